@@ -1,11 +1,27 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, abort, jsonify
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
+from assets import assets, build_assets
+from conditional import add_validators, message_etag, not_modified, profile_etag, timeline_etag
+from followgraph import follow_graph
+from fragments import fragment_cache, message_card
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes, Follows
+from hashing import calibrate_log_rounds, hashing_pool, HashingPoolSaturated
+from likecounts import like_counter
+from models import db, connect_db, User, Message, Likes, Follows, Suggestion
+from pagination import decode_cursor, split_page
+from profiler import QueryProfiler
+from purge import pending_purges, purge_account, purge_worker
+from schema import upgrade_schema
+from search import username_index
+from suggestions import compute_suggestions
+from usercache import user_cache
+from throttle import login_throttle, STORES
+from timelines import home_timeline, rebuild_timelines
 
 CURR_USER_KEY = "curr_user"
 
@@ -20,9 +36,102 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Authors with at least this many followers are merged into timelines on
+# read instead of being fanned out on write (see timelines.py).
+app.config['TIMELINE_CELEBRITY_THRESHOLD'] = int(
+    os.environ.get('TIMELINE_CELEBRITY_THRESHOLD', 10000))
+
+# Messages shown per page on the home page, profiles and likes pages.
+app.config['MESSAGES_PER_PAGE'] = 20
+
+# How long (seconds) and how many logged-in users are cached per process
+# (see usercache.py).
+app.config['USER_CACHE_TTL'] = 30
+app.config['USER_CACHE_SIZE'] = 10000
+
+# How long (seconds) and how many rendered message cards are cached per
+# process (see fragments.py).
+app.config['FRAGMENT_CACHE_TTL'] = 300
+app.config['FRAGMENT_CACHE_SIZE'] = 20000
+
+# How long (seconds) browsers may cache the fingerprinted files built by
+# `flask build-assets` (see assets.py).
+app.config['ASSET_MAX_AGE'] = 365 * 24 * 60 * 60
+
+# bcrypt cost for new password hashes; stored hashes are moved to it as
+# users log in. Run `flask calibrate-bcrypt` on the production hardware.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+
+# Password hashes run at once, and how many more may wait, before logins
+# and signups get a 503 (see hashing.py).
+app.config['HASHING_WORKERS'] = int(os.environ.get('HASHING_WORKERS', os.cpu_count() or 1))
+app.config['HASHING_QUEUE_DEPTH'] = int(
+    os.environ.get('HASHING_QUEUE_DEPTH', 4 * app.config['HASHING_WORKERS']))
+
+# Failed logins allowed per username and per client IP within a sliding
+# window (seconds) before /login refuses without checking the password
+# (see throttle.py). With several workers, use the 'database' store so
+# they all count the same failures; 'memory' counts per process.
+app.config['LOGIN_THROTTLE_WINDOW'] = 900
+app.config['LOGIN_THROTTLE_USERNAME_LIMIT'] = 5
+app.config['LOGIN_THROTTLE_IP_LIMIT'] = 50
+app.config['LOGIN_THROTTLE_STORE'] = os.environ.get('LOGIN_THROTTLE_STORE', 'memory')
+
+# Seconds between writes of the batched like counts (see likecounts.py).
+app.config['LIKE_COUNT_FLUSH_INTERVAL'] = 2
+
+# Deleted accounts are deactivated in the request and purged afterwards,
+# this many rows per DELETE, on a background thread (see purge.py).
+app.config['ACCOUNT_PURGE_BATCH_SIZE'] = 1000
+app.config['ACCOUNT_PURGE_BACKGROUND'] = True
+
+# Most follows held by the in-memory follow graph, how often (seconds)
+# it's rebuilt from the database, and whether on a background thread
+# (see followgraph.py).
+app.config['FOLLOW_GRAPH_MAX_EDGES'] = int(os.environ.get('FOLLOW_GRAPH_MAX_EDGES', 25_000_000))
+app.config['FOLLOW_GRAPH_MAX_AGE'] = 300
+app.config['FOLLOW_GRAPH_BACKGROUND'] = True
+
+# Who-to-follow suggestions stored per user by `flask suggest-follows`,
+# and how many of them the homepage shows (see suggestions.py).
+app.config['SUGGESTIONS_PER_USER'] = 10
+app.config['SUGGESTIONS_SHOWN'] = 5
+
+# Most users returned by a /users?q= search.
+app.config['USER_SEARCH_LIMIT'] = 50
+
+# Most SQL statements each route may run per request (see profiler.py).
+# Over budget is logged; with SQL_BUDGET_STRICT (as in the tests) it's an error.
+app.config['SQL_STATEMENT_BUDGETS'] = {
+    'homepage': 10,
+    'users_show': 10,
+    'show_likes': 10,
+    'show_following': 10,
+    'users_followers': 10,
+    'list_users': 10,
+    'messages_show': 10,
+    'messages_add': 10,
+}
+app.config['SQL_BUDGET_STRICT'] = os.environ.get('SQL_BUDGET_STRICT') == '1'
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+QueryProfiler(app)
+hashing_pool.init_app(app)
+purge_worker.init_app(app)
+assets.init_app(app)
+like_counter.init_app(app)
+app.jinja_env.globals['like_count'] = like_counter.count
+app.jinja_env.globals['message_card'] = message_card
+follow_graph.configure(max_edges=app.config['FOLLOW_GRAPH_MAX_EDGES'],
+                       max_age=app.config['FOLLOW_GRAPH_MAX_AGE'])
+user_cache.configure(ttl=app.config['USER_CACHE_TTL'], size=app.config['USER_CACHE_SIZE'])
+fragment_cache.configure(ttl=app.config['FRAGMENT_CACHE_TTL'], size=app.config['FRAGMENT_CACHE_SIZE'])
+login_throttle.configure(window=app.config['LOGIN_THROTTLE_WINDOW'],
+                         username_limit=app.config['LOGIN_THROTTLE_USERNAME_LIMIT'],
+                         ip_limit=app.config['LOGIN_THROTTLE_IP_LIMIT'],
+                         store=STORES[app.config['LOGIN_THROTTLE_STORE']]())
 
 
 ##############################################################################
@@ -31,10 +140,16 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a read-only UserSnapshot from the per-process cache, not a
+    User row; routes that need to write go through the models by id.
+    """
+
+    g.pop('followed_ids', None)
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = user_cache.get(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -108,11 +223,19 @@ def login():
     form = LoginForm()
 
     if form.is_submitted() and form.validate():
+        # Refuse before paying for a bcrypt check if this username or
+        # address has failed too often lately.
+        retry_after = login_throttle.check(form.username.data, request.remote_addr)
+        if retry_after:
+            flash(f"Too many failed login attempts. Try again in {retry_after} seconds.", 'danger')
+            return render_template('users/login.html', form=form), 429, {'Retry-After': str(retry_after)}
+
         with app.app_context():
             user = User.authenticate(form.username.data,
                                     form.password.data)
 
         if user:
+            login_throttle.record_success(form.username.data, request.remote_addr)
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             print('-------------------')
@@ -120,6 +243,7 @@ def login():
             print('-------------------')
             return redirect("/")
 
+        login_throttle.record_failure(form.username.data, request.remote_addr)
         flash("Invalid credentials.", 'danger')
 
     return render_template('users/login.html', form=form)
@@ -138,6 +262,21 @@ def logout():
         return redirect("/login")
 
 
+def active_user_or_404(user_id):
+    """Load user `user_id`, treating a deactivated account as missing."""
+
+    return User.query.filter_by(id=user_id, deactivated_at=None).first_or_404()
+
+
+def request_cursor():
+    """Read the `?before=` pagination cursor, rejecting malformed ones."""
+
+    try:
+        return decode_cursor(request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+
 ##############################################################################
 # General user routes:
 
@@ -151,34 +290,58 @@ def list_users():
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users = User.query.filter_by(deactivated_at=None).all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = User.search(search, limit=app.config['USER_SEARCH_LIMIT'])
+
+    # One follows query for every card's Follow/Unfollow button.
+    if g.user:
+        g.user.follows_among(users)
 
     return render_template('users/index.html', users=users)
 
 
+@app.route('/users/typeahead')
+def users_typeahead():
+    """JSON list of users whose username starts with the 'q' param.
+
+    Served from the in-memory prefix index, so it's cheap enough to call
+    on every keystroke.
+    """
+
+    return jsonify(username_index.prefix(request.args.get('q', ''), limit=10))
+
+
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = active_user_or_404(user_id)
+
+    response = not_modified(profile_etag(g.user, user))
+    if response:
+        return response
+
+    cursor = request_cursor()
+    page_size = app.config['MESSAGES_PER_PAGE']
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    
-    likes = Likes.query.filter(Likes.user_id == user_id).all()
+    messages = Message.posted_by(user_id, limit=page_size + 1, before=cursor)
+    messages, next_cursor = split_page(messages, page_size)
+
+    # The viewer's likes among this page only, for the like buttons.
+    viewer_id = g.user.id if g.user else None
+    other_likes = Likes.liked_message_ids(viewer_id, [message.id for message in messages])
 
-    other_likes = Likes.query.filter(Likes.user_id == session[CURR_USER_KEY]).all()
-    other_likes_ids = [other_like.message_id for other_like in other_likes]
+    # From the in-memory follow graph; None if it isn't loaded.
+    known_followers = None
+    if viewer_id and viewer_id != user_id:
+        known_followers = follow_graph.followed_by_followed(viewer_id, user_id)
 
-    return render_template('users/show.html', user=user, messages=messages, likes=likes, other_likes=other_likes_ids)
+    return render_template('users/show.html', user=user, messages=messages, likes_count=Likes.count_by(user_id),
+                           other_likes=other_likes,
+                           known_followers=known_followers, next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -189,11 +352,10 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-
-    likes = Likes.query.filter(Likes.user_id == user_id).all()
+    user = active_user_or_404(user_id)
+    g.user.follows_among(user.following)
 
-    return render_template('users/following.html', user=user, likes=likes)
+    return render_template('users/following.html', user=user, likes_count=Likes.count_by(user_id))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -204,11 +366,10 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = active_user_or_404(user_id)
+    g.user.follows_among(user.followers)
 
-    likes = Likes.query.filter(Likes.user_id == user_id).all()
-
-    return render_template('users/followers.html', user=user, likes=likes)
+    return render_template('users/followers.html', user=user, likes_count=Likes.count_by(user_id))
 
 
 @app.route('/users/<int:user_id>/likes')
@@ -219,16 +380,17 @@ def show_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    user = User.query.get_or_404(user_id)
+    user = active_user_or_404(user_id)
+    cursor = request_cursor()
+    page_size = app.config['MESSAGES_PER_PAGE']
 
-    liked = Likes.query.filter(Likes.user_id == user.id).all()
-    liked_ids = [like.message_id for like in liked]
-    liked_posts = Message.query.filter(Message.id.in_(liked_ids))
+    liked_posts = Message.liked_by(user.id, limit=page_size + 1, before=cursor)
+    liked_posts, next_cursor = split_page(liked_posts, page_size)
 
-    other_likes = Likes.query.filter(Likes.user_id == session[CURR_USER_KEY]).all()
-    other_likes_ids = [other_like.message_id for other_like in other_likes]
+    other_likes = Likes.liked_message_ids(g.user.id, [message.id for message in liked_posts])
 
-    return render_template('users/likes.html', user=user, messages=liked_posts, likes=liked, other_likes=other_likes_ids)
+    return render_template('users/likes.html', user=user, messages=liked_posts, likes_count=Likes.count_by(user.id),
+                           other_likes=other_likes, next_cursor=next_cursor)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -239,8 +401,8 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_user = active_user_or_404(follow_id)
+    db.session.add(Follows(user_being_followed_id=followed_user.id, user_following_id=g.user.id))
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -254,8 +416,10 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    # Go through the Follows row (not g.user.following) so the timeline
+    # listeners in timelines.py see the delete.
+    follow = Follows.query.filter_by(user_being_followed_id=follow_id, user_following_id=g.user.id).first_or_404()
+    db.session.delete(follow)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -271,20 +435,28 @@ def profile():
         return redirect("/")
     
     form = UserEditForm()
-    current_user_id = session[CURR_USER_KEY]
-    with app.app_context():
-        current_user = User.query.get(current_user_id)
+    current_user = g.user
+    current_user_id = current_user.id
 
     # If the request is a post request and the password is correct, any form data that is truthy will be used to update the user instance.
     if form.is_submitted() and form.validate():
+        # The password check is throttled like a login, so this form
+        # can't be used to guess the password of a stolen session.
+        retry_after = login_throttle.check(current_user.username, request.remote_addr)
+        if retry_after:
+            flash(f"Too many failed password attempts. Try again in {retry_after} seconds.", 'danger')
+            return render_template("users/edit.html", user=current_user, form=form), 429, {'Retry-After': str(retry_after)}
+
         with app.app_context():
             # If the password is correct
             if User.authenticate(current_user.username, form.password.data):
+                login_throttle.record_success(current_user.username, request.remote_addr)
                 User.update_user(user_id=current_user_id, username=form.username.data, email=form.email.data, image_url=form.image_url.data, header_image_url=form.header_image_url.data, bio=form.bio.data)
                 flash("You successfully updated your profile information!", "success")
                 return redirect(f"/users/{current_user_id}")
             # If the password is incorrect
             else:
+                login_throttle.record_failure(current_user.username, request.remote_addr)
                 flash("The password provided was invalid.", "danger")
                 return redirect("/users/profile")
     
@@ -299,32 +471,13 @@ def delete_user():
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    # Delete every reference to a follower or accounts being followed
-    Follows.query.filter(Follows.user_being_followed_id == session[CURR_USER_KEY]).delete()
-    Follows.query.filter(Follows.user_following_id == session[CURR_USER_KEY]).delete()
-    db.session.commit()
+    # Hide the account now; its rows are deleted in batches off the
+    # request (see purge.py).
+    user_id = g.user.id
+    User.deactivate(user_id)
+    purge_worker.enqueue(user_id)
 
-    # Delete every message that was liked by the account
-    Likes.query.filter(Likes.user_id == session[CURR_USER_KEY]).delete()
-    db.session.commit()
-
-    # Delete every message of the account that has been liked
-    all_messages = Message.query.filter(Message.user_id == session[CURR_USER_KEY]).all()
-    all_messages_ids = [message.id for message in all_messages]
-    Likes.query.filter(Likes.message_id.in_(all_messages_ids)).delete()
-    db.session.commit()
-
-    # Delete every message that comes from the account
-    Message.query.filter(Message.user_id == session[CURR_USER_KEY]).delete()
-    db.session.commit()
-
-    # Delete the profile and remove any information from session
-    current_user = User.query.filter(User.id == session[CURR_USER_KEY]).first()
-    
-    db.session.delete(current_user)
-    db.session.commit()
-
-    session.pop()
+    do_logout()
 
     return redirect("/signup")
 
@@ -346,8 +499,8 @@ def messages_add():
     form = MessageForm()
 
     if form.is_submitted() and form.validate():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -359,11 +512,17 @@ def messages_add():
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = Message.shown(message_id)
+    if msg is None:
+        abort(404)
+
+    response = not_modified(message_etag(g.user, msg))
+    if response:
+        return response
 
-    like = Likes.query.filter((Likes.user_id == session[CURR_USER_KEY]) & (Likes.message_id == message_id)).first()
+    likes = Likes.liked_message_ids(g.user.id if g.user else None, [msg.id])
 
-    return render_template('messages/show.html', message=msg, like=like)
+    return render_template('messages/show.html', message=msg, likes=likes)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -400,7 +559,7 @@ def like_message(message_id):
     
     message_id = request.view_args["message_id"]
     msg = Message.query.get(message_id)
-    current_user = User.query.get(session[CURR_USER_KEY])
+    current_user = g.user
     
     # redirects if the user attempts to like their own post
     if msg.user_id == current_user.id:
@@ -411,7 +570,11 @@ def like_message(message_id):
     else:
         new_like = Likes(user_id=current_user.id, message_id=msg.id)
         db.session.add(new_like)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Already liked (a double submit); likes are unique per user.
+            db.session.rollback()
         return redirect("/")
 
 @app.route("/users/remove_like/<int:message_id>", methods=["POST"])
@@ -425,7 +588,7 @@ def unlike_message(message_id):
     
     message_id = request.view_args["message_id"]
     msg = Message.query.get(message_id)
-    current_user = User.query.get(session[CURR_USER_KEY])
+    current_user = g.user
     liked_message = Likes.query.filter((Likes.user_id == current_user.id) & (Likes.message_id == msg.id)).first()
 
     
@@ -456,46 +619,144 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
-        # Extract the current user along with the ids of their following list.
-        current_user = User.query.get(session[CURR_USER_KEY])
-        followed_users = current_user.following
-        followed_users_ids = [followed_user.id for followed_user in followed_users]
-        # Append user's own id to end of list (easier than adding an extra condition on query statement)
-        followed_users_ids.append(session[CURR_USER_KEY])
-        # Send the last 100 messages from followers and self to home page.
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(followed_users_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        
-        messages_ids = [message.id for message in messages if message.user_id != current_user.id]
-        liked_posts = Likes.query.filter(Likes.message_id.in_(messages_ids))
-        likes = [like.message_id for like in liked_posts]
-
-        return render_template('home.html', messages=messages, likes=likes)
+        current_user = g.user
+
+        # Revalidating browsers are answered before the timeline is read.
+        response = not_modified(timeline_etag(current_user))
+        if response:
+            return response
+
+        cursor = request_cursor()
+        page_size = app.config['MESSAGES_PER_PAGE']
+        # The timeline is materialized on write (see timelines.py), so this
+        # is a single range read no matter how many accounts are followed.
+        messages = home_timeline(current_user.id, limit=page_size + 1, before=cursor)
+        messages, next_cursor = split_page(messages, page_size)
+
+        likes = Likes.liked_message_ids(current_user.id, [message.id for message in messages])
+
+        # Precomputed by `flask suggest-follows`; one indexed range read.
+        suggestions = Suggestion.for_user(current_user.id, limit=app.config['SUGGESTIONS_SHOWN'])
+
+        return render_template('home.html', messages=messages, likes=likes, suggestions=suggestions,
+                               next_cursor=next_cursor)
 
     else:
         return render_template('home-anon.html')
 
+
+@app.errorhandler(HashingPoolSaturated)
+def hashing_pool_saturated(error):
+    """Too many logins/signups are hashing at once: shed this one."""
+
+    return "Too many sign-ins in progress. Please try again in a moment.", 503, {'Retry-After': '1'}
+
+
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Add any tables, columns and indexes missing from an existing database."""
+
+    changes = upgrade_schema()
+    for change in changes:
+        print(change)
+
+    # New counter columns start at zero and a new timelines table starts
+    # empty; fill them from the source tables.
+    if any(change.startswith('added column users.') for change in changes):
+        User.reconcile_counts()
+    if 'added column messages.like_count' in changes:
+        Message.reconcile_like_counts()
+    if 'created table timelines' in changes:
+        rebuild_timelines()
+
+    print(f"Schema is up to date ({len(changes)} change(s)).")
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress the static files into static/dist."""
+
+    manifest = build_assets()
+    print(f"Built {len(manifest)} asset(s) into {assets.dist_dir}.")
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Recompute every materialized home timeline."""
+
+    rebuild_timelines()
+    print("Rebuilt home timelines.")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recompute the message/follower/following counts on every user and
+    the like count on every message."""
+
+    drifted = User.reconcile_counts()
+    print(f"Reconciled counters for {drifted} user(s).")
+
+    like_counter.flush()
+    drifted = Message.reconcile_like_counts()
+    print(f"Reconciled like counts for {drifted} message(s).")
+
+
+@app.cli.command('purge-accounts')
+def purge_accounts_command():
+    """Finish purging deactivated accounts (e.g. after a restart)."""
+
+    user_ids = pending_purges()
+    for user_id in user_ids:
+        purge = purge_account(user_id)
+        print(f"user {user_id}: {purge.follows_deleted} follows, {purge.likes_deleted} likes, "
+              f"{purge.messages_deleted} messages")
+
+    print(f"Purged {len(user_ids)} account(s).")
+
+
+@app.cli.command('suggest-follows')
+def suggest_follows_command():
+    """Recompute every user's who-to-follow suggestions."""
+
+    summary = compute_suggestions()
+    print(f"Stored {summary['suggestions']} suggestions for {summary['users']} user(s) "
+          f"from {summary['follows']} follows in {summary['seconds']}s ({summary['engine']}).")
+
+
+@app.cli.command('calibrate-bcrypt')
+@click.option('--target-ms', default=250, show_default=True,
+              help="Longest a single password hash should take.")
+def calibrate_bcrypt_command(target_ms):
+    """Pick the bcrypt cost that hashes within a target time on this machine."""
+
+    log_rounds, timings = calibrate_log_rounds(target_ms)
+    for rounds, milliseconds in timings.items():
+        print(f"cost {rounds}: {milliseconds:.1f}ms")
+
+    print(f"Set BCRYPT_LOG_ROUNDS={log_rounds} (currently {app.config['BCRYPT_LOG_ROUNDS']}).")
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Caching headers
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Pages that set validators (see conditional.py) may be kept by the
+# browser and revalidated; nothing else is cached.
 
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add validators or non-caching headers to every response."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
+    # Fingerprinted assets set their own year-long caching.
+    if not (add_validators(req) or req.cache_control.immutable):
+        req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        req.headers["Pragma"] = "no-cache"
+        req.headers["Expires"] = "0"
     return req
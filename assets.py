@@ -0,0 +1,189 @@
+"""Fingerprinted, precompressed static assets.
+
+``flask build-assets`` copies every file under ``static/`` into
+``static/dist/`` with a hash of its content in the name
+(``stylesheets/style.css`` -> ``stylesheets/style.1f0c9a2b3d4e5f60.css``),
+rewrites the ``/static/...`` urls inside stylesheets to the hashed
+names, writes gzip (and, with the optional ``brotli`` package, brotli)
+variants of text assets, and records the mapping in
+``static/dist/manifest.json``. Run it as part of every deploy, before
+the app starts: the manifest is read once, at import.
+
+Templates refer to assets through ``asset_url('stylesheets/style.css')``.
+With a manifest that gives the hashed url, which ``/static/dist/`` serves
+with ``Cache-Control: public, max-age=<a year>, immutable`` and the best
+precompressed variant the client accepts; a changed file gets a new
+name, so nothing ever needs revalidating. Without a manifest (in
+development) it gives the plain ``/static/`` url.
+
+Builds only add files, so pages rendered before a deploy can still load
+the assets they name; delete ``static/dist/`` to prune old versions.
+"""
+
+import gzip
+import json
+import mimetypes
+import os
+import re
+from hashlib import sha256
+
+from flask import abort, request, send_from_directory
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+# Where build_assets() writes, relative to the static directory.
+DIST = 'dist'
+
+MANIFEST = 'manifest.json'
+
+# Default for the ASSET_MAX_AGE config key (seconds): a year.
+MAX_AGE = 365 * 24 * 60 * 60
+
+# Assets worth compressing; images are compressed already.
+TEXT_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt', '.ico'}
+
+# Precompressed variants, most preferred first: (encoding, suffix).
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+STATIC_URL = re.compile(r'''url\((['"]?)/static/([^'")?#]+)\1\)''')
+
+
+def fingerprint(path, content):
+    """`path` with a hash of `content` before its extension."""
+
+    base, extension = os.path.splitext(path)
+    return f"{base}.{sha256(content).hexdigest()[:16]}{extension}"
+
+
+def compress(content):
+    """`{suffix: compressed content}` for each encoding that shrinks it."""
+
+    variants = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(content, quality=11)
+
+    return {suffix: compressed for suffix, compressed in variants.items() if len(compressed) < len(content)}
+
+
+def rewrite_urls(css, manifest):
+    """`css` with its /static/ urls pointed at the hashed files in `manifest`."""
+
+    def hashed(match):
+        quote, path = match.groups()
+        if path not in manifest:
+            return match.group(0)
+        return f"url({quote}/static/{DIST}/{manifest[path]}{quote})"
+
+    return STATIC_URL.sub(hashed, css)
+
+
+def source_files(static_dir):
+    """Paths (relative, with '/') of the files under `static_dir`, outside
+    the build directory, stylesheets last so the files they name are
+    hashed first."""
+
+    paths = []
+    for directory, subdirectories, files in os.walk(static_dir):
+        if directory == static_dir:
+            subdirectories[:] = [name for name in subdirectories if name != DIST]
+        for name in files:
+            paths.append(os.path.relpath(os.path.join(directory, name), static_dir).replace(os.sep, '/'))
+
+    return sorted(paths, key=lambda path: (path.endswith('.css'), path))
+
+
+def build_assets(static_dir=STATIC_DIR):
+    """Fingerprint and precompress everything under `static_dir` into its
+    dist directory. Returns the manifest."""
+
+    dist_dir = os.path.join(static_dir, DIST)
+    manifest = {}
+
+    for path in source_files(static_dir):
+        with open(os.path.join(static_dir, path), 'rb') as source:
+            content = source.read()
+
+        if path.endswith('.css'):
+            content = rewrite_urls(content.decode(), manifest).encode()
+
+        manifest[path] = fingerprint(path, content)
+        variants = {'': content}
+        if os.path.splitext(path)[1] in TEXT_EXTENSIONS:
+            variants.update(compress(content))
+
+        for suffix, data in variants.items():
+            target = os.path.join(dist_dir, manifest[path] + suffix)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as output:
+                output.write(data)
+
+    # Replace the manifest in one step, so a running app never reads half of it.
+    manifest_path = os.path.join(dist_dir, MANIFEST)
+    with open(manifest_path + '.tmp', 'w') as output:
+        json.dump(manifest, output, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    return manifest
+
+
+class Assets:
+    """The build manifest, the asset_url() template helper and the route
+    serving built assets."""
+
+    def __init__(self, static_dir=STATIC_DIR):
+        self.max_age = MAX_AGE
+        self.load(static_dir)
+
+    def init_app(self, app):
+        self.max_age = app.config.get('ASSET_MAX_AGE', MAX_AGE)
+        app.jinja_env.globals['asset_url'] = self.url
+        app.add_url_rule(f'/static/{DIST}/<path:filename>', 'asset', self.send)
+
+    def load(self, static_dir):
+        """Read `static_dir`'s manifest, if it has been built."""
+
+        self.dist_dir = os.path.join(static_dir, DIST)
+        try:
+            with open(os.path.join(self.dist_dir, MANIFEST)) as manifest:
+                self.manifest = json.load(manifest)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def url(self, path):
+        """The url to use for static file `path`, e.g. 'images/warbler-logo.png'."""
+
+        hashed = self.manifest.get(path)
+        if hashed is None:
+            return f"/static/{path}"
+        return f"/static/{DIST}/{hashed}"
+
+    def send(self, filename):
+        """Serve a built asset, precompressed if the client accepts it."""
+
+        if filename == MANIFEST:
+            abort(404)
+
+        mimetype = mimetypes.guess_type(filename)[0]
+        encoding = None
+        for name, suffix in ENCODINGS:
+            variant = safe_join(self.dist_dir, filename + suffix)
+            if request.accept_encodings.quality(name) > 0 and variant and os.path.isfile(variant):
+                encoding, filename = name, filename + suffix
+                break
+
+        response = send_from_directory(self.dist_dir, filename, mimetype=mimetype, max_age=self.max_age)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.cache_control.immutable = True
+
+        return response
+
+
+assets = Assets()
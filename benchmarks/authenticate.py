@@ -0,0 +1,78 @@
+"""Time User.authenticate() at each bcrypt cost.
+
+For each cost a user is created with a hash at that cost and logged in
+repeatedly (with BCRYPT_LOG_ROUNDS set to match, so nothing is
+rehashed). Prints p50/p99 latency and throughput per cost, for choosing
+BCRYPT_LOG_ROUNDS alongside ``flask calibrate-bcrypt``.
+
+Run it from the repo root. By default it uses an in-memory SQLite
+database, since the query is trivial next to the hash:
+
+    python benchmarks/authenticate.py
+    python benchmarks/authenticate.py --min-cost 10 --max-cost 14 --logins 50 --threads 4
+
+With ``--threads`` above 1 the logins are issued concurrently, which
+shows the hashing pool's queueing (see hashing.py).
+"""
+
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app import app  # noqa: E402
+from hashing import percentile  # noqa: E402
+from models import db, User  # noqa: E402
+
+PASSWORD = "benchmark password"
+
+
+def time_logins(username, logins, threads):
+    def login(_):
+        with app.app_context():
+            started = perf_counter()
+            assert User.authenticate(username, PASSWORD)
+            return perf_counter() - started
+
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        timings = list(executor.map(login, range(logins)))
+
+    return timings, perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--min-cost", type=int, default=10)
+    parser.add_argument("--max-cost", type=int, default=14)
+    parser.add_argument("--logins", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+
+    print(f"{'cost':>4}  {'p50 ms':>9}  {'p99 ms':>9}  {'logins/s':>9}")
+
+    for cost in range(args.min_cost, args.max_cost + 1):
+        app.config['BCRYPT_LOG_ROUNDS'] = cost
+        username = f"bench_cost_{cost}"
+
+        with app.app_context():
+            User.query.filter_by(username=username).delete()
+            User.signup(username=username, email=f"{username}@example.com", password=PASSWORD,
+                        image_url=User.image_url.default.arg)
+            db.session.commit()
+
+        timings, elapsed = time_logins(username, args.logins, args.threads)
+
+        print(f"{cost:>4}  {percentile(timings, 0.5) * 1000:>9.1f}  "
+              f"{percentile(timings, 0.99) * 1000:>9.1f}  {args.logins / elapsed:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""Time Warbler's hot paths at several database sizes.
+
+For each scale (number of messages) the database is regenerated with
+generator/create_csvs.py and loaded with seed.py, then each hot path is
+timed on its own:
+
+- authenticate: User.authenticate() for a seeded user
+- is_following: User.is_following() between two users
+- home_timeline: the homepage() timeline query
+- users_show / show_likes: the full routes, through the test client
+- render_home: rendering home.html for a page of messages
+
+Results go to a JSON file (one record per scale and benchmark) so two
+runs can be diffed in review. Nothing but the database is needed; run
+it from the repo root against a database you don't mind losing:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/hotpaths.py
+    DATABASE_URL=sqlite:////tmp/bench.db python benchmarks/hotpaths.py --scales 1000,100000 --out /tmp/hotpaths.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DATABASE_URL', 'postgresql:///warbler_bench')
+
+from flask import g, render_template  # noqa: E402
+from sqlalchemy import insert, literal, select  # noqa: E402
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from fragments import fragment_cache  # noqa: E402
+from hashing import percentile  # noqa: E402
+from models import db, Likes, Message, User  # noqa: E402
+from search import username_index  # noqa: E402
+from timelines import home_timeline, recent_messages  # noqa: E402
+from usercache import user_cache  # noqa: E402
+
+PASSWORD = "password"
+
+# Likes given to the viewer, so show_likes has a page to show.
+VIEWER_LIKES = 200
+
+
+def seed(messages, seed_value):
+    """Regenerate and load a database with `messages` messages."""
+
+    users = max(100, messages // 10)
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run([sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+                        '--users', str(users), '--messages', str(messages), '--follows', str(messages),
+                        '--seed', str(seed_value), '--out', directory], check=True)
+        subprocess.run([sys.executable, os.path.join(ROOT, 'seed.py'), '--dir', directory],
+                       check=True, cwd=ROOT, stdout=subprocess.DEVNULL)
+
+    user_cache.clear()
+    fragment_cache.clear()
+    username_index.reset()
+    recent_messages.clear()
+
+
+def pick_users():
+    """The most-following user (the viewer) and the most prolific author."""
+
+    viewer = User.query.order_by(User.following_count.desc(), User.id).first()
+    author = User.query.filter(User.id != viewer.id).order_by(User.messages_count.desc(), User.id).first()
+
+    db.session.execute(insert(Likes).from_select(
+        ['user_id', 'message_id'],
+        select(literal(viewer.id), Message.id)
+        .where(Message.user_id != viewer.id)
+        .order_by(Message.id)
+        .limit(VIEWER_LIKES)))
+    db.session.commit()
+
+    return viewer, author
+
+
+def time_calls(fn, runs):
+    fn()  # warm caches (and rehash the password at the configured cost)
+    timings = []
+    for _ in range(runs):
+        started = perf_counter()
+        fn()
+        timings.append(perf_counter() - started)
+    return timings
+
+
+def benchmarks(viewer, author, page_size):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = viewer.id
+
+    def get(path):
+        def request():
+            response = client.get(path)
+            assert response.status_code == 200, f"{path} returned {response.status_code}"
+        return request
+
+    def is_following():
+        # As on a fresh request: nothing about the viewer is loaded yet.
+        db.session.expire(viewer)
+        return viewer.is_following(author)
+
+    def render_home():
+        messages = home_timeline(viewer.id, limit=page_size)
+        likes = Likes.liked_message_ids(viewer.id, [message.id for message in messages])
+        with app.test_request_context('/'):
+            g.user = user_cache.get(viewer.id)
+            started = perf_counter()
+            render_template('home.html', messages=messages, likes=likes, next_cursor=None)
+            return perf_counter() - started
+
+    return {
+        'authenticate': lambda: User.authenticate(viewer.username, PASSWORD),
+        'is_following': is_following,
+        'home_timeline': lambda: home_timeline(viewer.id, limit=page_size + 1),
+        'users_show': get(f"/users/{author.id}"),
+        'show_likes': get(f"/users/{viewer.id}/likes"),
+        'render_home': render_home,
+    }
+
+
+def run_scale(messages, args):
+    print(f"\nSeeding {messages} messages...")
+    seed(messages, args.seed)
+
+    records = []
+    with app.app_context():
+        viewer, author = pick_users()
+        print(f"viewer #{viewer.id} follows {viewer.following_count}; "
+              f"author #{author.id} has {author.messages_count} messages")
+
+        for name, fn in benchmarks(viewer, author, app.config['MESSAGES_PER_PAGE']).items():
+            runs = min(args.runs, 5) if name == 'authenticate' else args.runs
+            if name == 'render_home':
+                # Time only the template, not the query feeding it.
+                fn()
+                timings = [fn() for _ in range(runs)]
+            else:
+                timings = time_calls(fn, runs)
+
+            record = {
+                'scale': messages,
+                'benchmark': name,
+                'runs': runs,
+                'median_ms': round(percentile(timings, 0.5) * 1000, 3),
+                'p95_ms': round(percentile(timings, 0.95) * 1000, 3),
+                'min_ms': round(min(timings) * 1000, 3),
+            }
+            records.append(record)
+            print(f"  {name:<14} median {record['median_ms']:>9.3f}ms  p95 {record['p95_ms']:>9.3f}ms")
+
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--scales', default='1000,100000,1000000',
+                        help="comma-separated message counts")
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='hotpaths.json')
+    args = parser.parse_args()
+
+    # Benchmarks shouldn't fail on the test suite's strict SQL budgets.
+    app.config['SQL_BUDGET_STRICT'] = False
+
+    results = []
+    for scale in (int(scale) for scale in args.scales.split(',')):
+        results.extend(run_scale(scale, args))
+
+    with app.app_context():
+        dialect = db.engine.dialect.name
+
+    with open(args.out, 'w') as output:
+        json.dump({
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'database': dialect,
+            'bcrypt_log_rounds': app.config['BCRYPT_LOG_ROUNDS'],
+            'results': results,
+        }, output, indent=2)
+
+    print(f"\nWrote {len(results)} results to {args.out}.")
+
+
+if __name__ == "__main__":
+    main()
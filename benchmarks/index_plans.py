@@ -0,0 +1,167 @@
+"""Show query plans for Warbler's hot queries with and without the
+secondary indexes declared in models.py.
+
+Seeds a scratch database with synthetic users, messages, follows and
+likes, then prints the plan (and timing) of each hot query twice: once
+with only the primary keys and unique constraints, and once after the
+secondary indexes have been created.
+
+Run it from the repo root against a database you don't mind losing
+(every table is dropped and recreated):
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/index_plans.py
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/index_plans.py --messages 1000000
+
+With SQLite it prints ``EXPLAIN QUERY PLAN`` output instead of
+``EXPLAIN ANALYZE``.
+"""
+
+import argparse
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, text  # noqa: E402
+
+from models import db  # noqa: E402
+
+HOT_QUERIES = {
+    "profile page (messages by user_id, newest first)":
+        "SELECT id, text, timestamp FROM messages WHERE user_id = {user_id} "
+        "ORDER BY timestamp DESC, id DESC LIMIT 21",
+    "likes by user_id":
+        "SELECT message_id FROM likes WHERE user_id = {user_id}",
+    "(user_id, message_id) like lookup":
+        "SELECT id FROM likes WHERE user_id = {user_id} AND message_id = {message_id}",
+    "follows by user_following_id":
+        "SELECT user_being_followed_id FROM follows WHERE user_following_id = {user_id}",
+}
+
+# Only the secondary indexes on the tables the hot queries touch.
+BENCHMARKED_TABLES = ('messages', 'likes', 'follows')
+
+
+def seed_postgres(conn, users, messages, follows, likes):
+    conn.execute(text(
+        "INSERT INTO users (email, username, password) "
+        "SELECT 'user' || i || '@example.com', 'user' || i, 'x' "
+        "FROM generate_series(1, :users) AS i"), {"users": users})
+    conn.execute(text(
+        "INSERT INTO messages (text, timestamp, user_id) "
+        "SELECT 'message ' || i, now() - random() * interval '730 days', "
+        "1 + floor(random() * :users)::int "
+        "FROM generate_series(1, :messages) AS i"), {"users": users, "messages": messages})
+    conn.execute(text(
+        "INSERT INTO follows (user_being_followed_id, user_following_id) "
+        "SELECT DISTINCT 1 + floor(random() * :users)::int, 1 + floor(random() * :users)::int "
+        "FROM generate_series(1, :follows) "
+        "ON CONFLICT DO NOTHING"), {"users": users, "follows": follows})
+    conn.execute(text(
+        "INSERT INTO likes (user_id, message_id) "
+        "SELECT 1 + floor(random() * :users)::int, i "
+        "FROM generate_series(1, :likes) AS i"), {"users": users, "likes": likes})
+    conn.execute(text("ANALYZE"))
+
+
+def seed_sqlite(conn, users, messages, follows, likes, batch=50000):
+    rand = random.Random(0)
+
+    def batches(rows):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == batch:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    for chunk in batches({"id": i, "email": f"user{i}@example.com", "username": f"user{i}"}
+                         for i in range(1, users + 1)):
+        conn.execute(text("INSERT INTO users (id, email, username, password) "
+                          "VALUES (:id, :email, :username, 'x')"), chunk)
+
+    for chunk in batches({"text": f"message {i}",
+                          "timestamp": f"2023-{rand.randint(1, 12):02}-{rand.randint(1, 28):02} "
+                                       f"{rand.randint(0, 23):02}:00:00",
+                          "user_id": rand.randint(1, users)}
+                         for i in range(messages)):
+        conn.execute(text("INSERT INTO messages (text, timestamp, user_id) "
+                          "VALUES (:text, :timestamp, :user_id)"), chunk)
+
+    for chunk in batches({"followed": rand.randint(1, users), "follower": rand.randint(1, users)}
+                         for _ in range(follows)):
+        conn.execute(text("INSERT OR IGNORE INTO follows (user_being_followed_id, user_following_id) "
+                          "VALUES (:followed, :follower)"), chunk)
+
+    for chunk in batches({"user_id": rand.randint(1, users), "message_id": i}
+                         for i in range(1, likes + 1)):
+        conn.execute(text("INSERT INTO likes (user_id, message_id) VALUES (:user_id, :message_id)"), chunk)
+
+    conn.execute(text("ANALYZE"))
+
+
+def explain(conn, sql):
+    if conn.dialect.name == 'postgresql':
+        rows = conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {sql}")).all()
+        return "\n".join(row[0] for row in rows)
+
+    rows = conn.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+    return "\n".join(row[-1] for row in rows)
+
+
+def print_plans(conn, label, params):
+    print(f"\n{'=' * 78}\n{label}\n{'=' * 78}")
+
+    for name, sql in HOT_QUERIES.items():
+        query = sql.format(**params)
+        started = perf_counter()
+        conn.execute(text(query)).all()
+        elapsed = (perf_counter() - started) * 1000
+
+        print(f"\n-- {name} ({elapsed:.2f}ms)\n{explain(conn, query)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--follows", type=int, default=2000000)
+    parser.add_argument("--likes", type=int, default=500000)
+    args = parser.parse_args()
+
+    engine = create_engine(os.environ.get('DATABASE_URL', 'postgresql:///warbler_bench'))
+    indexes = [index for table in db.metadata.sorted_tables
+               if table.name in BENCHMARKED_TABLES
+               for index in table.indexes]
+
+    with engine.begin() as conn:
+        db.metadata.drop_all(conn)
+        db.metadata.create_all(conn)
+        for index in indexes:
+            index.drop(conn)
+
+        print(f"Seeding {args.users} users, {args.messages} messages, "
+              f"{args.follows} follows, {args.likes} likes...")
+        started = perf_counter()
+        seed = seed_postgres if conn.dialect.name == 'postgresql' else seed_sqlite
+        seed(conn, min(args.users, args.messages), args.messages, args.follows,
+             min(args.likes, args.messages))
+        print(f"Seeded in {perf_counter() - started:.1f}s")
+
+        params = {"user_id": 42, "message_id": 4242}
+
+        print_plans(conn, "BEFORE: primary keys and unique constraints only", params)
+
+        for index in indexes:
+            index.create(conn)
+        conn.execute(text("ANALYZE"))
+
+        print_plans(conn, "AFTER: " + ", ".join(index.name for index in indexes), params)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""Generate a request trace for Warbler and replay it under concurrency.
+
+A trace is a JSON-lines file, one request per line:
+
+    {"session": 3, "route": "like", "method": "POST", "path": "/users/add_like/812", "data": {}}
+
+Requests are grouped into sessions. Each session is one user logging in
+(password "password", as in the generated CSVs) and then browsing:
+viewing their home page and other profiles, posting, liking and
+following in roughly the proportions in MIX.
+
+``generate`` builds a trace from the users and messages already in the
+database (seed it first). ``replay`` runs the sessions on --concurrency
+threads, against the app in-process (Flask test client, the default) or
+a running server (--target http://localhost:5000). It reports throughput
+and p50/p95/p99 latency per route, and can save the numbers as JSON for
+comparing branches:
+
+    python benchmarks/loadtest.py generate --sessions 500 --out /tmp/trace.jsonl
+    python benchmarks/loadtest.py replay /tmp/trace.jsonl --concurrency 8 --json /tmp/main.json
+    python benchmarks/loadtest.py replay /tmp/trace.jsonl --target http://localhost:5000
+
+Both commands use the database in DATABASE_URL, like the app. In-process
+replay turns off CSRF checks; against a server the CSRF token is read
+from the form first (untimed).
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+from time import perf_counter
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import build_opener, HTTPCookieProcessor, HTTPRedirectHandler, Request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hashing import percentile  # noqa: E402
+
+# Share of each action within a session, after the initial login.
+MIX = {
+    'home': 0.45,
+    'profile': 0.25,
+    'post': 0.10,
+    'like': 0.12,
+    'follow': 0.05,
+    'logout': 0.03,
+}
+
+# Mean actions per session after the login.
+SESSION_LENGTH = 20
+
+PASSWORD = "password"
+
+# Routes whose forms carry a CSRF token.
+FORM_PATHS = ('/login', '/messages/new')
+
+
+def generate(args):
+    from app import app
+    from models import Follows, Likes, Message, User
+
+    rand = random.Random(args.seed)
+
+    with app.app_context():
+        users = User.query.with_entities(User.id, User.username).all()
+        message_ids = [message_id for (message_id,) in Message.query.with_entities(Message.id)]
+        liked = {}
+        for user_id, message_id in Likes.query.with_entities(Likes.user_id, Likes.message_id):
+            liked.setdefault(user_id, set()).add(message_id)
+        following = {}
+        for followed_id, follower_id in Follows.query.with_entities(
+                Follows.user_being_followed_id, Follows.user_following_id):
+            following.setdefault(follower_id, set()).add(followed_id)
+
+    if not users or not message_ids:
+        sys.exit("The database has no users or messages; run seed.py first.")
+
+    actions, weights = zip(*MIX.items())
+
+    with open(args.out, 'w') as trace:
+        def emit(session, route, method, path, data=None):
+            trace.write(json.dumps({'session': session, 'route': route, 'method': method,
+                                    'path': path, 'data': data or {}}) + "\n")
+
+        for session in range(args.sessions):
+            user_id, username = rand.choice(users)
+            emit(session, 'login', 'POST', '/login', {'username': username, 'password': PASSWORD})
+
+            for _ in range(max(1, int(rand.expovariate(1 / SESSION_LENGTH)))):
+                action = rand.choices(actions, weights)[0]
+
+                if action == 'home':
+                    emit(session, 'home', 'GET', '/')
+                elif action == 'profile':
+                    emit(session, 'profile', 'GET', f"/users/{rand.choice(users)[0]}")
+                elif action == 'post':
+                    emit(session, 'post', 'POST', '/messages/new',
+                         {'text': f"Load test message {rand.randrange(10 ** 9)}"})
+                elif action == 'like':
+                    message_id = rand.choice(message_ids)
+                    user_liked = liked.setdefault(user_id, set())
+                    if message_id not in user_liked:
+                        user_liked.add(message_id)
+                        emit(session, 'like', 'POST', f"/users/add_like/{message_id}")
+                elif action == 'follow':
+                    followed_id = rand.choice(users)[0]
+                    followed = following.setdefault(user_id, set())
+                    if followed_id != user_id and followed_id not in followed:
+                        followed.add(followed_id)
+                        emit(session, 'follow', 'POST', f"/users/follow/{followed_id}")
+                elif action == 'logout':
+                    emit(session, 'logout', 'GET', '/logout')
+                    break
+
+    print(f"Wrote {args.sessions} sessions to {args.out}.")
+
+
+class AppClient:
+    """Issues requests to the app in-process through the Flask test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data):
+        return self.client.open(path, method=method, data=data).status_code
+
+
+class NoRedirects(HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpClient:
+    """Issues requests to a running server, keeping cookies like a browser."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirects)
+
+    def _open(self, method, path, data=None):
+        body = urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(Request(self.base_url + path, data=body, method=method)) as response:
+                return response.status, response.read().decode()
+        except HTTPError as error:
+            return error.code, ''
+
+    def request(self, method, path, data):
+        if method == 'POST' and path in FORM_PATHS:
+            _, form = self._open('GET', path)
+            token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', form)
+            data = dict(data, csrf_token=token.group(1) if token else '')
+
+        return self._open(method, path, data if method == 'POST' else None)[0]
+
+
+def replay(args):
+    with open(args.trace) as trace:
+        entries = [json.loads(line) for line in trace if line.strip()]
+
+    sessions = {}
+    for entry in entries:
+        sessions.setdefault(entry['session'], []).append(entry)
+
+    if args.target:
+        make_client = lambda: HttpClient(args.target)  # noqa: E731
+    else:
+        from app import app
+        app.config['WTF_CSRF_ENABLED'] = False
+        make_client = lambda: AppClient(app)  # noqa: E731
+
+    def run_session(requests):
+        client = make_client()
+        timings = []
+        for entry in requests:
+            started = perf_counter()
+            status = client.request(entry['method'], entry['path'], entry['data'])
+            timings.append((entry['route'], status, perf_counter() - started))
+        return timings
+
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = [timing for timings in executor.map(run_session, sessions.values())
+                   for timing in timings]
+    elapsed = perf_counter() - started
+
+    report(results, elapsed, args)
+
+
+def report(results, elapsed, args):
+    routes = {}
+    for route, status, seconds in results:
+        routes.setdefault(route, []).append((status, seconds))
+
+    summary = {
+        'requests': len(results),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(results) / elapsed, 1),
+        'concurrency': args.concurrency,
+        'routes': {},
+    }
+
+    print(f"{'route':<10} {'requests':>8} {'errors':>6} {'req/s':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+
+    for route, samples in sorted(routes.items()):
+        timings = [seconds for _, seconds in samples]
+        stats = {
+            'requests': len(samples),
+            # 5xx, plus 429/503 from the login throttle and hashing pool.
+            'errors': sum(1 for status, _ in samples if status >= 500 or status == 429),
+            'throughput': round(len(samples) / elapsed, 1),
+            'p50_ms': round(percentile(timings, 0.5) * 1000, 2),
+            'p95_ms': round(percentile(timings, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(timings, 0.99) * 1000, 2),
+        }
+        summary['routes'][route] = stats
+        print(f"{route:<10} {stats['requests']:>8} {stats['errors']:>6} {stats['throughput']:>8} "
+              f"{stats['p50_ms']:>8} {stats['p95_ms']:>8} {stats['p99_ms']:>8}")
+
+    print(f"\n{summary['requests']} requests in {summary['seconds']}s "
+          f"({summary['throughput']} req/s, concurrency {args.concurrency})")
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(summary, output, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = commands.add_parser('generate', help="write a trace from the seeded database")
+    generate_parser.add_argument('--sessions', type=int, default=200)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.add_argument('--out', default='trace.jsonl')
+    generate_parser.set_defaults(run=generate)
+
+    replay_parser = commands.add_parser('replay', help="replay a trace and report latencies")
+    replay_parser.add_argument('trace')
+    replay_parser.add_argument('--concurrency', type=int, default=4)
+    replay_parser.add_argument('--target', help="base URL of a running server (default: in-process)")
+    replay_parser.add_argument('--json', help="also write the results to this file")
+    replay_parser.set_defaults(run=replay)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Conditional GET for Warbler's pages.
+
+The home timeline, profiles and message pages give their responses an
+ETag, so a browser revalidating a page it already has gets a bodiless
+304. Routes call ``not_modified()`` as soon as they know the ETag,
+before the heavy queries and the template render, and return its 304 if
+it gives one:
+
+    response = not_modified(timeline_etag(g.user))
+    if response:
+        return response
+
+Pages are per viewer, so an ETag always includes the viewer's id and
+``user_cache`` version (which changes with their profile, counters and
+follows) and responses are ``Cache-Control: private, no-cache``. The
+timeline's also includes the version of every author the viewer
+follows, which changes when they post, delete a message or edit their
+profile.
+
+There is no Last-Modified: no single timestamp changes with everything
+on these pages, and clients that send only If-Modified-Since would be
+given stale pages.
+
+The versions behind an ETag are this process's: ``user_cache`` versions
+and ``like_counter.version`` only count changes committed here. Every
+ETag therefore carries PROCESS_TOKEN, so one issued by another worker
+(or before a restart) never matches; with several workers that means a
+revalidation only pays off on the worker that served the page. Like
+counts that other processes flush aren't tracked either, so a 304 can
+show a count up to the next change on the page behind.
+
+A response that would display flashed messages gets no ETag: its body
+is a one-off, and a 304 would leave the flashes queued.
+"""
+
+from hashlib import sha1
+from uuid import uuid4
+
+from flask import current_app, g, request, session
+from werkzeug.http import is_resource_modified
+
+from followgraph import follow_graph
+from likecounts import like_counter
+from models import Follows
+from timelines import newest_on_timeline
+from usercache import user_cache
+
+# Distinguishes this process's ETags from any other's.
+PROCESS_TOKEN = uuid4().hex
+
+# Cache-Control for responses with validators: any cache may keep them,
+# but only for this viewer, and must revalidate before every use.
+VALIDATED_CACHE_CONTROL = 'private, no-cache'
+
+
+def make_etag(*parts):
+    """An opaque ETag value for `parts` (anything with a stable repr)."""
+
+    return sha1(repr((PROCESS_TOKEN,) + parts).encode()).hexdigest()
+
+
+def viewer_parts(viewer):
+    """What every page's validators depend on: who's looking, as of when."""
+
+    if viewer is None:
+        return (None, None)
+    return (viewer.id, user_cache.version(viewer.id))
+
+
+def timeline_etag(viewer):
+    """ETag for `viewer`'s home timeline: its newest message, their follow
+    set (through their version), the authors they follow and the likes
+    shown on it."""
+
+    followed = follow_graph.following(viewer.id)
+    if followed is None:
+        followed = Follows.followed_ids(viewer.id)
+    else:
+        followed = followed.tolist()
+
+    return make_etag('timeline', *viewer_parts(viewer), newest_on_timeline(viewer.id),
+                     user_cache.versions(followed), like_counter.version)
+
+
+def profile_etag(viewer, user):
+    """ETag for `user`'s profile page as `viewer` sees it."""
+
+    return make_etag('profile', *viewer_parts(viewer), user.id, user_cache.version(user.id),
+                     like_counter.version)
+
+
+def message_etag(viewer, message):
+    """ETag for a message's page as `viewer` sees it."""
+
+    return make_etag('message', *viewer_parts(viewer), message.id, user_cache.version(message.user_id),
+                     like_counter.version)
+
+
+def not_modified(etag):
+    """A 304 response if the request already has this version of the page,
+    otherwise None. Either way the full response gets the ETag."""
+
+    if session.get('_flashes'):
+        return None
+
+    g.etag = etag
+    if is_resource_modified(request.environ, etag=etag):
+        return None
+
+    response = current_app.response_class(status=304)
+    add_validators(response)
+    return response
+
+
+def add_validators(response):
+    """Put the ETag given to not_modified() on `response`. Returns whether
+    there was one."""
+
+    etag = g.get('etag')
+    if etag is None or response.status_code not in (200, 304):
+        return False
+
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = VALIDATED_CACHE_CONTROL
+    return True
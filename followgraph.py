@@ -0,0 +1,372 @@
+"""In-memory follow graph for Warbler.
+
+Graph reads (who follows whom, "followed by people you follow") are
+answered from two compressed sparse row (CSR) adjacency arrays over
+the follows table, without a database round trip. For user id ``u``,
+``indices[indptr[u]:indptr[u + 1]]`` holds the sorted ids that ``u``
+follows in one array and the ids following ``u`` in the other.
+
+Ids are int32 and offsets int64, so the graph costs 8 bytes per follow
+(4 in each direction) plus 16 bytes per user id. It is built in one
+pass, and not at all past MAX_EDGES follows; an unavailable graph
+answers None and callers go without.
+
+Builds run on a background thread, started by the first lookup and
+again by the first one after MAX_AGE seconds. Only one build runs at a
+time: meanwhile lookups keep reading the old graph (or get None before
+the first build finishes), and follows committed during the build are
+replayed onto the new one. With FOLLOW_GRAPH_BACKGROUND off (as in the
+tests) the lookup that finds a build due runs it itself.
+
+Follows and unfollows made through the ORM go into a small overlay of
+added and removed edges once their transaction commits. When the
+overlay reaches OVERLAY_MAX edges it is merged into new arrays. Bulk
+writes and other processes' writes are picked up when the graph is
+rebuilt, every MAX_AGE seconds.
+"""
+
+import json
+import logging
+from threading import Lock, Thread
+from time import monotonic
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session, object_session
+
+from models import db, Follows
+
+logger = logging.getLogger('warbler.followgraph')
+
+# Seconds before the graph is rebuilt from the database.
+MAX_AGE = 300
+
+# Most follows the graph will hold (about 8 bytes each).
+MAX_EDGES = 25_000_000
+
+# Rows fetched per round trip while building.
+BUILD_CHUNK = 100_000
+
+# Recent changes held outside the arrays before they're merged in.
+OVERLAY_MAX = 50_000
+
+EMPTY = np.empty(0, dtype=np.int32)
+
+
+def pack(sources, targets):
+    """One int64 key per edge, for sorting and set operations on edge lists."""
+
+    return (sources.astype(np.int64) << 32) | targets.astype(np.int64)
+
+
+def follow_edges():
+    """`(followers, followed)` int32 arrays of every follow, read from the
+    database BUILD_CHUNK rows at a time."""
+
+    result = db.session.execute(select(Follows.user_following_id, Follows.user_being_followed_id)
+                                .execution_options(yield_per=BUILD_CHUNK))
+    chunks = [np.array(rows, dtype=np.int32) for rows in result.partitions()]
+    edges = np.concatenate(chunks) if chunks else np.empty((0, 2), dtype=np.int32)
+
+    return edges[:, 0], edges[:, 1]
+
+
+class Adjacency:
+    """One direction of the graph in CSR form: each id's neighbours, sorted."""
+
+    __slots__ = ('indptr', 'indices')
+
+    def __init__(self, sources, targets, size):
+        self.indices = targets[np.argsort(pack(sources, targets))]
+        self.indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=size), out=self.indptr[1:])
+
+    def neighbours(self, node):
+        if not 0 <= node < len(self.indptr) - 1:
+            return EMPTY
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def edges(self):
+        """`(sources, targets)` arrays of every edge."""
+
+        sources = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int32), np.diff(self.indptr))
+        return sources, self.indices
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes
+
+
+class Overlay:
+    """Edges added and removed since the arrays were built, by source id.
+
+    The latest change to an edge wins, so an edge is never in both.
+    """
+
+    def __init__(self):
+        self.added = {}
+        self.removed = {}
+        self.size = 0
+
+    def _move(self, source, target, into, out_of):
+        targets = out_of.get(source)
+        if targets and target in targets:
+            targets.remove(target)
+            self.size -= 1
+        targets = into.setdefault(source, set())
+        if target not in targets:
+            targets.add(target)
+            self.size += 1
+
+    def add(self, source, target):
+        self._move(source, target, self.added, self.removed)
+
+    def remove(self, source, target):
+        self._move(source, target, self.removed, self.added)
+
+    def apply(self, node, neighbours):
+        """`neighbours` (a node's sorted neighbours in the arrays) with the
+        node's changes applied."""
+
+        removed = self.removed.get(node)
+        if removed:
+            neighbours = np.setdiff1d(neighbours, np.fromiter(removed, np.int32), assume_unique=True)
+        added = self.added.get(node)
+        if added:
+            neighbours = np.union1d(neighbours, np.fromiter(added, np.int32))
+        return neighbours
+
+    def pairs(self, changes):
+        """`(sources, targets)` arrays of the edges in `changes`."""
+
+        edges = [(source, target) for source, targets in changes.items() for target in targets]
+        return np.array(edges, dtype=np.int32).reshape(-1, 2).T
+
+
+class FollowGraph:
+    """Both directions of the follow graph, plus the overlay of recent changes."""
+
+    def __init__(self, max_edges=MAX_EDGES, max_age=MAX_AGE):
+        self.max_edges = max_edges
+        self.max_age = max_age
+        self._following = None
+        self._followers = None
+        self._out = Overlay()
+        self._in = Overlay()
+        self._loaded_at = None
+        self._building = False
+        self._changes_while_building = []
+        self._generation = 0
+        self._lock = Lock()
+
+    def configure(self, max_edges, max_age):
+        self.max_edges = max_edges
+        self.max_age = max_age
+        self.reset()
+
+    def _load(self):
+        """`(followers, followed)` id arrays of every follow, or None if
+        there are more than max_edges of them."""
+
+        if db.session.scalar(select(func.count()).select_from(Follows)) > self.max_edges:
+            return None
+        return follow_edges()
+
+    def _build(self, followers, followed):
+        size = int(max(followers.max(initial=0), followed.max(initial=0))) + 1
+        self._following = Adjacency(followers, followed, size)
+        self._followers = Adjacency(followed, followers, size)
+        self._out = Overlay()
+        self._in = Overlay()
+
+    def _ensure_loaded(self):
+        """Whether the graph is available, starting a build if one is due
+        and none is running."""
+
+        with self._lock:
+            due = self._loaded_at is None or monotonic() - self._loaded_at > self.max_age
+            start = due and not self._building
+            if start:
+                self._building = True
+                generation = self._generation
+
+        if start:
+            if current_app.config.get('FOLLOW_GRAPH_BACKGROUND', True):
+                Thread(target=self._run, args=(current_app._get_current_object(), generation),
+                       name='follow-graph', daemon=True).start()
+            else:
+                self._rebuild(generation)
+
+        return self._following is not None
+
+    def _run(self, app, generation):
+        with app.app_context():
+            try:
+                self._rebuild(generation)
+            except Exception:
+                # Already logged; the next lookup starts another build.
+                pass
+
+    def _rebuild(self, generation):
+        """Load the follows table and swap the new graph in, unless reset()
+        was called since `generation` began."""
+
+        try:
+            edges = self._load()
+        except Exception:
+            logger.exception(json.dumps({'event': 'follow_graph_build_failed'}))
+            with self._lock:
+                if generation == self._generation:
+                    self._building = False
+                    self._changes_while_building = []
+            raise
+
+        with self._lock:
+            if generation != self._generation:
+                return
+
+            if edges is None:
+                self._following = self._followers = None
+                self._out = Overlay()
+                self._in = Overlay()
+            else:
+                self._build(*edges)
+                # The load may have missed these, and replaying one it saw is harmless.
+                for added, follower_id, followed_id in self._changes_while_building:
+                    self._apply(added, follower_id, followed_id)
+
+            self._building = False
+            self._changes_while_building = []
+            self._loaded_at = monotonic()
+
+    def _compact(self):
+        """Merge the overlay into new arrays. Call with the lock held."""
+
+        keys = pack(*self._following.edges())
+        if self._out.removed:
+            keys = keys[~np.isin(keys, pack(*self._out.pairs(self._out.removed)))]
+        if self._out.added:
+            keys = np.union1d(keys, pack(*self._out.pairs(self._out.added)))
+
+        self._build((keys >> 32).astype(np.int32), (keys & 0xFFFFFFFF).astype(np.int32))
+
+    def following(self, user_id):
+        """Sorted array of the ids `user_id` follows, or None if the graph
+        is unavailable."""
+
+        if not self._ensure_loaded():
+            return None
+        with self._lock:
+            if self._following is None:
+                return None
+            return self._out.apply(user_id, self._following.neighbours(user_id))
+
+    def followers(self, user_id):
+        """Sorted array of the ids following `user_id`, or None if the
+        graph is unavailable."""
+
+        if not self._ensure_loaded():
+            return None
+        with self._lock:
+            if self._followers is None:
+                return None
+            return self._in.apply(user_id, self._followers.neighbours(user_id))
+
+    def is_following(self, follower_id, followed_id):
+        following = self.following(follower_id)
+        if following is None:
+            return None
+        position = np.searchsorted(following, followed_id)
+        return bool(position < len(following) and following[position] == followed_id)
+
+    def followed_by_followed(self, viewer_id, user_id):
+        """Ids of the users `viewer_id` follows who follow `user_id`."""
+
+        following = self.following(viewer_id)
+        followers = self.followers(user_id)
+        if following is None or followers is None:
+            return None
+        return np.intersect1d(following, followers, assume_unique=True)
+
+    def _apply(self, added, follower_id, followed_id):
+        """Put one follow (`added`) or unfollow in the overlay. Call with
+        the lock held."""
+
+        if self._following is None:
+            return
+
+        if added:
+            self._out.add(follower_id, followed_id)
+            self._in.add(followed_id, follower_id)
+        else:
+            self._out.remove(follower_id, followed_id)
+            self._in.remove(followed_id, follower_id)
+        if self._out.size >= OVERLAY_MAX:
+            self._compact()
+
+    def _change(self, added, follower_id, followed_id):
+        with self._lock:
+            if self._building:
+                self._changes_while_building.append((added, follower_id, followed_id))
+            self._apply(added, follower_id, followed_id)
+
+    def add(self, follower_id, followed_id):
+        self._change(True, follower_id, followed_id)
+
+    def remove(self, follower_id, followed_id):
+        self._change(False, follower_id, followed_id)
+
+    def reset(self):
+        """Forget everything; the next lookup rebuilds from the database."""
+
+        with self._lock:
+            self._following = self._followers = None
+            self._out = Overlay()
+            self._in = Overlay()
+            self._loaded_at = None
+            self._building = False
+            self._changes_while_building = []
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            if self._following is None:
+                return {'loaded': False}
+            return {
+                'loaded': True,
+                'edges': len(self._following.indices),
+                'overlay': self._out.size,
+                'bytes': self._following.nbytes + self._followers.nbytes,
+            }
+
+
+follow_graph = FollowGraph()
+
+
+def apply_on_commit(follow, change):
+    """Queue `change` (follow_graph.add or .remove) until the session commits."""
+
+    object_session(follow).info.setdefault('follow_graph_pending', []).append(
+        (change, follow.user_following_id, follow.user_being_followed_id))
+
+
+@event.listens_for(Follows, 'after_insert')
+def graph_new_follow(mapper, connection, follow):
+    apply_on_commit(follow, follow_graph.add)
+
+
+@event.listens_for(Follows, 'after_delete')
+def graph_deleted_follow(mapper, connection, follow):
+    apply_on_commit(follow, follow_graph.remove)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_committed(session):
+    for change, follower_id, followed_id in session.info.pop('follow_graph_pending', ()):
+        change(follower_id, followed_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_rolled_back(session):
+    session.info.pop('follow_graph_pending', None)
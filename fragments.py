@@ -0,0 +1,133 @@
+"""Cache of rendered message cards.
+
+The timeline, profile and likes pages all render their messages with
+``templates/messages/_card.html``, through ``message_card()``. Rendered
+cards are kept in a bounded LRU keyed by
+
+    (message id, author's profile version, viewer's liked state)
+
+where the profile version is the author's version in ``user_cache``,
+bumped whenever their row (username, image) or counters change, and the
+liked state is None when the card has no like button (the viewer wrote
+the message or isn't logged in). Messages can't be edited, so nothing
+else on a card changes. A warm page is then mostly string concatenation.
+
+The like count is the exception: it changes far more often than the
+rest, so it's left out of the cached HTML and spliced in on every render.
+Like the user cache, entries expire after a TTL, since profile edits
+made by other processes don't bump this process's versions.
+
+Every STATS_INTERVAL lookups the cache logs ``stats()`` (size, hits,
+misses and hit rate) as a JSON line on the ``warbler.fragments`` logger.
+"""
+
+import json
+import logging
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from flask import g, render_template
+from markupsafe import Markup
+
+from likecounts import like_counter
+from usercache import user_cache
+
+logger = logging.getLogger('warbler.fragments')
+
+# Defaults for the FRAGMENT_CACHE_TTL and FRAGMENT_CACHE_SIZE config keys.
+DEFAULT_TTL = 300
+DEFAULT_SIZE = 20000
+
+# Log stats() after this many lookups.
+STATS_INTERVAL = 10000
+
+# Marks where the like count goes in a rendered card.
+LIKE_COUNT_SLOT = Markup('<!--like-count-->')
+
+LIKE_COUNT_HTML = Markup('<span class="text-muted ml-2"><i class="fa fa-thumbs-up"></i> {}</span>')
+
+
+class FragmentCache:
+    """TTL'd LRU of rendered HTML fragments, with hit/miss counts."""
+
+    def __init__(self, ttl=DEFAULT_TTL, size=DEFAULT_SIZE, stats_interval=STATS_INTERVAL):
+        self.ttl = ttl
+        self.size = size
+        self.stats_interval = stats_interval
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def configure(self, ttl, size):
+        with self._lock:
+            self.ttl = ttl
+            self.size = size
+            self._entries.clear()
+
+    def get(self, key):
+        """The fragment stored under `key`, or None."""
+
+        fragment = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if monotonic() - entry[1] < self.ttl:
+                    fragment = entry[0]
+                    self._entries.move_to_end(key)
+                else:
+                    del self._entries[key]
+
+            if fragment is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            due = (self.hits + self.misses) % self.stats_interval == 0
+
+        if due:
+            logger.info(json.dumps({'event': 'fragment_cache_stats', **self.stats()}))
+
+        return fragment
+
+    def put(self, key, fragment):
+        with self._lock:
+            self._entries[key] = (fragment, monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+fragment_cache = FragmentCache()
+
+
+def message_card(message, likes):
+    """Render `message`'s card for the current viewer, who has liked the
+    ids in `likes` (at least those on the page)."""
+
+    viewer = g.get('user')
+    liked = None if viewer is None or message.user_id == viewer.id else message.id in likes
+
+    key = (message.id, user_cache.version(message.user_id), liked)
+    parts = fragment_cache.get(key)
+    if parts is None:
+        html = render_template('messages/_card.html', msg=message, liked=liked, like_count=LIKE_COUNT_SLOT)
+        parts = tuple(html.split(LIKE_COUNT_SLOT, 1))
+        fragment_cache.put(key, parts)
+
+    count = like_counter.count(message)
+    return Markup(parts[0] + (LIKE_COUNT_HTML.format(count) if count else '') + parts[1])
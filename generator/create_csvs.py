@@ -3,14 +3,29 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Runs offline and is deterministic: the same --seed and sizes always
+produce the same files. Rows are sampled with NumPy and written in
+chunks of CHUNK_SIZE, so memory doesn't grow with the row counts
+(follows aside: their pairs are deduplicated in memory, about 16 bytes
+per follow). The data is skewed the way real traffic is:
+
+- who posts follows a Zipf distribution (a few users post most messages),
+- who gets followed does too (a few users have most followers),
+- timestamps get denser toward --end.
+
+    python generator/create_csvs.py
+    python generator/create_csvs.py --users 1000000 --messages 100000000 --follows 50000000 --out /data/warbler
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+
+import numpy as np
+
+from helpers import (PROFILE_IMAGE_URLS, CITIES, recent_timestamps, sample_cdf, sentences,
+                     zipf_cdf, WORDS)
 
 MAX_WARBLER_LENGTH = 140
 
@@ -20,58 +35,139 @@ FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
-
-fake = Faker()
-
-# Generate random profile image URLs to use for users
-
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
-
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+NUM_FOLLOWS = 5000
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
+# Every seeded user's password is "password"; User.authenticate() rehashes
+# it at the configured cost on first login.
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
+HEADER_IMAGE_URL = '/static/images/warbler-hero.jpg'
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
+# Rows sampled and written per chunk. Changing it changes the output for a seed.
+CHUNK_SIZE = 100000
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
+# Distinct sentences that bios and message texts are drawn from.
+SENTENCE_POOL_SIZE = 10000
 
-# Generate follows.csv from random pairings of users
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+def chunk_sizes(total):
+    for start in range(0, total, CHUNK_SIZE):
+        yield min(CHUNK_SIZE, total - start)
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+def write_users(path, count, rng):
+    words = np.array(WORDS)
+    bios = sentences(rng, SENTENCE_POOL_SIZE, 4, 12, MAX_WARBLER_LENGTH)
+    images = np.array(PROFILE_IMAGE_URLS)
+    cities = np.array(CITIES)
+
+    with open(path, 'w', newline='') as users_csv:
+        writer = csv.writer(users_csv)
+        writer.writerow(USERS_CSV_HEADERS)
+
+        first_id = 1
+        for size in chunk_sizes(count):
+            # The id suffix keeps usernames (and so emails) unique.
+            ids = np.arange(first_id, first_id + size).astype(str)
+            usernames = np.char.add(np.char.add(words[rng.integers(len(words), size=size)], '_'),
+                                    np.char.add(words[rng.integers(len(words), size=size)], ids))
+            emails = np.char.add(usernames, '@example.com')
+
+            writer.writerows(zip(
+                emails,
+                usernames,
+                images[rng.integers(len(images), size=size)],
+                [PASSWORD_HASH] * size,
+                bios[rng.integers(len(bios), size=size)],
+                [HEADER_IMAGE_URL] * size,
+                cities[rng.integers(len(cities), size=size)],
+            ))
+            first_id += size
+
+
+def write_messages(path, count, num_users, rng, args):
+    texts = sentences(rng, SENTENCE_POOL_SIZE, 5, 30, MAX_WARBLER_LENGTH)
+    authors = zipf_cdf(num_users, args.author_skew, rng)
+
+    with open(path, 'w', newline='') as messages_csv:
+        writer = csv.writer(messages_csv)
+        writer.writerow(MESSAGES_CSV_HEADERS)
+
+        for size in chunk_sizes(count):
+            writer.writerows(zip(
+                texts[rng.integers(len(texts), size=size)],
+                recent_timestamps(rng, size, args.end, args.years, args.recency_skew),
+                sample_cdf(rng, authors, size),
+            ))
+
+
+def sample_follows(count, num_users, rng, skew):
+    """`count` distinct (followed, follower) pairs, no self-follows.
+
+    Pairs are packed into one int64 each so duplicates can be dropped
+    with np.unique, and sampling repeats until there are enough.
+    """
+
+    if count > num_users * (num_users - 1):
+        raise ValueError(f"{num_users} users can't have {count} distinct follows")
+
+    popularity = zipf_cdf(num_users, skew, rng)
+    pairs = np.empty(0, dtype=np.int64)
+
+    while len(pairs) < count:
+        size = int((count - len(pairs)) * 1.2) + 1000
+        followed = sample_cdf(rng, popularity, size).astype(np.int64)
+        follower = rng.integers(1, num_users + 1, size=size, dtype=np.int64)
+        batch = (followed * (num_users + 1) + follower)[followed != follower]
+
+        before = len(pairs)
+        pairs = np.union1d(pairs, batch)
+        if len(pairs) - before < size // 100:
+            raise ValueError(f"--follow-skew {skew} is too steep for {count} follows among "
+                             f"{num_users} users; lower it or ask for fewer follows")
+
+    # union1d sorts; shuffle so truncating doesn't favour low ids.
+    pairs = rng.permutation(pairs)[:count]
+    return np.divmod(pairs, num_users + 1)
+
+
+def write_follows(path, count, num_users, rng, args):
+    followed, follower = sample_follows(count, num_users, rng, args.follow_skew)
+
+    with open(path, 'w', newline='') as follows_csv:
+        writer = csv.writer(follows_csv)
+        writer.writerow(FOLLOWS_CSV_HEADERS)
+
+        for start in range(0, count, CHUNK_SIZE):
+            writer.writerows(zip(followed[start:start + CHUNK_SIZE], follower[start:start + CHUNK_SIZE]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate random Warbler users, messages and follows.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=os.path.dirname(os.path.abspath(__file__)),
+                        help="directory to write the CSV files to")
+    parser.add_argument('--end', default='2023-07-01', help="newest possible message timestamp")
+    parser.add_argument('--years', type=float, default=2, help="how far back messages go")
+    parser.add_argument('--author-skew', type=float, default=1.0,
+                        help="Zipf exponent for who posts (0 is uniform)")
+    parser.add_argument('--follow-skew', type=float, default=0.8,
+                        help="Zipf exponent for who gets followed (0 is uniform)")
+    parser.add_argument('--recency-skew', type=float, default=3.0,
+                        help="how strongly timestamps cluster near --end (1 is uniform)")
+    args = parser.parse_args()
+
+    # One stream per file, so changing one size doesn't reshuffle the others.
+    users_rng, messages_rng, follows_rng = (
+        np.random.default_rng(seed) for seed in np.random.SeedSequence(args.seed).spawn(3))
+
+    write_users(os.path.join(args.out, 'users.csv'), args.users, users_rng)
+    write_messages(os.path.join(args.out, 'messages.csv'), args.messages, args.users, messages_rng, args)
+    write_follows(os.path.join(args.out, 'follows.csv'), args.follows, args.users, follows_rng, args)
+
+
+if __name__ == '__main__':
+    main()
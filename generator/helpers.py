@@ -1,14 +1,102 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+The samplers draw whole NumPy arrays at once. Text comes from a small
+pool built by sentences(), which rows then index into.
+"""
 
+import numpy as np
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+WORDS = """
+able across act add after again against age ago agree air all almost alone along already also always
+among animal answer any appear area arm around art ask attack away back bad bag ball bank bar base
+beat beautiful become bed before begin behind believe best better between big bird bit black blood
+blue board boat body book born both box boy break bring brother build building business buy call
+camera campaign car card care carry case cat catch cause cell center chair chance change charge check
+child choice choose city claim class clear close coach coffee cold color come common company cost
+could country couple course cover create crime cup cut dark data daughter day dead deal decade decide
+deep degree design detail dinner direction dog door down draw dream drive drop during early east easy
+eat edge effect eight either else end energy enjoy enough enter even evening event ever every exactly
+example experience eye face fact fall family far fast father fear feel few field fight fill film final
+find fine finish fire firm first fish five floor fly focus follow food foot force forget form forward
+four free friend front full fund game garden gas general get girl give glass goal good great green
+ground group grow guess gun hair half hand hang happen happy hard head health hear heart heat heavy
+help here high history hit hold home hope hot hotel hour house huge idea image imagine impact inside
+island issue item job join just keep key kid kind kitchen know land language large last late laugh
+law lead learn leave left leg less letter level lie life light like line list listen little live
+local long look lose lot love low machine main major make man many map market matter may meet member
+memory mention message middle might mind minute miss model modern moment money month moon morning
+mother mountain move movie much music name nation nature near need network never new news next nice
+night none north note nothing notice now number ocean off offer office often oil old once only open
+order other out over own page paint paper park part party pass past pay peace people perfect person
+phone pick picture piece place plan plant play point police pool poor popular power present pretty
+price print problem program project pull push put question quick quite radio rain raise range rate
+reach read ready real reason record red remain remember report rest result return rich ride right
+rise river road rock room rule run safe same save say scene school science sea season seat second
+see sell send sense serve set seven shake share ship shoot short show side sign simple sing sister
+sit six size skill skin sky sleep small smile snow social soft song soon sort sound south space speak
+special spend sport spring stage stand star start state stay step still stock stone stop store story
+street strong student study style success summer sun support sure table take talk team tell ten test
+thank thing think third three through time today together tonight total tough town trade travel tree
+trip true truth try turn two type under unit until up use usually value very view visit voice wait
+walk wall want war watch water way wear week weight west whole wide wife win wind window winter wish
+within without woman wonder word work world write wrong yard year yes yet young
+""".split()
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+CITIES = """
+Aberdeen Albany Ashford Bayview Bellmont Brookfield Carlisle Cedarville Clayton Dover Easton
+Fairview Franklin Georgetown Glendale Greenville Hamilton Harbor Hudson Kingston Lakeside Lexington
+Madison Marion Milford Newport Oakland Oxford Riverside Salem Springfield Sunnyvale Troy Union
+Westfield Winchester
+""".split()
 
-    return datetime.fromtimestamp(random_timestamp)
+PROFILE_IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
+
+
+def zipf_cdf(count, exponent, rng):
+    """Cumulative weights over `count` items with Zipf-distributed
+    popularity (weight 1/rank**exponent), ranks shuffled so popularity
+    isn't tied to id order."""
+
+    weights = 1.0 / np.arange(1, count + 1) ** exponent
+    rng.shuffle(weights)
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def sample_cdf(rng, cdf, size):
+    """Sample 1-based ids from a cumulative weight array."""
+
+    return np.minimum(np.searchsorted(cdf, rng.random(size), side='right'), len(cdf) - 1) + 1
+
+
+def sentences(rng, count, min_words, max_words, max_length):
+    """`count` random sentences of WORDS, each at most `max_length` characters."""
+
+    words = np.array(WORDS)
+    lengths = rng.integers(min_words, max_words + 1, size=count)
+    picks = words[rng.integers(len(words), size=lengths.sum())]
+
+    result = []
+    start = 0
+    for length in lengths:
+        result.append((" ".join(picks[start:start + length]).capitalize() + ".")[:max_length])
+        start += length
+    return np.array(result)
+
+
+def recent_timestamps(rng, size, end, years, skew):
+    """Timestamps over the `years` years before `end`, denser toward `end`.
+
+    Ages follow a power distribution: `skew` 1 is uniform, larger values
+    pack more of them into recent months.
+    """
+
+    span = years * 365.25 * 24 * 3600
+    start = np.datetime64(end, 'us') - np.timedelta64(int(span), 's')
+    offsets = (rng.power(skew, size) * span * 1e6).astype('timedelta64[us]')
+
+    return np.char.replace((start + offsets).astype(str), 'T', ' ')
@@ -0,0 +1,206 @@
+"""Bounded worker pool for password hashing.
+
+A bcrypt check takes a few hundred milliseconds of CPU. Run inline, a
+burst of logins occupies every request thread at once and ordinary page
+views queue up behind them. Instead, ``User.signup()`` and
+``User.authenticate()`` hand their bcrypt calls to this pool:
+
+- at most HASHING_WORKERS hashes run at once (bcrypt releases the GIL,
+  so a thread pool gets real parallelism),
+- at most HASHING_QUEUE_DEPTH more may wait for a worker,
+- anything beyond that fails immediately with HashingPoolSaturated,
+  which the app turns into a 503 with Retry-After instead of letting
+  logins starve the rest of the site.
+
+The pool keeps latency samples (time queued and time hashing) and logs
+``stats()`` as a JSON line on the ``warbler.hashing`` logger every
+STATS_INTERVAL hashes and on every rejection. Responses that hashed also
+get a ``Server-Timing: bcrypt`` entry.
+
+``calibrate_log_rounds()`` picks the bcrypt cost (BCRYPT_LOG_ROUNDS) for
+the hardware it runs on; ``User.authenticate()`` rehashes passwords whose
+stored cost doesn't match the configured one.
+"""
+
+import json
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from statistics import median
+from time import perf_counter
+
+from bcrypt import gensalt, hashpw
+from flask import g, has_request_context
+
+logger = logging.getLogger('warbler.hashing')
+
+# How many recent latency samples stats() summarizes.
+SAMPLE_SIZE = 1024
+
+# Log stats() after this many completed hashes.
+STATS_INTERVAL = 100
+
+# Default for the BCRYPT_LOG_ROUNDS config key (Flask-Bcrypt's default),
+# and the range calibrate_log_rounds() searches.
+DEFAULT_LOG_ROUNDS = 12
+MIN_LOG_ROUNDS = 10
+MAX_LOG_ROUNDS = 16
+
+
+class HashingPoolSaturated(Exception):
+    """Every hashing worker is busy and the wait queue is full."""
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of `samples` (0 for no samples)."""
+
+    if not samples:
+        return 0.0
+
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def hash_log_rounds(hashed):
+    """The cost a bcrypt hash was made with (the 12 in `$2b$12$...`)."""
+
+    return int(hashed.split('$')[2])
+
+
+def time_hash(log_rounds, samples=3):
+    """Median milliseconds to hash a password at cost `log_rounds`."""
+
+    timings = []
+    for _ in range(samples):
+        started = perf_counter()
+        hashpw(b'calibration password', gensalt(log_rounds))
+        timings.append((perf_counter() - started) * 1000)
+
+    return median(timings)
+
+
+def calibrate_log_rounds(target_ms, min_rounds=MIN_LOG_ROUNDS, max_rounds=MAX_LOG_ROUNDS, samples=3):
+    """Find the highest bcrypt cost that hashes within `target_ms` here.
+
+    Each extra round doubles the work, so the search stops at the first
+    cost over the target. Never goes below `min_rounds`. Returns
+    `(log_rounds, {log_rounds: median ms})` for every cost timed.
+    """
+
+    timings = {}
+    chosen = min_rounds
+
+    for log_rounds in range(min_rounds, max_rounds + 1):
+        timings[log_rounds] = time_hash(log_rounds, samples)
+        if timings[log_rounds] > target_ms:
+            break
+        chosen = log_rounds
+
+    return chosen, timings
+
+
+class HashingPool:
+    """Fixed-size thread pool with a bounded wait queue for bcrypt calls."""
+
+    def __init__(self, workers=None, queue_depth=None, stats_interval=STATS_INTERVAL):
+        self.stats_interval = stats_interval
+        self._lock = Lock()
+        self._executor = None
+        self.configure(workers, queue_depth)
+
+    def configure(self, workers=None, queue_depth=None):
+        """(Re)size the pool. Work already submitted finishes on the old pool."""
+
+        workers = workers or os.cpu_count() or 1
+        queue_depth = queue_depth if queue_depth is not None else 4 * workers
+
+        with self._lock:
+            old_executor = self._executor
+            self.workers = workers
+            self.queue_depth = queue_depth
+            self._slots = BoundedSemaphore(workers + queue_depth)
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+            self.completed = 0
+            self.rejected = 0
+            self._waits = deque(maxlen=SAMPLE_SIZE)
+            self._hashes = deque(maxlen=SAMPLE_SIZE)
+
+        if old_executor is not None:
+            old_executor.shutdown(wait=False)
+
+    def run(self, fn, *args):
+        """Run `fn(*args)` on a hashing worker and return its result.
+
+        Raises HashingPoolSaturated without waiting if there's no room.
+        """
+
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            self.log_stats(logging.WARNING, 'hashing_saturated')
+            raise HashingPoolSaturated()
+
+        submitted = perf_counter()
+
+        def timed():
+            started = perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                finished = perf_counter()
+                with self._lock:
+                    self.completed += 1
+                    self._waits.append(started - submitted)
+                    self._hashes.append(finished - started)
+                    due = self.completed % self.stats_interval == 0
+                if due:
+                    self.log_stats(logging.INFO, 'hashing_stats')
+
+        try:
+            result = self._executor.submit(timed).result()
+        finally:
+            slots.release()
+
+        if has_request_context():
+            g.hashing_ms = g.get('hashing_ms', 0.0) + (perf_counter() - submitted) * 1000
+
+        return result
+
+    def stats(self):
+        """Counters and latency percentiles (milliseconds) for recent hashes."""
+
+        with self._lock:
+            waits = list(self._waits)
+            hashes = list(self._hashes)
+            stats = {
+                'workers': self.workers,
+                'queue_depth': self.queue_depth,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+        for name, samples in (('wait', waits), ('hash', hashes)):
+            for label, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+                stats[f'{name}_{label}_ms'] = round(percentile(samples, fraction) * 1000, 3)
+
+        return stats
+
+    def log_stats(self, level, event):
+        logger.log(level, json.dumps({'event': event, **self.stats()}))
+
+    def init_app(self, app):
+        """Size the pool from app config and report hash time per response."""
+
+        self.configure(app.config.get('HASHING_WORKERS'), app.config.get('HASHING_QUEUE_DEPTH'))
+
+        @app.after_request
+        def add_hashing_timing(response):
+            if 'hashing_ms' in g:
+                response.headers.add('Server-Timing', f"bcrypt;dur={g.hashing_ms:.2f}")
+            return response
+
+
+hashing_pool = HashingPool()
@@ -0,0 +1,169 @@
+"""Write-behind aggregation of Message.like_count.
+
+Incrementing ``messages.like_count`` in the same transaction as each
+like would make every like on a hot post queue for that one row's lock.
+Instead, committed likes and unlikes only add +1/-1 to an in-process
+tally, and a background thread flushes the tally every
+LIKE_COUNT_FLUSH_INTERVAL seconds: one ``UPDATE ... SET like_count =
+like_count + :delta`` per message that changed, in one executemany and
+one short transaction. A thousand likes on one post between flushes
+become a single +1000.
+
+Counts trail the likes table by up to a flush interval, and a process
+that dies loses its unflushed tally; ``flask reconcile-counters``
+recomputes them from the likes table. Bulk deletes of likes skip the
+listeners below and adjust the counts themselves (see purge.py).
+"""
+
+import atexit
+import json
+import logging
+from collections import Counter
+from threading import Event, Lock, Thread
+
+from sqlalchemy import bindparam, event, update
+from sqlalchemy.orm import Session, object_session
+
+from models import db, Likes, Message
+
+logger = logging.getLogger('warbler.likecounts')
+
+# Default for the LIKE_COUNT_FLUSH_INTERVAL config key (seconds).
+FLUSH_INTERVAL = 2
+
+
+class LikeCounter:
+    """In-memory like-count deltas by message id, flushed in batches."""
+
+    def __init__(self, interval=FLUSH_INTERVAL):
+        self.interval = interval
+        self.flushes = 0
+        # Bumped by every committed like and unlike in this process.
+        self.version = 0
+        self.flushed_deltas = 0
+        self._pending = Counter()
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._app = None
+        self._thread = None
+        self._stop = Event()
+
+    def init_app(self, app):
+        self._app = app
+        self.interval = app.config.get('LIKE_COUNT_FLUSH_INTERVAL', FLUSH_INTERVAL)
+
+    def add(self, message_id, delta):
+        with self._lock:
+            self._pending[message_id] += delta
+            self.version += 1
+            if self._thread is None and self._app is not None:
+                self._thread = Thread(target=self._run, name='like-counts', daemon=True)
+                self._thread.start()
+
+    def pending(self, message_id):
+        """Delta not yet written for `message_id`."""
+
+        with self._lock:
+            return self._pending.get(message_id, 0)
+
+    def count(self, message):
+        """`message.like_count` plus this process's unflushed delta for it."""
+
+        return message.like_count + self.pending(message.id)
+
+    def flush(self):
+        """Write the pending deltas. Returns how many messages were updated.
+
+        Flushes run one at a time, so when this returns, everything
+        tallied before it was called has been written (or re-queued).
+        """
+
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+
+        deltas = [{'message_id': message_id, 'delta': delta}
+                  for message_id, delta in pending.items() if delta]
+        if not deltas:
+            return 0
+
+        try:
+            db.session.execute(update(Message.__table__)
+                               .where(Message.id == bindparam('message_id'))
+                               .values(like_count=Message.like_count + bindparam('delta')),
+                               deltas)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # Keep the tally for the next flush rather than losing it.
+            with self._lock:
+                self._pending.update(pending)
+            raise
+
+        self.flushes += 1
+        self.flushed_deltas += len(deltas)
+        return len(deltas)
+
+    def reset(self):
+        """Drop the unflushed tally without writing it."""
+
+        with self._lock:
+            self._pending = Counter()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'flushes': self.flushes,
+                'flushed_deltas': self.flushed_deltas,
+            }
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._flush_in_context()
+
+    def _flush_in_context(self):
+        with self._app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                logger.exception(json.dumps({'event': 'like_count_flush_failed', **self.stats()}))
+
+    def shutdown(self):
+        """Stop the flush thread and write whatever is left."""
+
+        self._stop.set()
+        if self._app is not None:
+            self._flush_in_context()
+
+
+like_counter = LikeCounter()
+atexit.register(like_counter.shutdown)
+
+
+def count_on_commit(like, delta):
+    object_session(like).info.setdefault('like_count_pending', []).append((like.message_id, delta))
+
+
+@event.listens_for(Likes, 'after_insert')
+def count_new_like(mapper, connection, like):
+    count_on_commit(like, 1)
+
+
+@event.listens_for(Likes, 'after_delete')
+def count_deleted_like(mapper, connection, like):
+    count_on_commit(like, -1)
+
+
+@event.listens_for(Session, 'after_commit')
+def tally_committed(session):
+    for message_id, delta in session.info.pop('like_count_pending', ()):
+        like_counter.add(message_id, delta)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_rolled_back(session):
+    session.info.pop('like_count_pending', None)
@@ -2,13 +2,29 @@
 
 from datetime import datetime
 
+from flask import current_app
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, case, event, exists, func, or_, select, update
+from sqlalchemy.orm import contains_eager, joinedload
+
+from hashing import DEFAULT_LOG_ROUNDS, hash_log_rounds, hashing_pool
+from pagination import before_cursor
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
+def password_log_rounds():
+    """bcrypt cost for new password hashes (the BCRYPT_LOG_ROUNDS config key)."""
+
+    return current_app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+
+
+# Most ids bound into one IN list by Follows.followed_among().
+FOLLOWED_AMONG_CHUNK = 1000
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -26,6 +42,47 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key serves "who follows X"; this serves "who does X follow".
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id', 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def exists_between(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? One EXISTS probe of
+        the primary key."""
+
+        return db.session.scalar(select(exists()
+                                        .where(cls.user_being_followed_id == followed_id)
+                                        .where(cls.user_following_id == follower_id)))
+
+    @classmethod
+    def followed_ids(cls, follower_id):
+        """Ids of everyone `follower_id` follows, off the follower index."""
+
+        return db.session.scalars(select(cls.user_being_followed_id)
+                                  .where(cls.user_following_id == follower_id)
+                                  .order_by(cls.user_being_followed_id)).all()
+
+    @classmethod
+    def followed_among(cls, follower_id, user_ids):
+        """Return the set of `user_ids` that `follower_id` follows.
+
+        One query per FOLLOWED_AMONG_CHUNK ids off the follower index, for
+        marking follow buttons on user lists.
+        """
+
+        user_ids = list(user_ids)
+        followed = set()
+
+        for start in range(0, len(user_ids), FOLLOWED_AMONG_CHUNK):
+            followed.update(db.session.scalars(
+                select(cls.user_being_followed_id)
+                .where(cls.user_following_id == follower_id)
+                .where(cls.user_being_followed_id.in_(user_ids[start:start + FOLLOWED_AMONG_CHUNK]))))
+
+        return followed
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -45,7 +102,76 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+    )
+
+    # One like per user per message. Also serves both "everything X liked"
+    # and the (user, message) lookup. The message_id index serves the
+    # cascade when a message is deleted and counting a message's likes.
+    __table_args__ = (
+        db.Index('ix_likes_user_id_message_id', 'user_id', 'message_id', unique=True),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def liked_message_ids(cls, user_id, message_ids):
+        """Return the set of `message_ids` that `user_id` has liked.
+
+        One query restricted to the messages on the page, for marking
+        liked state on message lists.
+        """
+
+        if not user_id or not message_ids:
+            return set()
+
+        return set(db.session.scalars(
+            select(cls.message_id)
+            .where(cls.user_id == user_id)
+            .where(cls.message_id.in_(message_ids))))
+
+    @classmethod
+    def count_by(cls, user_id):
+        """How many messages `user_id` has liked, counted in the database."""
+
+        return db.session.scalar(select(func.count()).select_from(cls).where(cls.user_id == user_id))
+
+
+class TimelineEntry(db.Model):
+    """A message materialized onto a user's home timeline."""
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    # Reading a timeline and unfollowing use the user_id indexes. Deleting a
+    # message (and the messages foreign key cascade) uses message_id. Taking
+    # a new celebrity off every timeline (and the author foreign key
+    # cascade) uses author_id.
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp', 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_timelines_user_id_author_id', 'user_id', 'author_id'),
+        db.Index('ix_timelines_message_id', 'message_id'),
+        db.Index('ix_timelines_author_id', 'author_id'),
     )
 
 
@@ -94,20 +220,54 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts for the stats on the home page and profiles.
+    # Kept current by the listeners at the bottom of this module; use
+    # User.reconcile_counts() to repair drift.
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set when the user deletes their account. The account is gone as far
+    # as the site is concerned; purge.py deletes its rows afterwards.
+    deactivated_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message')
 
+    # Deactivated accounts drop out of both lists straight away, though
+    # their follows stay until the account is purged.
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id) & deactivated_at.is_(None),
+        viewonly=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id) & deactivated_at.is_(None),
+        viewonly=True,
     )
 
     likes = db.relationship(
@@ -121,14 +281,12 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists_between(other_user.id, self.id)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists_between(self.id, other_user.id)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -146,7 +304,9 @@ class User(db.Model):
         if possible_user:
             return False
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        # Hashing runs on the bounded pool in hashing.py; raises
+        # HashingPoolSaturated if it's full.
+        hashed_pwd = cls.hash_password(password)
 
         user = User(
             username=username,
@@ -169,15 +329,75 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deactivated_at=None).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hashing_pool.run(bcrypt.check_password_hash, user.password, password)
             if is_auth:
+                # Move the stored hash to the configured cost while we
+                # have the plaintext.
+                if hash_log_rounds(user.password) != password_log_rounds():
+                    user.password = cls.hash_password(password)
+                    db.session.commit()
+                    # Callers read the user after their session closes.
+                    db.session.refresh(user)
                 return user
 
         return False
+
+    @staticmethod
+    def hash_password(password):
+        """Hash `password` at the configured cost, on the hashing pool."""
+
+        return hashing_pool.run(bcrypt.generate_password_hash, password, password_log_rounds()).decode('UTF-8')
     
+    @classmethod
+    def search(cls, term, limit=50):
+        """Find users whose username contains `term`, most relevant first.
+
+        Exact matches come first, then usernames starting with `term`,
+        then the rest; deactivated accounts are left out. On Postgres the match runs off the pg_trgm GIN
+        index (see USERNAME_SEARCH_DDL) and the rest are ranked by
+        trigram similarity. Elsewhere prefixes are read as a range off
+        the unique username index and only the remainder of the page
+        falls back to a scanning LIKE.
+        """
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            return (cls.query
+                    .filter(cls.username.icontains(term, autoescape=True))
+                    .filter(cls.deactivated_at.is_(None))
+                    .order_by(case((func.lower(cls.username) == term.lower(), 0),
+                                   (cls.username.istartswith(term, autoescape=True), 1),
+                                   else_=2),
+                              func.similarity(cls.username, term).desc(),
+                              cls.username)
+                    .limit(limit)
+                    .all())
+
+        prefixed = (cls.query
+                    .filter(cls.username >= term)
+                    .filter(cls.username < term + '\uffff')
+                    .filter(cls.deactivated_at.is_(None))
+                    .order_by(func.length(cls.username), cls.username)
+                    .limit(limit)
+                    .all())
+
+        if len(prefixed) == limit:
+            return prefixed
+
+        found = [user.id for user in prefixed]
+        containing = (cls.query
+                      .filter(cls.username.icontains(term, autoescape=True))
+                      .filter(cls.id.not_in(found))
+                      .filter(cls.deactivated_at.is_(None))
+                      .order_by(case((cls.username.istartswith(term, autoescape=True), 0), else_=1),
+                                cls.username)
+                      .limit(limit - len(prefixed))
+                      .all())
+
+        return prefixed + containing
+
     @classmethod
     def update_user(cls, user_id, username, email, image_url, header_image_url, bio):
         """Updates the user instance based on information provided (uses app.app_context in app).
@@ -202,6 +422,79 @@ class User(db.Model):
         
         db.session.commit()
 
+    @classmethod
+    def deactivate(cls, user_id):
+        """Deactivate `user_id` and queue their rows for purging.
+
+        Cheap enough for a request: one UPDATE and one INSERT. The rows
+        themselves are deleted later by purge.purge_account().
+        """
+
+        user = db.session.get(cls, user_id)
+        user.deactivated_at = datetime.utcnow()
+        db.session.add(AccountPurge(user_id=user_id, requested_at=user.deactivated_at))
+        db.session.commit()
+
+    @classmethod
+    def release_follow_counts(cls, user_id):
+        """Decrement the counts of everyone `user_id` follows or is followed by.
+
+        For bulk deletes of a user's follows, which skip the listeners
+        below. Call it before the follows are deleted, in the same
+        transaction.
+        """
+
+        followed_ids = select(Follows.user_being_followed_id).where(Follows.user_following_id == user_id)
+        follower_ids = select(Follows.user_following_id).where(Follows.user_being_followed_id == user_id)
+
+        db.session.execute(update(cls)
+                           .where(cls.id.in_(followed_ids))
+                           .values(followers_count=cls.followers_count - 1))
+        db.session.execute(update(cls)
+                           .where(cls.id.in_(follower_ids))
+                           .values(following_count=cls.following_count - 1))
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every user's counters from the source tables in one
+        statement. Returns the number of users whose counts had drifted."""
+
+        messages = (select(func.count(Message.id))
+                    .where(Message.user_id == cls.id)
+                    .scalar_subquery())
+        following = (select(func.count())
+                     .select_from(Follows)
+                     .where(Follows.user_following_id == cls.id)
+                     .scalar_subquery())
+        followers = (select(func.count())
+                     .select_from(Follows)
+                     .where(Follows.user_being_followed_id == cls.id)
+                     .scalar_subquery())
+
+        result = db.session.execute(
+            update(cls)
+            .where(or_(cls.messages_count != messages,
+                       cls.following_count != following,
+                       cls.followers_count != followers))
+            .values(messages_count=messages,
+                    following_count=following,
+                    followers_count=followers)
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+
+        return result.rowcount
+
+
+# Trigram index backing User.search() on Postgres. Other databases use the
+# unique index on username. schema.upgrade_schema() runs these too.
+USERNAME_SEARCH_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users USING gin (username gin_trgm_ops)",
+]
+
+for statement in USERNAME_SEARCH_DDL:
+    event.listen(User.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -221,7 +514,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -230,8 +523,258 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # A user's messages, newest first: profiles, keyset pages, backfills.
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+    # Likes on this message. Maintained asynchronously by likecounts.py, so
+    # it can trail the likes table by a flush interval; use
+    # Message.reconcile_like_counts() to repair drift.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    @classmethod
+    def reconcile_like_counts(cls):
+        """Recompute every message's like count from the likes table in one
+        statement. Returns the number of messages whose count had drifted."""
+
+        likes = (select(func.count())
+                 .select_from(Likes)
+                 .where(Likes.message_id == cls.id)
+                 .scalar_subquery())
+
+        result = db.session.execute(
+            update(cls)
+            .where(cls.like_count != likes)
+            .values(like_count=likes)
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+
+        return result.rowcount
+
+    @classmethod
+    def with_authors(cls):
+        """Base query for message lists.
+
+        Authors are joined in up front, so a template touching `msg.user`
+        doesn't issue one SELECT per message.
+        """
+
+        return cls.query.options(joinedload(cls.user))
+
+    @classmethod
+    def shown(cls, message_id):
+        """Message `message_id` with its author, or None if it's gone or
+        its author is deactivated."""
+
+        return (cls.query
+                .join(cls.user)
+                .options(contains_eager(cls.user))
+                .filter(cls.id == message_id)
+                .filter(User.deactivated_at.is_(None))
+                .first())
+
+    @classmethod
+    def posted_by(cls, user_id, limit, before=None):
+        """Messages posted by `user_id`, newest first, older than the
+        optional `(timestamp, id)` cursor `before`."""
+
+        return (cls
+                .with_authors()
+                .filter(cls.user_id == user_id)
+                .filter(before_cursor(cls.timestamp, cls.id, before))
+                .order_by(cls.timestamp.desc(), cls.id.desc())
+                .limit(limit)
+                .all())
+
+    @classmethod
+    def liked_by(cls, user_id, limit, before=None):
+        """Messages liked by `user_id`, newest first, older than the
+        optional `(timestamp, id)` cursor `before`."""
+
+        return (cls
+                .with_authors()
+                .join(Likes, Likes.message_id == cls.id)
+                .filter(Likes.user_id == user_id)
+                .filter(before_cursor(cls.timestamp, cls.id, before))
+                .order_by(cls.timestamp.desc(), cls.id.desc())
+                .limit(limit)
+                .all())
+
+
+class AccountPurge(db.Model):
+    """Progress of purging a deactivated account (see purge.py)."""
+
+    __tablename__ = 'account_purges'
+
+    # Not a foreign key: the row outlives the user it records.
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    follows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    likes_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    messages_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    def __repr__(self):
+        return f"<AccountPurge #{self.user_id}: {'done' if self.finished_at else 'pending'}>"
+
+
+class LoginFailure(db.Model):
+    """A failed login, for throttling shared by every process (see throttle.py)."""
+
+    __tablename__ = 'login_failures'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # 'user:<lowercased username>' or 'ip:<address>'.
+    key = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # Unix time, as the throttle counts it.
+    failed_at = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # Every read is one key's failures in time order; expiry scans by time.
+    __table_args__ = (
+        db.Index('ix_login_failures_key_failed_at', 'key', 'failed_at'),
+        db.Index('ix_login_failures_failed_at', 'failed_at'),
+    )
+
+    def __repr__(self):
+        return f"<LoginFailure {self.key} at {self.failed_at}>"
+
+
+class Suggestion(db.Model):
+    """A precomputed who-to-follow suggestion (see suggestions.py)."""
+
+    __tablename__ = 'suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    suggested_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # How many of the people `user_id` follows follow `suggested_id`.
+    shared = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    suggested = db.relationship('User', foreign_keys=[suggested_id])
+
+    @classmethod
+    def for_user(cls, user_id, limit):
+        """The user's best `limit` suggestions, skipping anyone they've
+        followed (or who has left) since the job ran.
+
+        One range read of the primary key, with the suggested users joined in.
+        """
+
+        followed = (select(Follows.user_being_followed_id)
+                    .where(Follows.user_following_id == user_id)
+                    .where(Follows.user_being_followed_id == cls.suggested_id)
+                    .exists())
+
+        return (cls.query
+                .join(cls.suggested)
+                .options(contains_eager(cls.suggested))
+                .filter(cls.user_id == user_id)
+                .filter(User.deactivated_at.is_(None))
+                .filter(~followed)
+                .order_by(cls.rank)
+                .limit(limit)
+                .all())
+
+
+##############################################################################
+# Counter maintenance
+#
+# These run inside the flush, so a counter always changes in the same
+# transaction as the row it counts.
+
+
+def adjust_count(connection, user_id, column, delta):
+    """Add `delta` to one of a user's counter columns."""
+
+    counter = getattr(User, column)
+    connection.execute(update(User)
+                       .where(User.id == user_id)
+                       .values({counter: counter + delta}))
+
+
+@event.listens_for(Message, 'after_insert')
+def count_new_message(mapper, connection, message):
+    adjust_count(connection, message.user_id, 'messages_count', 1)
+
+
+@event.listens_for(Message, 'after_delete')
+def count_deleted_message(mapper, connection, message):
+    adjust_count(connection, message.user_id, 'messages_count', -1)
+
+
+@event.listens_for(Follows, 'after_insert')
+def count_new_follow(mapper, connection, follow):
+    adjust_count(connection, follow.user_following_id, 'following_count', 1)
+    adjust_count(connection, follow.user_being_followed_id, 'followers_count', 1)
+
+
+@event.listens_for(Follows, 'after_delete')
+def count_deleted_follow(mapper, connection, follow):
+    adjust_count(connection, follow.user_following_id, 'following_count', -1)
+    adjust_count(connection, follow.user_being_followed_id, 'followers_count', -1)
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
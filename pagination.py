@@ -0,0 +1,62 @@
+"""Keyset (cursor) pagination for message lists.
+
+Pages are ordered newest first on ``(timestamp, id)``. Instead of an
+OFFSET, the next page starts strictly below the last message shown, so
+page 500 costs the same index range scan as page 1. The position is
+handed to the client as an opaque ``?before=`` token.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from sqlalchemy import true, tuple_
+
+
+def encode_cursor(timestamp, message_id):
+    """Pack a `(timestamp, id)` position into a URL-safe token."""
+
+    raw = f"{timestamp.isoformat()}|{message_id}".encode('UTF-8')
+    return urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Unpack a token made by encode_cursor().
+
+    Returns None for a missing token. Raises ValueError if the token is
+    malformed.
+    """
+
+    if not token:
+        return None
+
+    try:
+        raw = urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('UTF-8')
+        timestamp, message_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (TypeError, ValueError) as exc:
+        raise ValueError(f"Invalid cursor: {token!r}") from exc
+
+
+def before_cursor(timestamp_column, id_column, cursor):
+    """Filter clause for rows older than `cursor` (a no-op without one)."""
+
+    if cursor is None:
+        return true()
+
+    return tuple_(timestamp_column, id_column) < tuple_(*cursor)
+
+
+def split_page(messages, page_size):
+    """Split `page_size + 1` fetched messages into a page and the next cursor.
+
+    Callers fetch one row more than they show; if it came back there is
+    another page, which starts below the last message on this one.
+    """
+
+    page = messages[:page_size]
+
+    if len(messages) <= page_size:
+        return page, None
+
+    last = page[-1]
+    return page, encode_cursor(last.timestamp, last.id)
@@ -0,0 +1,146 @@
+"""Per-request SQL instrumentation for Warbler.
+
+Hooks SQLAlchemy's engine events to record, for every request, how many
+statements ran, how long they took in total and which were slowest.
+The numbers go out in response headers (``X-SQL-Queries``,
+``X-SQL-Time`` and a standard ``Server-Timing`` entry) and in one JSON
+log line per request on the ``warbler.sql`` logger.
+
+Routes can be given a statement budget in ``SQL_STATEMENT_BUDGETS``
+(endpoint name -> max statements). Going over it logs a warning, or
+raises QueryBudgetExceeded when ``SQL_BUDGET_STRICT`` is set, which is
+how the test suite turns a new N+1 query into a failing test.
+"""
+
+import heapq
+import json
+import logging
+from time import perf_counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('warbler.sql')
+
+# Longest SQL text kept for the slowest-statements report.
+MAX_STATEMENT_LENGTH = 200
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A request ran more SQL statements than its route's budget allows."""
+
+
+class RequestProfile:
+    """SQL statistics for a single request."""
+
+    def __init__(self, keep_slowest):
+        self.statements = 0
+        self.seconds = 0.0
+        self.keep_slowest = keep_slowest
+        self._slowest = []
+
+    def record(self, statement, seconds):
+        self.statements += 1
+        self.seconds += seconds
+
+        entry = (seconds, self.statements, statement[:MAX_STATEMENT_LENGTH])
+        if len(self._slowest) < self.keep_slowest:
+            heapq.heappush(self._slowest, entry)
+        elif self._slowest and entry > self._slowest[0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    @property
+    def milliseconds(self):
+        return self.seconds * 1000
+
+    def slowest(self):
+        """The slowest statements, slowest first."""
+
+        return [{'ms': round(seconds * 1000, 3), 'sql': statement}
+                for seconds, _, statement in sorted(self._slowest, reverse=True)]
+
+
+class QueryProfiler:
+    """Flask extension that profiles the SQL issued by each request."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQL_PROFILER_SLOWEST', 3)
+        app.config.setdefault('SQL_STATEMENT_BUDGETS', {})
+        app.config.setdefault('SQL_BUDGET_STRICT', False)
+
+        # Listen on the Engine class rather than db.engine so this works
+        # before the app has an app context (and for every bind).
+        if not event.contains(Engine, 'before_cursor_execute', _start_statement):
+            event.listen(Engine, 'before_cursor_execute', _start_statement)
+            event.listen(Engine, 'after_cursor_execute', _finish_statement)
+            event.listen(Engine, 'handle_error', _abandon_statement)
+
+        # Register before the app's own hooks so the whole request is
+        # covered: before_request runs in order, after_request in reverse.
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    def start_request(self):
+        g.sql_profile = RequestProfile(keep_slowest=self._config('SQL_PROFILER_SLOWEST'))
+
+    def finish_request(self, response):
+        profile = g.pop('sql_profile', None)
+        if profile is None:
+            return response
+
+        response.headers['X-SQL-Queries'] = str(profile.statements)
+        response.headers['X-SQL-Time'] = f"{profile.milliseconds:.2f}ms"
+        response.headers.add(
+            'Server-Timing', f'db;dur={profile.milliseconds:.2f};desc="{profile.statements} queries"')
+
+        budget = self._config('SQL_STATEMENT_BUDGETS').get(request.endpoint)
+        over_budget = budget is not None and profile.statements > budget
+
+        logger.log(logging.WARNING if over_budget else logging.INFO, json.dumps({
+            'event': 'sql_profile',
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'statements': profile.statements,
+            'budget': budget,
+            'db_ms': round(profile.milliseconds, 3),
+            'slowest': profile.slowest(),
+        }))
+
+        if over_budget and self._config('SQL_BUDGET_STRICT'):
+            raise QueryBudgetExceeded(
+                f"{request.endpoint} ran {profile.statements} SQL statements "
+                f"(budget {budget}) for {request.method} {request.path}")
+
+        return response
+
+    @staticmethod
+    def _config(key):
+        return current_app.config[key]
+
+
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('sql_profile_started', []).append(perf_counter())
+
+
+def _finish_statement(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['sql_profile_started'].pop()
+
+    if has_request_context():
+        profile = g.get('sql_profile')
+        if profile is not None:
+            profile.record(statement, perf_counter() - started)
+
+
+def _abandon_statement(context):
+    # A failed statement never reaches after_cursor_execute.
+    if context.connection is not None:
+        started = context.connection.info.get('sql_profile_started')
+        if started:
+            started.pop()
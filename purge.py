@@ -0,0 +1,167 @@
+"""Purge deactivated accounts in the background.
+
+Deleting an account used to happen inside the request: every message id
+loaded into Python, row-by-row ORM deletes and a commit per table, which
+for a prolific user held locks for as long as it took. Now
+``delete_user()`` only calls ``User.deactivate()`` (the account
+disappears from the site at once) and hands the user id to
+``purge_worker``, which deletes the rows afterwards on its own thread:
+
+1. follows, both directions, releasing the counters on the other side,
+2. likes the user gave, releasing the liked messages' like counts,
+3. their home timeline,
+4. their messages; likes and timeline entries pointing at them go with
+   them through the ``ondelete='cascade'`` foreign keys,
+5. the user row itself.
+
+Each step deletes PURGE_BATCH_SIZE rows per set-based ``DELETE ... WHERE
+... IN (SELECT ... LIMIT n)`` and commits every batch, so no statement
+runs long or holds locks for long. Progress is recorded on the user's
+``AccountPurge`` row; every step is idempotent, so a purge interrupted by
+a restart is finished by ``flask purge-accounts``.
+"""
+
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import delete, select, update
+
+from models import db, AccountPurge, Follows, Likes, Message, TimelineEntry, User
+from timelines import recent_messages
+
+logger = logging.getLogger('warbler.purge')
+
+# Default for the ACCOUNT_PURGE_BATCH_SIZE config key.
+PURGE_BATCH_SIZE = 1000
+
+
+def delete_in_batches(purge, column, delete_batch, batch_size):
+    """Call `delete_batch(batch_size)` until it deletes nothing, committing
+    each batch along with its count added to `purge.<column>`."""
+
+    while True:
+        deleted = delete_batch(batch_size)
+        if column:
+            setattr(purge, column, getattr(purge, column) + deleted)
+        db.session.commit()
+
+        if not deleted:
+            return
+
+
+def owned_rows(model, owner, key, user_id, release=None):
+    """A batch deleter for the rows of `model` whose `owner` column is
+    `user_id`, taken in `key` order.
+
+    `release`, a counter column on User or Message, is decremented first
+    for the rows whose ids are in the batch's `key` column.
+    """
+
+    def delete_batch(limit):
+        batch = select(key).where(owner == user_id).order_by(key).limit(limit)
+
+        if release is not None:
+            counted = release.class_
+            db.session.execute(update(counted)
+                               .where(counted.id.in_(batch))
+                               .values({release: release - 1})
+                               .execution_options(synchronize_session=False))
+
+        return db.session.execute(delete(model)
+                                  .where(owner == user_id)
+                                  .where(key.in_(batch))
+                                  .execution_options(synchronize_session=False)).rowcount
+
+    return delete_batch
+
+
+def purge_account(user_id):
+    """Delete everything belonging to deactivated user `user_id`.
+
+    Safe to call again after an interruption; returns the user's
+    AccountPurge row, or None if no purge was requested.
+    """
+
+    purge = db.session.get(AccountPurge, user_id)
+    if purge is None or purge.finished_at is not None:
+        return purge
+
+    batch_size = current_app.config.get('ACCOUNT_PURGE_BATCH_SIZE', PURGE_BATCH_SIZE)
+    steps = [
+        ('follows_deleted', owned_rows(Follows, Follows.user_being_followed_id, Follows.user_following_id,
+                                       user_id, release=User.following_count)),
+        ('follows_deleted', owned_rows(Follows, Follows.user_following_id, Follows.user_being_followed_id,
+                                       user_id, release=User.followers_count)),
+        ('likes_deleted', owned_rows(Likes, Likes.user_id, Likes.message_id, user_id,
+                                     release=Message.like_count)),
+        (None, owned_rows(TimelineEntry, TimelineEntry.user_id, TimelineEntry.message_id, user_id)),
+        ('messages_deleted', owned_rows(Message, Message.user_id, Message.id, user_id)),
+    ]
+    for column, delete_batch in steps:
+        delete_in_batches(purge, column, delete_batch, batch_size)
+
+    # Through the ORM, so the cache and search index listeners see it.
+    user = db.session.get(User, user_id)
+    if user is not None:
+        db.session.delete(user)
+    purge.finished_at = datetime.utcnow()
+    db.session.commit()
+
+    recent_messages.forget(user_id)
+    logger.info(json.dumps({
+        'event': 'account_purged',
+        'user_id': user_id,
+        'follows_deleted': purge.follows_deleted,
+        'likes_deleted': purge.likes_deleted,
+        'messages_deleted': purge.messages_deleted,
+        'seconds': round((purge.finished_at - purge.requested_at).total_seconds(), 3),
+    }))
+
+    return purge
+
+
+def pending_purges():
+    """Ids of deactivated users whose purge hasn't finished."""
+
+    return db.session.scalars(select(AccountPurge.user_id)
+                              .where(AccountPurge.finished_at.is_(None))
+                              .order_by(AccountPurge.requested_at)).all()
+
+
+class PurgeWorker:
+    """Runs purge_account() on a single background thread.
+
+    With the ACCOUNT_PURGE_BACKGROUND config key off (as in the tests),
+    purges run inline in the request instead.
+    """
+
+    def __init__(self):
+        self._app = None
+        self._executor = None
+
+    def init_app(self, app):
+        self._app = app
+
+    def enqueue(self, user_id):
+        if not current_app.config.get('ACCOUNT_PURGE_BACKGROUND', True):
+            purge_account(user_id)
+            return
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='purge')
+        self._executor.submit(self._run, user_id)
+
+    def _run(self, user_id):
+        with self._app.app_context():
+            try:
+                purge_account(user_id)
+            except Exception:
+                db.session.rollback()
+                # The AccountPurge row stays unfinished for `flask purge-accounts`.
+                logger.exception(json.dumps({'event': 'account_purge_failed', 'user_id': user_id}))
+
+
+purge_worker = PurgeWorker()
@@ -0,0 +1,139 @@
+"""Bring an existing Warbler database up to date with models.py.
+
+``db.create_all()`` only creates tables that don't exist yet, so a
+database created before a column or index was added never gets it.
+``upgrade_schema()`` fills those gaps in place, without touching data:
+
+- missing tables are created,
+- missing columns are added (they must be nullable or have a
+  server_default, which every column added since the first release has),
+- missing indexes are created, including the Postgres-only trigram
+  index used by username search,
+- indexes whose uniqueness changed are rebuilt,
+- unique constraints models.py no longer declares are dropped (SQLite
+  can't drop a constraint, so there the table is copied into a fresh
+  one instead).
+
+Run it with ``flask upgrade-db``. It is safe to run repeatedly.
+"""
+
+from sqlalchemy import inspect, UniqueConstraint
+
+from models import db, USERNAME_SEARCH_DDL
+
+
+def missing_columns(inspector, table):
+    """Columns declared on `table` that the database doesn't have."""
+
+    existing = {column['name'] for column in inspector.get_columns(table.name)}
+    return [column for column in table.columns if column.name not in existing]
+
+
+def missing_indexes(inspector, table):
+    """Indexes declared on `table` that the database doesn't have."""
+
+    existing = {index['name'] for index in inspector.get_indexes(table.name)}
+    return [index for index in table.indexes if index.name not in existing]
+
+
+def changed_indexes(inspector, table):
+    """Declared indexes that exist but differ in uniqueness."""
+
+    existing = {index['name']: bool(index['unique']) for index in inspector.get_indexes(table.name)}
+    return [index for index in table.indexes
+            if index.name in existing and existing[index.name] != bool(index.unique)]
+
+
+def undeclared_unique_constraints(inspector, table):
+    """Unique constraints in the database that `table` no longer declares."""
+
+    declared = {frozenset(table.primary_key.columns.keys())}
+    declared.update(frozenset(constraint.columns.keys()) for constraint in table.constraints
+                    if isinstance(constraint, UniqueConstraint))
+    declared.update(frozenset(index.columns.keys()) for index in table.indexes if index.unique)
+
+    return [constraint for constraint in inspector.get_unique_constraints(table.name)
+            if frozenset(constraint['column_names']) not in declared]
+
+
+def rebuild_table(connection, inspector, table):
+    """Copy `table` into a fresh one created from models.py (for SQLite,
+    which can't drop constraints in place)."""
+
+    existing = {column['name'] for column in inspector.get_columns(table.name)}
+    columns = ', '.join(column.name for column in table.columns if column.name in existing)
+
+    for index in inspector.get_indexes(table.name):
+        connection.exec_driver_sql(f'DROP INDEX {index["name"]}')
+    connection.exec_driver_sql(f'ALTER TABLE {table.name} RENAME TO {table.name}_old')
+    table.create(connection)
+    connection.exec_driver_sql(
+        f'INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {table.name}_old')
+    connection.exec_driver_sql(f'DROP TABLE {table.name}_old')
+
+
+def add_column(connection, table, column):
+    """ALTER TABLE ... ADD COLUMN for a column declared in models.py."""
+
+    column_type = column.type.compile(dialect=connection.dialect)
+    ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+
+    if column.server_default is not None:
+        ddl += f" DEFAULT {column.server_default.arg}"
+    if not column.nullable:
+        ddl += ' NOT NULL'
+
+    connection.exec_driver_sql(ddl)
+
+
+def upgrade_schema():
+    """Create whatever tables, columns and indexes are missing.
+
+    Returns a list of human-readable descriptions of what was changed.
+    """
+
+    changes = []
+
+    with db.engine.begin() as connection:
+        inspector = inspect(connection)
+        existing_tables = set(inspector.get_table_names())
+
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                table.create(connection)
+                changes.append(f"created table {table.name}")
+                continue
+
+            stale = undeclared_unique_constraints(inspector, table)
+            if stale and connection.dialect.name == 'sqlite':
+                rebuild_table(connection, inspector, table)
+                changes.append(f"rebuilt table {table.name} without "
+                               + ", ".join(f"unique({', '.join(c['column_names'])})" for c in stale))
+                continue
+            for constraint in stale:
+                connection.exec_driver_sql(f'ALTER TABLE {table.name} DROP CONSTRAINT {constraint["name"]}')
+                changes.append(f"dropped constraint {constraint['name']}")
+
+            for column in missing_columns(inspector, table):
+                add_column(connection, table, column)
+                changes.append(f"added column {table.name}.{column.name}")
+
+            for index in changed_indexes(inspector, table):
+                index.drop(connection)
+                index.create(connection)
+                changes.append(f"rebuilt index {index.name} ({'' if index.unique else 'not '}unique)")
+
+            for index in missing_indexes(inspector, table):
+                index.create(connection)
+                changes.append(f"created index {index.name}")
+
+        # Indexes that only exist on Postgres aren't declared on the
+        # tables; their DDL is idempotent, so just run it.
+        if connection.dialect.name == 'postgresql':
+            existing = {index['name'] for index in inspector.get_indexes('users')}
+            for statement in USERNAME_SEARCH_DDL:
+                connection.exec_driver_sql(statement)
+            if 'ix_users_username_trgm' not in existing:
+                changes.append("created index ix_users_username_trgm")
+
+    return changes
@@ -0,0 +1,128 @@
+"""In-memory username prefix index for typeahead search.
+
+``User.search()`` handles the full /users?q= search in the database.
+Typeahead fires on every keystroke and only ever needs prefixes, so it
+is answered from a sorted in-process list of lowercased usernames with
+two binary searches, without touching the database. Deactivated
+accounts are left out, as they are by ``User.search()``.
+
+The index is built from the users table on first use and kept current
+by mapper events on ``User``, applied once their transaction commits so
+a rolled back signup or rename never shows up. Bulk loads and deletes skip those events
+(as do writes from other processes), so it is also rebuilt every
+MAX_AGE seconds.
+"""
+
+from bisect import bisect_left, insort
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from models import db, User
+
+# Seconds before the index is rebuilt from the database.
+MAX_AGE = 300
+
+
+class UsernameIndex:
+    """Sorted `(lowercased username, username, id)` entries for prefix lookups."""
+
+    def __init__(self, max_age=MAX_AGE):
+        self.max_age = max_age
+        self._entries = None
+        self._loaded_at = 0
+        self._lock = Lock()
+
+    def _load(self):
+        rows = db.session.query(User.username, User.id).filter(User.deactivated_at.is_(None)).all()
+        return sorted((username.lower(), username, user_id) for username, user_id in rows)
+
+    def _ensure_loaded(self):
+        if self._entries is None or monotonic() - self._loaded_at > self.max_age:
+            entries = self._load()
+            with self._lock:
+                self._entries = entries
+                self._loaded_at = monotonic()
+
+    def prefix(self, term, limit=10):
+        """Return up to `limit` `{'id', 'username'}` dicts whose username
+        starts with `term` (case-insensitively), in alphabetical order."""
+
+        term = term.lower()
+        if not term:
+            return []
+
+        self._ensure_loaded()
+
+        with self._lock:
+            start = bisect_left(self._entries, (term,))
+            end = bisect_left(self._entries, (term + '\uffff',), lo=start)
+            matches = self._entries[start:min(end, start + limit)]
+
+        return [{'id': user_id, 'username': username} for _, username, user_id in matches]
+
+    def add(self, user_id, username):
+        with self._lock:
+            if self._entries is not None:
+                insort(self._entries, (username.lower(), username, user_id))
+
+    def remove(self, user_id, username):
+        with self._lock:
+            if self._entries is not None:
+                entry = (username.lower(), username, user_id)
+                position = bisect_left(self._entries, entry)
+                if position < len(self._entries) and self._entries[position] == entry:
+                    del self._entries[position]
+
+    def reset(self):
+        """Forget everything; the next lookup reloads from the database."""
+
+        with self._lock:
+            self._entries = None
+
+
+username_index = UsernameIndex()
+
+
+def apply_on_commit(user, change, username):
+    """Queue `change` (username_index.add or .remove) of `username` until
+    `user`'s session commits."""
+
+    object_session(user).info.setdefault('username_index_pending', []).append((change, user.id, username))
+
+
+@event.listens_for(User, 'after_insert')
+def index_new_user(mapper, connection, user):
+    apply_on_commit(user, username_index.add, user.username)
+
+
+@event.listens_for(User, 'after_update')
+def reindex_updated_user(mapper, connection, user):
+    attrs = inspect(user).attrs
+    deactivated = attrs.deactivated_at.history.has_changes() and user.deactivated_at is not None
+
+    if deactivated or attrs.username.history.has_changes():
+        for old_username in attrs.username.history.deleted:
+            apply_on_commit(user, username_index.remove, old_username)
+        if deactivated:
+            apply_on_commit(user, username_index.remove, user.username)
+        else:
+            apply_on_commit(user, username_index.add, user.username)
+
+
+@event.listens_for(User, 'after_delete')
+def unindex_deleted_user(mapper, connection, user):
+    apply_on_commit(user, username_index.remove, user.username)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_committed(session):
+    for change, user_id, username in session.info.pop('username_index_pending', ()):
+        change(user_id, username)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_rolled_back(session):
+    session.info.pop('username_index_pending', None)
@@ -1,23 +1,220 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+Streams generator/users.csv, messages.csv and follows.csv into the
+database in chunks of --batch rows, so memory stays flat however big
+the files are:
+
+- on Postgres each chunk goes through ``COPY ... FROM STDIN``,
+- elsewhere (SQLite) each chunk is one executemany INSERT.
+
+Secondary indexes (and, on Postgres, foreign keys) are dropped before
+the load and recreated once it's done, which is much cheaper than
+maintaining them row by row. Then the counters and home timelines,
+which bulk loads bypass, are rebuilt.
+
+Users and messages get explicit ids (their row number in the CSV), so
+follows.csv's user ids line up however the load is interrupted. Each
+chunk is committed together with its row in a ``seed_progress`` table;
+after a crash, ``--resume`` picks up at the first uncommitted chunk.
+
+    python seed.py
+    python seed.py --dir /data/warbler --batch 50000
+    python seed.py --resume
+"""
+
+import argparse
+import csv
+import io
+from datetime import datetime
+from itertools import islice
+from time import perf_counter
+
+from sqlalchemy import DateTime, Integer, inspect, text
+from sqlalchemy.schema import AddConstraint
 
-from csv import DictReader
 from app import app
-from models import db, connect_db, User, Message, Follows
+from models import db, User
+from schema import upgrade_schema
+from timelines import rebuild_timelines
+
+# Tables in load order, with their CSV and whether rows get explicit ids.
+SOURCES = [
+    ('users', 'users.csv', True),
+    ('messages', 'messages.csv', True),
+    ('follows', 'follows.csv', False),
+]
+
+# Seconds between progress lines while a table loads.
+REPORT_INTERVAL = 5
+
+
+def reset_database(connection):
+    """Recreate every table, minus the indexes and foreign keys the load
+    would otherwise have to maintain."""
+
+    connection.exec_driver_sql('DROP TABLE IF EXISTS seed_progress')
+    db.metadata.drop_all(connection)
+    db.metadata.create_all(connection)
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(connection)
+
+    if connection.dialect.name == 'postgresql':
+        connection.exec_driver_sql('DROP INDEX IF EXISTS ix_users_username_trgm')
+        inspector = inspect(connection)
+        for table in db.metadata.sorted_tables:
+            for foreign_key in inspector.get_foreign_keys(table.name):
+                connection.exec_driver_sql(
+                    f'ALTER TABLE {table.name} DROP CONSTRAINT {foreign_key["name"]}')
+
+    connection.exec_driver_sql(
+        'CREATE TABLE seed_progress (table_name VARCHAR(64) PRIMARY KEY, rows_loaded INTEGER NOT NULL)')
+    for table_name, _, _ in SOURCES:
+        connection.execute(text('INSERT INTO seed_progress VALUES (:table_name, 0)'),
+                           {'table_name': table_name})
+
+
+def rows_loaded(connection):
+    return dict(connection.execute(text('SELECT table_name, rows_loaded FROM seed_progress')).all())
+
+
+def chunks(rows, size):
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def copy_chunk(connection, table, columns, chunk):
+    """Stream a chunk of CSV rows into Postgres with COPY."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(chunk)
+    buffer.seek(0)
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def insert_chunk(connection, table, columns, chunk):
+    """Insert a chunk of CSV rows with one executemany."""
+
+    converters = []
+    for name in columns:
+        column_type = table.c[name].type
+        if isinstance(column_type, DateTime):
+            converters.append(datetime.fromisoformat)
+        elif isinstance(column_type, Integer):
+            converters.append(int)
+        else:
+            converters.append(str)
+
+    connection.execute(table.insert(), [
+        {name: convert(value) for name, convert, value in zip(columns, converters, row)}
+        for row in chunk])
+
+
+def load_table(table_name, path, explicit_ids, batch):
+    """Load one CSV, resuming after the rows already committed."""
+
+    table = db.metadata.tables[table_name]
+
+    with db.engine.connect() as connection:
+        done = rows_loaded(connection)[table_name]
+        connection.commit()
+        load = copy_chunk if connection.dialect.name == 'postgresql' else insert_chunk
+
+        with open(path, newline='') as source:
+            reader = csv.reader(source)
+            columns = next(reader)
+            if explicit_ids:
+                columns = ['id'] + columns
+
+            rows = islice(reader, done, None)
+            if explicit_ids:
+                rows = ([row_id] + row for row_id, row in enumerate(rows, start=done + 1))
+
+            if done:
+                print(f"{table_name}: resuming after {done} rows")
+
+            started = reported = perf_counter()
+            loaded = 0
+
+            for chunk in chunks(rows, batch):
+                with connection.begin():
+                    load(connection, table, columns, chunk)
+                    connection.execute(
+                        text('UPDATE seed_progress SET rows_loaded = :rows WHERE table_name = :table_name'),
+                        {'rows': done + loaded + len(chunk), 'table_name': table_name})
+                loaded += len(chunk)
+
+                if perf_counter() - reported > REPORT_INTERVAL:
+                    reported = perf_counter()
+                    print(f"{table_name}: {done + loaded} rows "
+                          f"({loaded / (reported - started):,.0f} rows/s)")
+
+        elapsed = perf_counter() - started
+        print(f"{table_name}: loaded {loaded} rows in {elapsed:.1f}s "
+              f"({loaded / elapsed if elapsed else 0:,.0f} rows/s)")
+
+    return loaded
+
+
+def finish(connection):
+    """Put back what reset_database() deferred and drop the progress table."""
+
+    if connection.dialect.name == 'postgresql':
+        for table_name, _, explicit_ids in SOURCES:
+            if explicit_ids:
+                connection.exec_driver_sql(
+                    f"SELECT setval(pg_get_serial_sequence('{table_name}', 'id'), "
+                    f"COALESCE(MAX(id), 0) + 1, false) FROM {table_name}")
+
+        inspector = inspect(connection)
+        for table in db.metadata.sorted_tables:
+            existing = {tuple(foreign_key['constrained_columns'])
+                        for foreign_key in inspector.get_foreign_keys(table.name)}
+            for foreign_key in table.foreign_key_constraints:
+                if tuple(foreign_key.column_keys) not in existing:
+                    connection.execute(AddConstraint(foreign_key))
+
+    connection.exec_driver_sql('DROP TABLE seed_progress')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed the database from generated CSV files.")
+    parser.add_argument('--dir', default='generator', help="directory holding the CSV files")
+    parser.add_argument('--batch', type=int, default=10000, help="rows per chunk")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted load instead of starting over")
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.resume:
+            if not inspect(db.engine).has_table('seed_progress'):
+                parser.error("there is no interrupted load to resume")
+        else:
+            with db.engine.begin() as connection:
+                reset_database(connection)
 
+        started = perf_counter()
+        total = sum(load_table(table_name, f"{args.dir}/{filename}", explicit_ids, args.batch)
+                    for table_name, filename, explicit_ids in SOURCES)
 
+        print("Creating indexes...")
+        upgrade_schema()
+        with db.engine.begin() as connection:
+            finish(connection)
 
-with app.app_context():
-    db.drop_all()
-    db.create_all()
-    db.session.commit()
+        # Bulk loads skip the counter and timeline listeners, so build
+        # both in one pass (counters first; timelines read them).
+        print("Rebuilding counters and timelines...")
+        User.reconcile_counts()
+        rebuild_timelines()
 
-    with open('generator/users.csv') as users:
-        db.session.bulk_insert_mappings(User, DictReader(users))
+        elapsed = perf_counter() - started
+        print(f"Seeded {total} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s overall).")
 
-    with open('generator/messages.csv') as messages:
-        db.session.bulk_insert_mappings(Message, DictReader(messages))
 
-    with open('generator/follows.csv') as follows:
-        db.session.bulk_insert_mappings(Follows, DictReader(follows))
-    
-    db.session.commit()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Who-to-follow suggestions, computed in a batch job.
+
+A user's candidates are the people followed by the people they follow,
+ranked by how many of the people they follow follow them ("shared").
+With A the follow matrix (A[u, v] = 1 if u follows v) that's row u of
+A @ A, minus u and everyone u already follows.
+
+``compute_suggestions()`` takes that product a batch of rows at a time,
+with scipy.sparse if it's installed and otherwise the same product in
+NumPy over followgraph.py's CSR arrays. Batches are sized so each one
+walks at most PATH_BUDGET two-hop paths, whatever the degree
+distribution. Each user's top SUGGESTIONS_PER_USER are swapped into the
+``suggestions`` table a batch per transaction, and the homepage reads
+them back with one primary-key range read (``Suggestion.for_user()``).
+
+Run it periodically, e.g. nightly from cron:
+
+    flask suggest-follows
+"""
+
+import json
+import logging
+from functools import partial
+from time import perf_counter
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import delete, insert, select
+
+from followgraph import Adjacency, follow_edges, pack
+from models import db, Suggestion, User
+
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+logger = logging.getLogger('warbler.suggestions')
+
+# Default for the SUGGESTIONS_PER_USER config key.
+SUGGESTIONS_PER_USER = 10
+
+# Most two-hop paths (and so array entries) expanded per batch.
+PATH_BUDGET = 5_000_000
+
+
+def expand(adjacency, nodes):
+    """Every neighbour of every node in `nodes`, concatenated, with the
+    position in `nodes` each one came from."""
+
+    starts = adjacency.indptr[nodes]
+    lengths = adjacency.indptr[nodes + 1] - starts
+    owners = np.repeat(np.arange(len(nodes)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    return owners, adjacency.indices[starts[owners] + offsets]
+
+
+def two_hop_numpy(following, rows):
+    """`(positions in rows, candidates, shared)` for the rows `rows` of A @ A."""
+
+    first_owners, first_hop = expand(following, rows)
+    second_owners, second_hop = expand(following, first_hop)
+
+    keys, shared = np.unique(pack(first_owners[second_owners], second_hop), return_counts=True)
+    return keys >> 32, keys & 0xFFFFFFFF, shared
+
+
+def two_hop_scipy(matrix, rows):
+    """The same as two_hop_numpy(), with a scipy.sparse product."""
+
+    product = (matrix[rows] @ matrix).tocoo()
+    return product.row, product.col, product.data
+
+
+def top_suggestions(rows, owners, candidates, shared, following, excluded, per_user):
+    """Filter and rank one batch's candidates: `(user, rank, suggested,
+    shared)` arrays with at most `per_user` rows per user."""
+
+    users = rows[owners]
+
+    first_owners, first_hop = expand(following, rows)
+    already_followed = np.isin(pack(users, candidates), pack(rows[first_owners], first_hop))
+    keep = (candidates != users) & ~excluded[candidates] & ~already_followed
+    users, candidates, shared = users[keep], candidates[keep], shared[keep]
+
+    # Most shared first, then lowest id, so reruns are stable.
+    order = np.lexsort((candidates, -shared, users))
+    users, candidates, shared = users[order], candidates[order], shared[order]
+    ranks = np.arange(len(users)) - np.searchsorted(users, users)
+
+    top = ranks < per_user
+    return users[top], ranks[top], candidates[top], shared[top]
+
+
+def batches(following, size):
+    """Contiguous `(first id, end id)` ranges of users whose two-hop
+    paths add up to at most PATH_BUDGET (or a single user past it)."""
+
+    degrees = np.diff(following.indptr)
+    sources, targets = following.edges()
+    paths = np.cumsum(np.bincount(sources, weights=degrees[targets], minlength=size))
+
+    start = 0
+    while start < size:
+        spent = paths[start - 1] if start else 0
+        end = max(int(np.searchsorted(paths, spent + PATH_BUDGET, side='right')), start + 1)
+        yield start, min(end, size)
+        start = end
+
+
+def compute_suggestions():
+    """Recompute every user's suggestions. Returns a summary dict."""
+
+    started = perf_counter()
+    per_user = current_app.config.get('SUGGESTIONS_PER_USER', SUGGESTIONS_PER_USER)
+
+    followers, followed = follow_edges()
+    deactivated = np.array(db.session.scalars(select(User.id).where(User.deactivated_at.is_not(None))).all(),
+                           dtype=np.int64)
+    size = int(max(followers.max(initial=0), followed.max(initial=0), deactivated.max(initial=0))) + 1
+
+    following = Adjacency(followers, followed, size)
+    excluded = np.zeros(size, dtype=bool)
+    excluded[deactivated] = True
+
+    if sparse is not None:
+        matrix = sparse.csr_matrix((np.ones(len(followers), dtype=np.int32), (followers, followed)),
+                                   shape=(size, size))
+        two_hop = partial(two_hop_scipy, matrix)
+    else:
+        two_hop = partial(two_hop_numpy, following)
+
+    users = stored = 0
+    for start, end in batches(following, size):
+        rows = np.arange(start, end)
+        user_ids, ranks, suggested_ids, shared = top_suggestions(
+            rows, *two_hop(rows), following, excluded, per_user)
+
+        db.session.execute(delete(Suggestion)
+                           .where(Suggestion.user_id >= start)
+                           .where(Suggestion.user_id < end))
+        if len(user_ids):
+            db.session.execute(insert(Suggestion), [
+                {'user_id': int(user_id), 'rank': int(rank), 'suggested_id': int(suggested_id),
+                 'shared': int(count)}
+                for user_id, rank, suggested_id, count in zip(user_ids, ranks, suggested_ids, shared)])
+        db.session.commit()
+
+        users += len(np.unique(user_ids))
+        stored += len(user_ids)
+
+    # Users past the last id in the graph follow nobody any more.
+    db.session.execute(delete(Suggestion).where(Suggestion.user_id >= size))
+    db.session.commit()
+
+    summary = {
+        'event': 'suggestions_computed',
+        'engine': 'scipy' if sparse is not None else 'numpy',
+        'follows': len(followers),
+        'users': users,
+        'suggestions': stored,
+        'seconds': round(perf_counter() - started, 3),
+    }
+    logger.info(json.dumps(summary))
+
+    return summary
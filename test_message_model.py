@@ -1,7 +1,11 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Message, Follows, Likes
+from schema import missing_indexes, rebuild_table, undeclared_unique_constraints
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
@@ -49,4 +53,58 @@ class MessageModelTestCase(TestCase):
             # See if the text of the message is equal to the instance
             self.assertEqual(new_m.text, "This is a test message.")
             # See if the user has at least 1 message
-            self.assertEqual(len(new_u.messages), 1)
\ No newline at end of file
+            self.assertEqual(len(new_u.messages), 1)
+
+    def test_likes_unique_per_user_upgrade(self):
+        """Upgrading a likes table with the old unique(message_id) should keep
+        its rows and allow one like per user per message."""
+
+        engine = create_engine('sqlite://')
+        with engine.begin() as connection:
+            # Just the likes table, so don't check its foreign keys.
+            connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+            connection.exec_driver_sql("CREATE TABLE likes (id INTEGER NOT NULL, user_id INTEGER, "
+                                       "message_id INTEGER, PRIMARY KEY (id), UNIQUE (message_id))")
+            connection.exec_driver_sql("CREATE INDEX ix_likes_user_id_message_id ON likes (user_id, message_id)")
+            connection.exec_driver_sql("INSERT INTO likes VALUES (1, 1, 10), (2, 2, 11)")
+
+            inspector = inspect(connection)
+            stale = undeclared_unique_constraints(inspector, Likes.__table__)
+            self.assertEqual([constraint['column_names'] for constraint in stale], [['message_id']])
+            self.assertIn('ix_likes_message_id', [index.name for index in missing_indexes(inspector, Likes.__table__)])
+
+            rebuild_table(connection, inspector, Likes.__table__)
+
+        with engine.begin() as connection:
+            connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+            inspector = inspect(connection)
+            self.assertEqual(undeclared_unique_constraints(inspector, Likes.__table__), [])
+            self.assertEqual(missing_indexes(inspector, Likes.__table__), [])
+            self.assertEqual(connection.exec_driver_sql("SELECT COUNT(*) FROM likes").scalar(), 2)
+
+            # Deleting a message's likes (the cascade) is an index lookup
+            plan = connection.exec_driver_sql("EXPLAIN QUERY PLAN DELETE FROM likes WHERE message_id = 10").all()
+            self.assertIn("ix_likes_message_id", " ".join(row[-1] for row in plan))
+
+            # Another user can now like message 10...
+            connection.exec_driver_sql("INSERT INTO likes (user_id, message_id) VALUES (2, 10)")
+
+        # ...but nobody can like it twice
+        with self.assertRaises(IntegrityError):
+            with engine.begin() as connection:
+                connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+                connection.exec_driver_sql("INSERT INTO likes (user_id, message_id) VALUES (2, 10)")
+
+    def test_timeline_deletes_use_indexes(self):
+        """Deleting a message's or an author's timeline rows shouldn't scan
+        the whole timelines table."""
+
+        engine = create_engine('sqlite://')
+        db.metadata.create_all(engine)
+
+        with engine.connect() as connection:
+            for statement, index in [("DELETE FROM timelines WHERE message_id = 1", "ix_timelines_message_id"),
+                                     ("DELETE FROM timelines WHERE author_id = 1 AND user_id != 1",
+                                      "ix_timelines_author_id")]:
+                plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}").all()
+                self.assertIn(index, " ".join(row[-1] for row in plan))
@@ -6,9 +6,15 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Follows, Likes
+from sqlalchemy import insert
+
+from fragments import fragment_cache
+from likecounts import like_counter
+from models import db, connect_db, Message, User, Follows, Likes, TimelineEntry
+from timelines import RecentMessages, recent_messages
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -33,6 +39,13 @@ with app.app_context():
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any request that goes over its route's SQL statement budget
+# (see SQL_STATEMENT_BUDGETS in app.py)
+app.config['SQL_BUDGET_STRICT'] = True
+
+# Build the follow graph in the request that needs it, so tests see it straight away
+app.config['FOLLOW_GRAPH_BACKGROUND'] = False
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -44,6 +57,10 @@ class MessageViewTestCase(TestCase):
             User.query.delete()
             Message.query.delete()
             Follows.query.delete()
+            # Ids are reused after the deletes above; drop cards rendered and
+            # likes tallied for old rows
+            fragment_cache.clear()
+            like_counter.reset()
 
             self.client = app.test_client()
 
@@ -68,10 +85,10 @@ class MessageViewTestCase(TestCase):
 
             testuser_extract3 = User.query.filter(User.username == "testuser3").first()
             
-            message_1 = Message(text="First message.", timestamp=Message.timestamp.default.arg, user_id=testuser_extract1.id)
-            message_2 = Message(text="Second message.", timestamp=Message.timestamp.default.arg, user_id=testuser_extract1.id)
-            message_3 = Message(text="First other message.", timestamp=Message.timestamp.default.arg, user_id=testuser_extract2.id)
-            message_4 = Message(text="Yet another message.", timestamp=Message.timestamp.default.arg, user_id=testuser_extract3.id)
+            message_1 = Message(text="First message.", timestamp=datetime.utcnow(), user_id=testuser_extract1.id)
+            message_2 = Message(text="Second message.", timestamp=datetime.utcnow(), user_id=testuser_extract1.id)
+            message_3 = Message(text="First other message.", timestamp=datetime.utcnow(), user_id=testuser_extract2.id)
+            message_4 = Message(text="Yet another message.", timestamp=datetime.utcnow(), user_id=testuser_extract3.id)
 
             db.session.add(message_1)
             db.session.add(message_2)
@@ -187,4 +204,147 @@ class MessageViewTestCase(TestCase):
             self.assertIn("First other message.", html)
 
             # The user should not be able to see the messages of any account they don't follow
-            self.assertNotIn("Yet another message.", html)
\ No newline at end of file
+            self.assertNotIn("Yet another message.", html)
+
+    def test_timeline_fan_out(self):
+        """A new message should show up on the home page of every follower,
+        and drop off it once they stop following the author."""
+        with app.app_context():
+            author = User.query.filter(User.username == "testuser2").first()
+            follower = User.query.filter(User.username == "testuser").first()
+            author_id = author.id
+            follower_id = follower.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            c.post("/messages/new", data={"text": "Fresh off the press."})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            # The follower's home page should include the new message
+            html1 = c.get("/").get_data(as_text=True)
+            self.assertIn("Fresh off the press.", html1)
+
+            c.post(f"/users/stop-following/{author_id}")
+
+            # Once unfollowed, the author's messages should be gone from the home page
+            html2 = c.get("/").get_data(as_text=True)
+            self.assertNotIn("Fresh off the press.", html2)
+            self.assertNotIn("First other message.", html2)
+
+    def test_timeline_celebrity_merge(self):
+        """Messages from authors over the celebrity threshold aren't fanned out,
+        but should still be merged into their followers' home pages."""
+        with app.app_context():
+            author = User.query.filter(User.username == "testuser2").first()
+            follower = User.query.filter(User.username == "testuser").first()
+            author_id = author.id
+            follower_id = follower.id
+
+        app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 1
+        recent_messages.clear()
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = author_id
+
+                c.post("/messages/new", data={"text": "Hello, fans."})
+
+                msg = Message.query.filter(Message.text == "Hello, fans.").first()
+
+                # Only the author's own timeline should get a row
+                self.assertEqual(TimelineEntry.query.filter(TimelineEntry.message_id == msg.id).count(), 1)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = follower_id
+
+                # The follower should still see the message on their home page
+                html = c.get("/").get_data(as_text=True)
+                self.assertIn("Hello, fans.", html)
+                self.assertIn("First message.", html)
+        finally:
+            app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 10000
+            recent_messages.clear()
+
+    def test_timeline_celebrity_threshold_crossing(self):
+        """An author dropping back below the celebrity threshold should be
+        backfilled onto their remaining followers' home pages."""
+        with app.app_context():
+            follower1 = User.query.filter(User.username == "testuser").first()
+            follower2 = User.query.filter(User.username == "testuser2").first()
+            author = User.query.filter(User.username == "testuser3").first()
+            follower1_id, follower2_id, author_id = follower1.id, follower2.id, author.id
+
+        app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 2
+        recent_messages.clear()
+
+        try:
+            with self.client as c:
+                for follower_id in (follower1_id, follower2_id):
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = follower_id
+                    c.post(f"/users/follow/{author_id}")
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = author_id
+                c.post("/messages/new", data={"text": "Posted while famous."})
+
+                # As a celebrity, the post is only on the author's own timeline
+                msg = Message.query.filter(Message.text == "Posted while famous.").first()
+                self.assertEqual(TimelineEntry.query.filter(TimelineEntry.message_id == msg.id).count(), 1)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = follower2_id
+                c.post(f"/users/stop-following/{author_id}")
+
+                # Back under the threshold, the remaining follower gets the post fanned out
+                self.assertEqual(TimelineEntry.query.filter(TimelineEntry.message_id == msg.id).count(), 2)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = follower1_id
+                html = c.get("/").get_data(as_text=True)
+                self.assertIn("Posted while famous.", html)
+        finally:
+            app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 10000
+            recent_messages.clear()
+
+    def test_recent_messages_expire(self):
+        """Celebrity buffers should pick up posts they weren't told about
+        (e.g. from another process) once they expire."""
+        with app.app_context():
+            author = User.query.filter(User.username == "testuser3").first()
+            author_id = author.id
+
+            buffers = RecentMessages(max_age=60)
+            self.assertEqual(buffers.entries(author_id, 10), [])
+
+            # Bypass the mapper events, as a write from another process would
+            db.session.execute(insert(Message).values(
+                text="From elsewhere.", timestamp=datetime.utcnow(), user_id=author_id))
+            db.session.commit()
+
+            self.assertEqual(buffers.entries(author_id, 10), [])
+
+            buffers.max_age = 0
+            self.assertEqual(len(buffers.entries(author_id, 10)), 1)
+
+    def test_sql_profile_headers(self):
+        """Every response should report the SQL it ran."""
+        with app.app_context():
+            current_user = User.query.filter(User.username == "testuser").first()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = current_user.id
+
+            resp = c.get("/")
+
+            # The statement count and time should be reported in the headers
+            self.assertEqual(resp.status_code, 200)
+            self.assertGreater(int(resp.headers["X-SQL-Queries"]), 0)
+            self.assertTrue(resp.headers["X-SQL-Time"].endswith("ms"))
+            self.assertIn("db;dur=", resp.headers["Server-Timing"])
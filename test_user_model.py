@@ -6,9 +6,16 @@
 
 
 import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import sleep
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, User, Message, Follows
+from followgraph import follow_graph, FollowGraph
+from hashing import calibrate_log_rounds, hash_log_rounds, HashingPool, HashingPoolSaturated
+from models import db, User, Message, Follows, Suggestion
+from suggestions import compute_suggestions
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -22,6 +29,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 from app import app
 
+# Build the follow graph in the request that needs it, so tests see it straight away
+app.config['FOLLOW_GRAPH_BACKGROUND'] = False
+
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
@@ -118,7 +128,133 @@ class UserModelTestCase(TestCase):
             self.assertFalse(new_u1_2.is_followed_by(new_u2_2))
             # Returns true (user 2 is being followed by user 1)
             self.assertTrue(new_u2_2.is_followed_by(new_u1_2))
-    
+
+    def test_followed_among(self):
+        """Follows.followed_among() should pick out the followed users from a
+        list, in one query per FOLLOWED_AMONG_CHUNK ids."""
+
+        with app.app_context():
+            users = [User(email=f"user{i}@test.com", username=f"user{i}", password="password")
+                     for i in range(5)]
+            db.session.add_all(users)
+            db.session.commit()
+
+            viewer, *others = [user.id for user in users]
+            db.session.add(Follows(user_being_followed_id=others[0], user_following_id=viewer))
+            db.session.add(Follows(user_being_followed_id=others[3], user_following_id=viewer))
+            db.session.commit()
+
+            self.assertEqual(Follows.followed_among(viewer, others), {others[0], others[3]})
+            self.assertEqual(Follows.followed_among(others[0], others), set())
+            self.assertEqual(Follows.followed_among(viewer, []), set())
+
+            with patch('models.FOLLOWED_AMONG_CHUNK', 2):
+                self.assertEqual(Follows.followed_among(viewer, others), {others[0], others[3]})
+
+    def test_follow_graph_background_build(self):
+        """The follow graph should build on a background thread, one build
+        at a time, serving the old graph (or None) meanwhile and keeping
+        follows committed during the build."""
+
+        with app.app_context():
+            users = [User(email=f"user{i}@test.com", username=f"user{i}", password="password")
+                     for i in range(3)]
+            db.session.add_all(users)
+            db.session.commit()
+            a, b, c = [user.id for user in users]
+            db.session.add(Follows(user_being_followed_id=b, user_following_id=a))
+            db.session.commit()
+
+        graph = FollowGraph(max_age=0)
+        release = Event()
+        loads = []
+        real_load = graph._load
+
+        def slow_load():
+            loads.append(1)
+            release.wait(5)
+            return real_load()
+
+        app.config['FOLLOW_GRAPH_BACKGROUND'] = True
+        try:
+            with app.app_context(), patch.object(graph, '_load', slow_load):
+                # Nothing to serve until the first build finishes, and no second build starts
+                self.assertIsNone(graph.following(a))
+                self.assertIsNone(graph.following(a))
+
+                graph.add(a, c)
+                release.set()
+                for _ in range(50):
+                    if graph.stats()['loaded']:
+                        break
+                    sleep(0.1)
+                self.assertEqual(len(loads), 1)
+
+                # The follow made during the build was replayed onto it; the
+                # stale graph is served while the next build waits
+                release.clear()
+                self.assertEqual(list(graph.following(a)), sorted([b, c]))
+                self.assertEqual(list(graph.following(a)), sorted([b, c]))
+                release.set()
+                for _ in range(50):
+                    if len(loads) == 2 and not graph._building:
+                        break
+                    sleep(0.1)
+                self.assertEqual(len(loads), 2)
+        finally:
+            release.set()
+            app.config['FOLLOW_GRAPH_BACKGROUND'] = False
+
+    def test_follow_graph(self):
+        """The follow graph should match the follows table through follows,
+        unfollows and merges of its overlay."""
+
+        with app.app_context():
+            users = [User(email=f"user{i}@test.com", username=f"user{i}", password="password")
+                     for i in range(4)]
+            db.session.add_all(users)
+            db.session.commit()
+            a, b, c, d = [user.id for user in users]
+
+            db.session.add_all([Follows(user_being_followed_id=b, user_following_id=a),
+                                Follows(user_being_followed_id=a, user_following_id=b),
+                                Follows(user_being_followed_id=c, user_following_id=b)])
+            db.session.commit()
+
+            follow_graph.reset()
+            self.assertEqual(list(follow_graph.following(b)), sorted([a, c]))
+            self.assertEqual(list(follow_graph.followers(c)), [b])
+            self.assertEqual(list(follow_graph.followed_by_followed(a, c)), [b])
+            self.assertTrue(follow_graph.is_following(a, b))
+            self.assertFalse(follow_graph.is_following(a, c))
+            self.assertEqual(list(follow_graph.following(d * 100)), [])
+
+            # Committed changes land in the overlay, then get merged in
+            with patch('followgraph.OVERLAY_MAX', 2):
+                db.session.add(Follows(user_being_followed_id=d, user_following_id=a))
+                db.session.commit()
+                self.assertEqual(follow_graph.stats()['overlay'], 1)
+                self.assertEqual(list(follow_graph.followers(d)), [a])
+
+                db.session.delete(Follows.query.get((b, a)))
+                db.session.commit()
+                self.assertEqual(follow_graph.stats()['overlay'], 0)
+
+            self.assertEqual(list(follow_graph.following(a)), [d])
+            self.assertEqual(list(follow_graph.followers(b)), [])
+            self.assertEqual(follow_graph.stats()['edges'], 3)
+
+            # Rolled back changes never reach the graph
+            db.session.add(Follows(user_being_followed_id=c, user_following_id=a))
+            db.session.flush()
+            db.session.rollback()
+            self.assertFalse(follow_graph.is_following(a, c))
+
+            # Past its size limit the graph doesn't load at all
+            small_graph = FollowGraph(max_edges=2)
+            self.assertIsNone(small_graph.following(a))
+            self.assertIsNone(small_graph.is_following(a, d))
+
     def test_user_signup(self):
         with app.app_context():
             # Returns true if valid credentials are provided.
@@ -152,6 +288,32 @@ class UserModelTestCase(TestCase):
             attempt_3 = User.authenticate(username="testuser2", password="HASHED_PASSWORD")
             self.assertFalse(attempt_3)
     
+    def test_user_authenticate_rehash(self):
+        with app.app_context():
+            app.config['BCRYPT_LOG_ROUNDS'] = 4
+            try:
+                User.signup(username="testuser1", email="test@test.com", password="HASHED_PASSWORD", image_url=User.image_url.default.arg)
+                db.session.commit()
+
+                u1 = User.query.filter(User.username == "testuser1").first()
+                self.assertEqual(hash_log_rounds(u1.password), 4)
+
+                # Logging in after the cost changes should move the hash to the new cost
+                app.config['BCRYPT_LOG_ROUNDS'] = 5
+                self.assertTrue(User.authenticate(username="testuser1", password="HASHED_PASSWORD"))
+                self.assertEqual(hash_log_rounds(u1.password), 5)
+
+                # The new hash should still accept the password
+                self.assertTrue(User.authenticate(username="testuser1", password="HASHED_PASSWORD"))
+            finally:
+                app.config['BCRYPT_LOG_ROUNDS'] = 12
+
+    def test_calibrate_log_rounds(self):
+        # No cost can hash in 0ms, so calibration should settle on the minimum
+        log_rounds, timings = calibrate_log_rounds(0, min_rounds=4, max_rounds=6, samples=1)
+        self.assertEqual(log_rounds, 4)
+        self.assertEqual(list(timings), [4])
+
     def test_user_update(self):
         with app.app_context():
             u1 = User.signup(username="testuser1", email="test@test.com", password="HASHED_PASSWORD", image_url=User.image_url.default.arg)
@@ -167,4 +329,96 @@ class UserModelTestCase(TestCase):
         
             # Returns false if user instance has previous email
             prior_user = User.query.filter(User.email == "test@test.com").first()
-            self.assertFalse(prior_user)
\ No newline at end of file
+            self.assertFalse(prior_user)
+
+    def test_user_counters(self):
+        with app.app_context():
+            u1 = User(email="test@test.com", username="testuser1", password="HASHED_PASSWORD")
+            u2 = User(email="example@test.com", username="testuser2", password="something")
+            db.session.add_all([u1, u2])
+            db.session.commit()
+
+            db.session.add(Follows(user_being_followed_id=u2.id, user_following_id=u1.id))
+            db.session.add(Message(text="Counted.", user_id=u2.id))
+            db.session.commit()
+
+            # Follows and messages should be counted as they are added
+            self.assertEqual(u1.following_count, 1)
+            self.assertEqual(u2.followers_count, 1)
+            self.assertEqual(u2.messages_count, 1)
+
+            db.session.delete(Follows.query.filter(Follows.user_following_id == u1.id).first())
+            db.session.commit()
+
+            # Removing a follow should decrement both sides
+            self.assertEqual(u1.following_count, 0)
+            self.assertEqual(u2.followers_count, 0)
+
+            # Reconciling should repair counters that have drifted
+            u2.messages_count = 7
+            db.session.commit()
+            self.assertEqual(User.reconcile_counts(), 1)
+            self.assertEqual(u2.messages_count, 1)
+
+    def test_hashing_pool_saturated(self):
+        pool = HashingPool(workers=1, queue_depth=0)
+        started = Event()
+        release = Event()
+
+        def slow_hash():
+            started.set()
+            release.wait(5)
+            return "hashed"
+
+        # Occupy the only worker from another request thread
+        request_thread = ThreadPoolExecutor(max_workers=1)
+        blocker = request_thread.submit(pool.run, slow_hash)
+        started.wait(5)
+
+        # With no room to queue, the next hash is rejected immediately
+        with self.assertLogs('warbler.hashing', 'WARNING') as logs:
+            with self.assertRaises(HashingPoolSaturated):
+                pool.run(len, "password")
+        self.assertIn('"rejected": 1', logs.output[0])
+        self.assertEqual(pool.stats()['rejected'], 1)
+
+        release.set()
+        self.assertEqual(blocker.result(5), "hashed")
+        request_thread.shutdown()
+
+        # Once the worker is free, hashing succeeds again
+        self.assertEqual(pool.run(len, "password"), 8)
+        self.assertEqual(pool.stats()['completed'], 2)
+
+    def test_compute_suggestions(self):
+        """Suggestions should be friends of friends ranked by how many
+        friends they share, without self, existing follows or deactivated users."""
+
+        with app.app_context():
+            users = [User(email=f"user{i}@test.com", username=f"user{i}", password="password")
+                     for i in range(6)]
+            db.session.add_all(users)
+            db.session.commit()
+            a, b, c, d, e, f = [user.id for user in users]
+
+            for follower, followed in [(a, b), (a, c), (b, d), (c, d), (c, e), (b, a), (c, f), (d, a)]:
+                db.session.add(Follows(user_following_id=follower, user_being_followed_id=followed))
+            db.session.commit()
+            User.deactivate(f)
+
+            # One user per batch, to cover batching
+            with patch('suggestions.PATH_BUDGET', 1):
+                summary = compute_suggestions()
+
+            ranked = [(suggestion.suggested_id, suggestion.shared)
+                      for suggestion in Suggestion.query.filter_by(user_id=a).order_by(Suggestion.rank)]
+            self.assertEqual(ranked, [(d, 2), (e, 1)])
+
+            # b follows a and d; a follows c, d follows nobody new
+            self.assertEqual([suggestion.suggested_id for suggestion in Suggestion.for_user(b, limit=5)], [c])
+            self.assertEqual(summary['suggestions'], Suggestion.query.count())
+
+            # Following a suggestion hides it before the job runs again
+            db.session.add(Follows(user_following_id=a, user_being_followed_id=d))
+            db.session.commit()
+            self.assertEqual([suggestion.suggested_id for suggestion in Suggestion.for_user(a, limit=5)], [e])
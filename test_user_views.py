@@ -1,7 +1,22 @@
 import os
+import shutil
+import tempfile
+from datetime import datetime
+from time import sleep
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Follows, Likes
+from flask import session
+from sqlalchemy import event
+
+from assets import assets, build_assets, STATIC_DIR
+from models import db, connect_db, AccountPurge, LoginFailure, Message, User, Follows, Likes
+from followgraph import follow_graph
+from fragments import fragment_cache
+from likecounts import like_counter
+from search import username_index
+from suggestions import compute_suggestions
+from throttle import DatabaseStore, login_throttle, LoginThrottle, MemoryStore
+from usercache import user_cache
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
@@ -12,6 +27,19 @@ with app.app_context():
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any request that goes over its route's SQL statement budget
+app.config['SQL_BUDGET_STRICT'] = True
+
+# Purge deleted accounts inside the request, so tests can check the result
+app.config['ACCOUNT_PURGE_BACKGROUND'] = False
+
+# Build the follow graph in the request that needs it, so tests see it straight away
+app.config['FOLLOW_GRAPH_BACKGROUND'] = False
+
+# Like counts are flushed by the tests themselves; a background flush
+# landing mid-test would race their checks of the pending tally
+like_counter.interval = 3600
+
 class UserViewTestCase(TestCase):
     
     def setUp(self):
@@ -20,6 +48,11 @@ class UserViewTestCase(TestCase):
             Message.query.delete()
             Follows.query.delete()
             Likes.query.delete()
+            AccountPurge.query.delete()
+            # Ids are reused after the deletes above; drop cards rendered and
+            # likes tallied for old rows
+            fragment_cache.clear()
+            like_counter.reset()
 
             self.client = app.test_client()
 
@@ -44,10 +77,10 @@ class UserViewTestCase(TestCase):
 
             testuser_extract3 = User.query.filter(User.username == "testuser3").first()
             
-            message_1 = Message(text="First message.", timestamp=Message.timestamp.default.arg, user_id=testuser_extract1.id)
-            message_2 = Message(text="Second message.", timestamp=Message.timestamp.default.arg, user_id=testuser_extract1.id)
-            message_3 = Message(text="First other message.", timestamp=Message.timestamp.default.arg, user_id=testuser_extract2.id)
-            message_4 = Message(text="Yet another message.", timestamp=Message.timestamp.default.arg, user_id=testuser_extract3.id)
+            message_1 = Message(text="First message.", timestamp=datetime.utcnow(), user_id=testuser_extract1.id)
+            message_2 = Message(text="Second message.", timestamp=datetime.utcnow(), user_id=testuser_extract1.id)
+            message_3 = Message(text="First other message.", timestamp=datetime.utcnow(), user_id=testuser_extract2.id)
+            message_4 = Message(text="Yet another message.", timestamp=datetime.utcnow(), user_id=testuser_extract3.id)
 
             db.session.add(message_1)
             db.session.add(message_2)
@@ -99,6 +132,235 @@ class UserViewTestCase(TestCase):
             # response should not display non-existent accounts
             self.assertNotIn("testuser6", html)
     
+    def test_search_users(self):
+        """Searching should list matching users, most relevant first, and treat
+        LIKE wildcards in the search term literally."""
+
+        with app.app_context():
+            current_user = User.query.filter(User.username == "testuser").first()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = current_user.id
+
+            resp1 = c.get("/users?q=user3")
+            html1 = resp1.get_data(as_text=True)
+
+            # Only users whose name contains the term should be listed
+            self.assertEqual(resp1.status_code, 200)
+            self.assertIn("@testuser3", html1)
+            self.assertNotIn("@testuser2", html1)
+
+            resp2 = c.get("/users?q=testuser")
+            html2 = resp2.get_data(as_text=True)
+
+            # An exact match should be listed before longer usernames
+            self.assertLess(html2.index("@testuser<"), html2.index("@testuser2<"))
+
+            resp3 = c.get("/users?q=%25")
+            html3 = resp3.get_data(as_text=True)
+
+            # A '%' is searched for literally, not as a wildcard
+            self.assertIn("Sorry, no users found", html3)
+
+    def test_users_typeahead(self):
+        """Typeahead should return users whose username starts with the term."""
+
+        username_index.reset()
+
+        resp = self.client.get("/users/typeahead?q=TestUser")
+
+        # Matching is case-insensitive and in alphabetical order
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([user["username"] for user in resp.json], ["testuser", "testuser2", "testuser3"])
+
+        resp2 = self.client.get("/users/typeahead?q=nobody")
+        self.assertEqual(resp2.json, [])
+
+        # Renames reach the index when they commit, and never if rolled back
+        with app.app_context():
+            user = User.query.filter(User.username == "testuser3").first()
+            user.username = "nobody"
+            db.session.flush()
+            self.assertEqual(username_index.prefix("nobody"), [])
+            db.session.rollback()
+        self.assertEqual(self.client.get("/users/typeahead?q=nobody").json, [])
+
+        with app.app_context():
+            user = User.query.filter(User.username == "testuser3").first()
+            user.username = "nobody"
+            db.session.commit()
+        self.assertEqual([user["username"] for user in self.client.get("/users/typeahead?q=nobody").json], ["nobody"])
+        self.assertEqual([user["username"] for user in self.client.get("/users/typeahead?q=TestUser").json],
+                         ["testuser", "testuser2"])
+
+    def test_current_user_cache(self):
+        """The logged-in user should be loaded once and reused across requests
+        until their profile changes."""
+
+        with app.app_context():
+            current_user = User.query.filter(User.username == "testuser").first()
+            current_user_id = current_user.id
+
+        user_cache.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = current_user_id
+
+            resp1 = c.get("/users/profile")
+            resp2 = c.get("/users/profile")
+
+            # The second request should be served the cached user (one query fewer)
+            self.assertEqual(int(resp2.headers["X-SQL-Queries"]), int(resp1.headers["X-SQL-Queries"]) - 1)
+
+            with app.app_context():
+                User.update_user(user_id=current_user_id, username="renameduser", email=None, image_url=None, header_image_url=None, bio=None)
+
+            resp3 = c.get("/")
+
+            # Updating the profile should invalidate the cached user
+            self.assertIn("@renameduser", resp3.get_data(as_text=True))
+
+    def test_user_cache_invalidated_on_commit(self):
+        """Cached users should only be invalidated once a change commits."""
+
+        with app.app_context():
+            current_user = User.query.filter(User.username == "testuser").first()
+            current_user_id = current_user.id
+
+            user_cache.clear()
+            cached = user_cache.get(current_user_id)
+
+            # A flushed but uncommitted change leaves the entry alone...
+            current_user.bio = "Flushed, not committed."
+            db.session.flush()
+            self.assertIs(user_cache.get(current_user_id), cached)
+
+            # ...and so does rolling it back
+            db.session.rollback()
+            self.assertIs(user_cache.get(current_user_id), cached)
+
+            current_user = db.session.get(User, current_user_id)
+            current_user.bio = "Committed."
+            db.session.commit()
+            self.assertEqual(user_cache.get(current_user_id).bio, "Committed.")
+
+    def test_login_rehash(self):
+        """Logging in should work when the stored hash is rehashed to a new cost."""
+
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+
+        try:
+            with self.client as c:
+                resp = c.post("/login", data={"username": "testuser", "password": "testuser"})
+                self.assertEqual(resp.status_code, 302)
+                self.assertIn(CURR_USER_KEY, session)
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = 12
+
+    def test_login_throttle(self):
+        """Repeated failed logins should be refused without checking the
+        password, until the failures age out of the window."""
+
+        login_throttle.store = MemoryStore()
+        login_throttle.configure(window=1, username_limit=2, ip_limit=50)
+
+        try:
+            with self.client as c:
+                for _ in range(2):
+                    resp = c.post("/login", data={"username": "testuser", "password": "wrong password"})
+                    self.assertEqual(resp.status_code, 200)
+
+                # Even the right password is refused once the limit is hit
+                resp = c.post("/login", data={"username": "testuser", "password": "testuser"})
+                self.assertEqual(resp.status_code, 429)
+                self.assertIn("Retry-After", resp.headers)
+                self.assertNotIn(CURR_USER_KEY, session)
+                self.assertEqual(login_throttle.stats()['blocked'], 1)
+
+                # Once the failures age out, logging in works again
+                sleep(1.1)
+                resp = c.post("/login", data={"username": "testuser", "password": "testuser"})
+                self.assertEqual(resp.status_code, 302)
+                self.assertIn(CURR_USER_KEY, session)
+        finally:
+            login_throttle.store = MemoryStore()
+            login_throttle.configure(window=app.config['LOGIN_THROTTLE_WINDOW'],
+                                     username_limit=app.config['LOGIN_THROTTLE_USERNAME_LIMIT'],
+                                     ip_limit=app.config['LOGIN_THROTTLE_IP_LIMIT'])
+
+    def test_login_throttle_database_store(self):
+        """The database store should share failures between throttles, as
+        between processes, and keep only the newest `keep` per key."""
+
+        store = DatabaseStore()
+        other_process = LoginThrottle(store=store, window=60, username_limit=2, ip_limit=50)
+        login_throttle.configure(window=60, username_limit=2, ip_limit=50, store=store)
+
+        try:
+            with app.app_context():
+                for stamp in (1.0, 2.0, 3.0):
+                    store.record("user:someone", stamp, 2)
+                self.assertEqual(store.timestamps("user:someone"), [2.0, 3.0])
+                store.expire(2.5)
+                self.assertEqual(store.timestamps("user:someone"), [3.0])
+                store.clear("user:someone")
+                self.assertEqual(store.timestamps("user:someone"), [])
+
+            with self.client as c:
+                for _ in range(2):
+                    c.post("/login", data={"username": "testuser", "password": "wrong password"})
+
+                # Another process sees the failures, whatever address it's asked about
+                with app.app_context():
+                    self.assertGreater(other_process.check("testuser", "10.0.0.1"), 0)
+
+                resp = c.post("/login", data={"username": "testuser", "password": "testuser"})
+                self.assertEqual(resp.status_code, 429)
+        finally:
+            with app.app_context():
+                LoginFailure.query.delete()
+                db.session.commit()
+            login_throttle.configure(window=app.config['LOGIN_THROTTLE_WINDOW'],
+                                     username_limit=app.config['LOGIN_THROTTLE_USERNAME_LIMIT'],
+                                     ip_limit=app.config['LOGIN_THROTTLE_IP_LIMIT'],
+                                     store=MemoryStore())
+
+    def test_profile_password_throttle(self):
+        """Wrong passwords on the edit profile form count as failed logins."""
+
+        login_throttle.configure(window=60, username_limit=2, ip_limit=50, store=MemoryStore())
+
+        with app.app_context():
+            current_user_id = User.query.filter(User.username == "testuser").first().id
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = current_user_id
+
+                for _ in range(2):
+                    resp = c.post("/users/profile", data={"password": "wrong password", "bio": "Guessed."})
+                    self.assertEqual(resp.status_code, 302)
+
+                # Even the right password is refused once the limit is hit
+                resp = c.post("/users/profile", data={"password": "testuser", "bio": "Guessed."})
+                self.assertEqual(resp.status_code, 429)
+                self.assertIn("Retry-After", resp.headers)
+
+                # And so are logins as the same user
+                resp = c.post("/login", data={"username": "testuser", "password": "testuser"})
+                self.assertEqual(resp.status_code, 429)
+
+            with app.app_context():
+                self.assertIsNone(User.query.filter(User.bio == "Guessed.").first())
+        finally:
+            login_throttle.configure(window=app.config['LOGIN_THROTTLE_WINDOW'],
+                                     username_limit=app.config['LOGIN_THROTTLE_USERNAME_LIMIT'],
+                                     ip_limit=app.config['LOGIN_THROTTLE_IP_LIMIT'],
+                                     store=MemoryStore())
+
     def test_show_user_profile(self):
         """If logged in, displays a page of the user's profile.
         The profile should show every message created by the user.
@@ -147,6 +409,194 @@ class UserViewTestCase(TestCase):
             self.assertNotIn("Edit Profile", html2)
             self.assertNotIn("Delete Profile", html2)
     
+    def test_profile_pagination(self):
+        """Profiles should show one page of messages at a time, with a cursor
+        link to the next (older) page."""
+
+        with app.app_context():
+            current_user = User.query.filter(User.username == "testuser").first()
+            current_user_id = current_user.id
+
+            for i in range(25):
+                db.session.add(Message(text=f"Paged message #{i}.", timestamp=datetime.utcnow(), user_id=current_user_id))
+            db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = current_user_id
+
+            resp1 = c.get(f"/users/{current_user_id}")
+            html1 = resp1.get_data(as_text=True)
+
+            # The first page should hold the newest messages and link to the next page
+            self.assertEqual(resp1.status_code, 200)
+            self.assertIn("Paged message #24.", html1)
+            self.assertNotIn("Paged message #4.", html1)
+            self.assertIn("?before=", html1)
+
+            cursor = html1.split("?before=")[1].split('"')[0]
+            resp2 = c.get(f"/users/{current_user_id}?before={cursor}")
+            html2 = resp2.get_data(as_text=True)
+
+            # The second page should pick up where the first one stopped
+            self.assertEqual(resp2.status_code, 200)
+            self.assertIn("Paged message #4.", html2)
+            self.assertIn("First message.", html2)
+            self.assertNotIn("Paged message #24.", html2)
+            self.assertNotIn("?before=", html2)
+
+            # A malformed cursor should be rejected
+            resp3 = c.get(f"/users/{current_user_id}?before=not-a-cursor")
+            self.assertEqual(resp3.status_code, 400)
+
+    def test_message_list_query_budget(self):
+        """Message lists should load their authors and the viewer's liked state
+        in a fixed number of SQL statements, however many authors are on the page."""
+
+        with app.app_context():
+            current_user = User.query.filter(User.username == "testuser").first()
+            current_user_id = current_user.id
+
+            for i in range(15):
+                author = User(username=f"author{i}", email=f"author{i}@test.com", password="password")
+                db.session.add(author)
+                db.session.commit()
+
+                message = Message(text=f"Author message #{i}.", timestamp=datetime.utcnow(), user_id=author.id)
+                db.session.add(message)
+                db.session.add(Follows(user_being_followed_id=author.id, user_following_id=current_user_id))
+                db.session.commit()
+
+                db.session.add(Likes(user_id=current_user_id, message_id=message.id))
+                db.session.commit()
+
+            engine = db.engine
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", count_statement)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = current_user_id
+
+                pages = [("/", "Author message #14."),
+                         (f"/users/{current_user_id}", "First message."),
+                         (f"/users/{current_user_id}/likes", "Author message #14.")]
+
+                for url, expected in pages:
+                    statements.clear()
+                    resp = c.get(url)
+
+                    # Each page should render every author without a query per message
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertIn(expected, resp.get_data(as_text=True))
+                    self.assertLessEqual(len(statements), 10, f"{url} issued {len(statements)} statements")
+        finally:
+            event.remove(engine, "before_cursor_execute", count_statement)
+
+    def test_liked_state_for_page_only(self):
+        """Pages should look up the viewer's likes for the messages shown,
+        never load every like the viewer or profile owner has made."""
+
+        with app.app_context():
+            current_user = User.query.filter(User.username == "testuser").first()
+            other_user = User.query.filter(User.username == "testuser2").first()
+            current_user_id, other_user_id = current_user.id, other_user.id
+
+            liked = Message.query.filter(Message.text == "First other message.").first()
+            unliked = Message(text="Not liked yet.", timestamp=datetime.utcnow(), user_id=other_user_id)
+            db.session.add(unliked)
+            db.session.commit()
+            liked_id, unliked_id = liked.id, unliked.id
+
+            engine = db.engine
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", count_statement)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = current_user_id
+
+                urls = [f"/users/{other_user_id}", f"/users/{other_user_id}/likes",
+                        f"/users/{other_user_id}/following", f"/users/{other_user_id}/followers",
+                        f"/users/{current_user_id}/likes", f"/messages/{liked_id}"]
+                for url in urls:
+                    statements.clear()
+                    self.assertEqual(c.get(url).status_code, 200)
+
+                    for statement in statements:
+                        if "FROM likes" in statement:
+                            self.assertTrue(" IN (" in statement or "count(" in statement,
+                                            f"{url} ran {statement}")
+
+                # The profile's Likes stat is a count, not a list
+                html = c.get(f"/users/{current_user_id}").get_data(as_text=True)
+                self.assertIn(f'<a href="/users/{current_user_id}/likes">1</a>', html)
+
+                self.assertIn(f"/users/remove_like/{liked_id}", c.get(f"/messages/{liked_id}").get_data(as_text=True))
+                self.assertIn(f"/users/add_like/{unliked_id}", c.get(f"/messages/{unliked_id}").get_data(as_text=True))
+                self.assertEqual(c.get("/messages/999999").status_code, 404)
+
+            # Logged out, the message page still renders, without like buttons
+            with app.test_client() as anonymous:
+                resp = anonymous.get(f"/messages/{liked_id}")
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotIn("/users/add_like/", resp.get_data(as_text=True))
+        finally:
+            event.remove(engine, "before_cursor_execute", count_statement)
+
+    def test_user_list_query_budget(self):
+        """User lists should check the viewer's follows with one query,
+        not one per user card."""
+
+        with app.app_context():
+            current_user = User.query.filter(User.username == "testuser").first()
+            current_user_id = current_user.id
+
+            for i in range(15):
+                other = User(username=f"listed{i}", email=f"listed{i}@test.com", password="password")
+                db.session.add(other)
+                db.session.commit()
+
+                db.session.add(Follows(user_being_followed_id=other.id, user_following_id=current_user_id))
+                db.session.add(Follows(user_being_followed_id=current_user_id, user_following_id=other.id))
+                db.session.commit()
+
+            engine = db.engine
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", count_statement)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = current_user_id
+
+                for url in ["/users", f"/users/{current_user_id}/following", f"/users/{current_user_id}/followers"]:
+                    statements.clear()
+                    resp = c.get(url)
+
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertIn("@listed14", resp.get_data(as_text=True))
+                    self.assertLessEqual(len(statements), 10, f"{url} issued {len(statements)} statements")
+        finally:
+            event.remove(engine, "before_cursor_execute", count_statement)
+
     def test_following_page(self):
         """If logged on, should display a page of all the accounts the user is following.
         If it is the profile of the current_user, it should allow the user to unfollow an account."""
@@ -446,4 +896,325 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 302)
 
             # The user account should no longer be present
-            self.assertFalse(User.query.filter(User.username == "testuser").first())
\ No newline at end of file
+            self.assertFalse(User.query.filter(User.username == "testuser").first())
+
+    def test_delete_profile_purges_in_batches(self):
+        """Deleting a profile removes its follows, likes and messages a batch
+        at a time and releases the other side's follow counters."""
+
+        app.config['ACCOUNT_PURGE_BATCH_SIZE'] = 1
+
+        with app.app_context():
+            current_user = User.query.filter(User.username == "testuser").first()
+            other_user = User.query.filter(User.username == "testuser2").first()
+            current_id, other_id = current_user.id, other_user.id
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = current_id
+
+                resp = c.post("/users/delete")
+                self.assertEqual(resp.status_code, 302)
+
+                # The session should be logged out
+                self.assertNotIn(CURR_USER_KEY, session)
+        finally:
+            app.config['ACCOUNT_PURGE_BATCH_SIZE'] = 1000
+
+        with app.app_context():
+            purge = db.session.get(AccountPurge, current_id)
+            self.assertIsNotNone(purge.finished_at)
+            self.assertEqual((purge.follows_deleted, purge.likes_deleted, purge.messages_deleted), (2, 1, 2))
+
+            self.assertIsNone(db.session.get(User, current_id))
+            self.assertEqual(Message.query.filter(Message.user_id == current_id).count(), 0)
+            self.assertEqual(Follows.query.count(), 0)
+
+            # testuser2's like of testuser's message went with the message
+            self.assertEqual(Likes.query.count(), 0)
+
+            other_user = db.session.get(User, other_id)
+            self.assertEqual((other_user.following_count, other_user.followers_count), (0, 0))
+
+    def test_deactivated_user_hidden(self):
+        """A deactivated account can't log in or be viewed, even before it's purged."""
+
+        username_index.reset()
+        self.assertIn("testuser", [user["username"] for user in self.client.get("/users/typeahead?q=testuser").json])
+
+        with app.app_context():
+            current_id = User.query.filter(User.username == "testuser").first().id
+            other_id = User.query.filter(User.username == "testuser2").first().id
+            message_id = Message.query.filter(Message.text == "First message.").first().id
+            User.deactivate(current_id)
+
+        # Searches, follow lists and messages leave the account out
+        self.assertEqual([user["username"] for user in self.client.get("/users/typeahead?q=testuser").json],
+                         ["testuser2", "testuser3"])
+        username_index.reset()
+        self.assertEqual([user["username"] for user in self.client.get("/users/typeahead?q=testuser").json],
+                         ["testuser2", "testuser3"])
+        self.assertNotIn("@testuser<", self.client.get("/users?q=testuser").get_data(as_text=True))
+        self.assertEqual(self.client.get(f"/messages/{message_id}").status_code, 404)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+            self.assertNotIn("@testuser<", c.get(f"/users/{other_id}/followers").get_data(as_text=True))
+            self.assertNotIn("@testuser<", c.get(f"/users/{other_id}/following").get_data(as_text=True))
+            with c.session_transaction() as sess:
+                del sess[CURR_USER_KEY]
+
+        with self.client as c:
+            resp = c.post("/login", data={"username": "testuser", "password": "testuser"})
+            self.assertIn("Invalid credentials.", resp.get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = current_id
+
+            # An existing session no longer counts as logged in
+            resp = c.get("/")
+            self.assertIn("Sign up", resp.get_data(as_text=True))
+
+            resp = c.get(f"/users/{current_id}")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_profile_known_followers(self):
+        """A profile should show how many people the viewer follows follow
+        its user, from the in-memory follow graph."""
+
+        with app.app_context():
+            current_id = User.query.filter(User.username == "testuser").first().id
+            other_id = User.query.filter(User.username == "testuser2").first().id
+            third_id = User.query.filter(User.username == "testuser3").first().id
+
+        follow_graph.reset()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = current_id
+
+            resp = c.get(f"/users/{third_id}")
+            self.assertNotIn("you follow", resp.get_data(as_text=True))
+
+            with app.app_context():
+                db.session.add(Follows(user_being_followed_id=third_id, user_following_id=other_id))
+                db.session.commit()
+
+            resp = c.get(f"/users/{third_id}")
+            self.assertIn("Followed by 1 person you follow", resp.get_data(as_text=True))
+
+    def test_homepage_suggestions(self):
+        """The homepage should show the viewer's precomputed suggestions."""
+
+        with app.app_context():
+            current_id = User.query.filter(User.username == "testuser").first().id
+            other_id = User.query.filter(User.username == "testuser2").first().id
+            third_id = User.query.filter(User.username == "testuser3").first().id
+
+            db.session.add(Follows(user_being_followed_id=third_id, user_following_id=other_id))
+            db.session.commit()
+            compute_suggestions()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = current_id
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("Who to follow", html)
+            self.assertIn(f'action="/users/follow/{third_id}"', html)
+
+    def test_message_card_cache(self):
+        """Message cards should be rendered once and reused until the author,
+        the viewer's like or the like count changes."""
+
+        with app.app_context():
+            current_user_id = User.query.filter(User.username == "testuser").first().id
+            other_user_id = User.query.filter(User.username == "testuser2").first().id
+            third_user_id = User.query.filter(User.username == "testuser3").first().id
+            message_id = Message.query.filter(Message.text == "First other message.").first().id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = current_user_id
+
+            html1 = c.get("/").get_data(as_text=True)
+            misses = fragment_cache.misses
+            hits = fragment_cache.hits
+
+            # A second render is served entirely from the cache
+            html2 = c.get("/").get_data(as_text=True)
+            self.assertEqual(html2, html1)
+            self.assertEqual(fragment_cache.misses, misses)
+            self.assertGreater(fragment_cache.hits, hits)
+            self.assertIn(f"/users/remove_like/{message_id}", html2)
+
+            # The like count is filled in fresh on every render
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = third_user_id
+            c.post(f"/users/add_like/{message_id}")
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = current_user_id
+            self.assertIn('<i class="fa fa-thumbs-up"></i> 2', c.get("/").get_data(as_text=True))
+
+            # Editing the author's profile re-renders their cards
+            with app.app_context():
+                User.update_user(user_id=other_user_id, username="renamed2", email=None, image_url=None,
+                                 header_image_url=None, bio=None)
+            self.assertIn("@renamed2", c.get("/").get_data(as_text=True))
+
+            # So does the viewer's like changing
+            c.post(f"/users/remove_like/{message_id}")
+            self.assertIn(f"/users/add_like/{message_id}", c.get("/").get_data(as_text=True))
+
+    def test_conditional_get(self):
+        """Timelines, profiles and message pages should answer a matching
+        revalidation with a 304, without reading the page's data."""
+
+        with app.app_context():
+            current_user_id = User.query.filter(User.username == "testuser").first().id
+            other_user_id = User.query.filter(User.username == "testuser2").first().id
+            message_id = Message.query.filter(Message.text == "Yet another message.").first().id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = current_user_id
+
+            resp1 = c.get("/")
+            etag = resp1.headers["ETag"]
+            self.assertEqual(resp1.headers["Cache-Control"], "private, no-cache")
+
+            resp2 = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp2.status_code, 304)
+            self.assertEqual(resp2.get_data(), b"")
+            self.assertLess(int(resp2.headers["X-SQL-Queries"]), int(resp1.headers["X-SQL-Queries"]))
+
+            # Liking something on the page changes it
+            with app.app_context():
+                liked_id = Message.query.filter(Message.text == "First other message.").first().id
+            c.post(f"/users/remove_like/{liked_id}")
+            self.assertEqual(c.get("/", headers={"If-None-Match": etag}).status_code, 200)
+
+            # A page with a flash pending is always rendered in full, uncached
+            etag = c.get("/").headers["ETag"]
+            c.post(f"/users/remove_like/{liked_id}")
+            resp3 = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp3.status_code, 200)
+            self.assertIn("originally liked", resp3.get_data(as_text=True))
+            self.assertNotIn("ETag", resp3.headers)
+            self.assertIn("no-store", resp3.headers["Cache-Control"])
+
+            # A followed author editing their profile changes it
+            etag = c.get("/").headers["ETag"]
+            with app.app_context():
+                User.update_user(user_id=other_user_id, username="renamed", email=None, image_url=None,
+                                 header_image_url=None, bio=None)
+            self.assertEqual(c.get("/", headers={"If-None-Match": etag}).status_code, 200)
+
+            # So does deleting one of their older messages
+            with app.app_context():
+                older = Message(text="Older message.", timestamp=datetime(2020, 1, 1), user_id=other_user_id)
+                db.session.add(older)
+                db.session.commit()
+                older_id = older.id
+            etag = c.get("/").headers["ETag"]
+            with app.app_context():
+                db.session.delete(db.session.get(Message, older_id))
+                db.session.commit()
+            self.assertEqual(c.get("/", headers={"If-None-Match": etag}).status_code, 200)
+
+            # Profiles are validated by ETag only; a date alone never gets a 304
+            resp4 = c.get(f"/users/{other_user_id}")
+            self.assertNotIn("Last-Modified", resp4.headers)
+            self.assertEqual(c.get(f"/users/{other_user_id}",
+                                   headers={"If-None-Match": resp4.headers["ETag"]}).status_code, 304)
+            self.assertEqual(c.get(f"/users/{other_user_id}",
+                                   headers={"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"}).status_code, 200)
+
+            # Following the profile's owner changes the profile as the viewer sees it
+            with app.app_context():
+                db.session.add(Follows(user_being_followed_id=User.query.filter(User.username == "testuser3").first().id,
+                                       user_following_id=current_user_id))
+                db.session.commit()
+            self.assertEqual(c.get(f"/users/{other_user_id}",
+                                   headers={"If-None-Match": resp4.headers["ETag"]}).status_code, 200)
+
+            resp5 = c.get(f"/messages/{message_id}")
+            self.assertNotIn("Last-Modified", resp5.headers)
+            self.assertEqual(c.get(f"/messages/{message_id}",
+                                   headers={"If-None-Match": resp5.headers["ETag"]}).status_code, 304)
+
+        # Another viewer never matches
+        resp6 = app.test_client().get(f"/messages/{message_id}", headers={"If-None-Match": resp5.headers["ETag"]})
+        self.assertEqual(resp6.status_code, 200)
+
+    def test_like_counts(self):
+        """Several users can like one message, each once, and its like count
+        is written in batches."""
+
+        with app.app_context():
+            message = Message.query.filter(Message.text == "First message.").first()
+            message_id = message.id
+            other_id = User.query.filter(User.username == "testuser3").first().id
+
+            like_counter.flush()
+            Message.reconcile_like_counts()
+            self.assertEqual(db.session.get(Message, message_id).like_count, 1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+
+            # A double submit shouldn't fail or count twice
+            self.assertEqual(c.post(f"/users/add_like/{message_id}").status_code, 302)
+            self.assertEqual(c.post(f"/users/add_like/{message_id}").status_code, 302)
+            self.assertEqual(Likes.query.filter(Likes.message_id == message_id).count(), 2)
+
+            # Until the flush, only this process's tally knows about the like
+            self.assertEqual(like_counter.pending(message_id), 1)
+            self.assertIn('<i class="fa fa-thumbs-up"></i> 2', c.get(f"/messages/{message_id}").get_data(as_text=True))
+
+            like_counter.flush()
+            self.assertEqual(like_counter.pending(message_id), 0)
+            self.assertEqual(db.session.get(Message, message_id).like_count, 2)
+
+            c.post(f"/users/remove_like/{message_id}")
+            like_counter.flush()
+            self.assertEqual(db.session.get(Message, message_id).like_count, 1)
+
+    def test_fingerprinted_assets(self):
+        """Built assets should be linked by hashed name and served
+        precompressed with year-long immutable caching."""
+
+        with tempfile.TemporaryDirectory() as directory:
+            static_dir = os.path.join(directory, 'static')
+            shutil.copytree(STATIC_DIR, static_dir, ignore=shutil.ignore_patterns('dist'))
+            manifest = build_assets(static_dir)
+            assets.load(static_dir)
+
+            try:
+                html = self.client.get("/").get_data(as_text=True)
+                stylesheet = f"/static/dist/{manifest['stylesheets/style.css']}"
+                self.assertIn(f'href="{stylesheet}"', html)
+
+                resp1 = self.client.get(stylesheet, headers={"Accept-Encoding": "gzip"})
+                self.assertEqual(resp1.headers["Content-Encoding"], "gzip")
+                self.assertEqual(resp1.mimetype, "text/css")
+                self.assertEqual(resp1.headers["Cache-Control"], "public, max-age=31536000, immutable")
+
+                # Urls inside the stylesheet point at hashed files too
+                resp2 = self.client.get(stylesheet)
+                self.assertNotIn("Content-Encoding", resp2.headers)
+                self.assertIn(f"/static/dist/{manifest['images/nav-bg.png']}", resp2.get_data(as_text=True))
+
+                # Images aren't worth compressing
+                resp3 = self.client.get(f"/static/dist/{manifest['images/warbler-logo.png']}",
+                                        headers={"Accept-Encoding": "gzip, br"})
+                self.assertEqual(resp3.status_code, 200)
+                self.assertNotIn("Content-Encoding", resp3.headers)
+            finally:
+                assets.load(STATIC_DIR)
+
+        # Without a build, templates fall back to the plain files
+        self.assertIn('href="/static/stylesheets/style.css"', self.client.get("/").get_data(as_text=True))
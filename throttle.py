@@ -0,0 +1,198 @@
+"""Failed-login throttling.
+
+Every POST to /login with a real username costs a full bcrypt check, so
+credential stuffing turns straight into CPU. ``login()`` asks
+``login_throttle.check()`` first and refuses with a 429 (without
+hashing anything) once a username or client IP has too many recent
+failures.
+
+Failures are counted in a sliding window: a lockout lifts on its own as
+the oldest failures age out, one attempt at a time, rather than all at
+once. A successful login clears the username's failures (but not the
+IP's, so one valid account can't launder attempts on others). Each
+refusal is logged as JSON on the ``warbler.throttle`` logger with the
+running allowed/blocked/failure/success counts.
+
+Failure timestamps live in a store, chosen by the LOGIN_THROTTLE_STORE
+config key. ``MemoryStore`` ('memory') keeps them per process, so with
+several workers each one counts on its own and an attacker gets the
+limits once per worker. ``DatabaseStore`` ('database') keeps them in the
+``login_failures`` table, shared by every process; each check costs a
+query and each failure a short transaction of its own.
+"""
+
+import json
+import logging
+from collections import deque
+from threading import Lock
+from time import time
+
+from sqlalchemy import delete, insert, select
+
+from models import db, LoginFailure
+
+logger = logging.getLogger('warbler.throttle')
+
+# Defaults for the LOGIN_THROTTLE_* config keys.
+WINDOW = 900
+USERNAME_LIMIT = 5
+IP_LIMIT = 50
+
+# Forget keys whose newest failure is older than the window this often.
+PRUNE_INTERVAL = 60
+
+
+class MemoryStore:
+    """Per-process failure timestamps, newest last, per key."""
+
+    def __init__(self):
+        self._failures = {}
+        self._lock = Lock()
+
+    def record(self, key, timestamp, keep):
+        """Add a failure for `key`, keeping only the newest `keep`."""
+
+        with self._lock:
+            failures = self._failures.get(key)
+            if failures is None or failures.maxlen != keep:
+                failures = self._failures[key] = deque(failures or (), maxlen=keep)
+            failures.append(timestamp)
+
+    def timestamps(self, key):
+        with self._lock:
+            return list(self._failures.get(key, ()))
+
+    def clear(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+    def expire(self, before):
+        """Forget every key with no failure since `before`."""
+
+        with self._lock:
+            for key in [key for key, failures in self._failures.items() if failures[-1] < before]:
+                del self._failures[key]
+
+
+class DatabaseStore:
+    """Failure timestamps in the login_failures table, shared by every
+    process.
+
+    Each call runs in its own transaction on its own connection, so
+    recording a failure never commits (or waits on) the request's session.
+    """
+
+    table = LoginFailure.__table__
+
+    def record(self, key, timestamp, keep):
+        """Add a failure for `key`, keeping only the newest `keep`."""
+
+        newest = (select(self.table.c.id)
+                  .where(self.table.c.key == key)
+                  .order_by(self.table.c.failed_at.desc())
+                  .limit(keep))
+
+        with db.engine.begin() as connection:
+            connection.execute(insert(self.table).values(key=key, failed_at=timestamp))
+            connection.execute(delete(self.table)
+                               .where(self.table.c.key == key)
+                               .where(self.table.c.id.not_in(newest.scalar_subquery())))
+
+    def timestamps(self, key):
+        with db.engine.connect() as connection:
+            return list(connection.scalars(select(self.table.c.failed_at)
+                                           .where(self.table.c.key == key)
+                                           .order_by(self.table.c.failed_at)))
+
+    def clear(self, key):
+        with db.engine.begin() as connection:
+            connection.execute(delete(self.table).where(self.table.c.key == key))
+
+    def expire(self, before):
+        """Forget every failure older than `before` (which forgets every
+        key with none since)."""
+
+        with db.engine.begin() as connection:
+            connection.execute(delete(self.table).where(self.table.c.failed_at < before))
+
+
+# Values of the LOGIN_THROTTLE_STORE config key.
+STORES = {'memory': MemoryStore, 'database': DatabaseStore}
+
+
+class LoginThrottle:
+    """Sliding-window failure limits per username and per client IP."""
+
+    def __init__(self, store=None, window=WINDOW, username_limit=USERNAME_LIMIT, ip_limit=IP_LIMIT):
+        self.store = store or MemoryStore()
+        self.configure(window, username_limit, ip_limit)
+        self._pruned_at = time()
+        self._lock = Lock()
+
+    def configure(self, window, username_limit, ip_limit, store=None):
+        if store is not None:
+            self.store = store
+        self.window = window
+        self.limits = {'user': username_limit, 'ip': ip_limit}
+        self.metrics = {'allowed': 0, 'blocked': 0, 'failures': 0, 'successes': 0}
+
+    def _keys(self, username, ip):
+        return {'user': f"user:{(username or '').lower()}", 'ip': f"ip:{ip}"}
+
+    def _count(self, metric):
+        with self._lock:
+            self.metrics[metric] += 1
+
+    def check(self, username, ip):
+        """Seconds until `username` may try again from `ip`, or 0 if now."""
+
+        now = time()
+        retry_after = 0
+
+        for kind, key in self._keys(username, ip).items():
+            limit = self.limits[kind]
+            recent = [stamp for stamp in self.store.timestamps(key) if stamp > now - self.window]
+            if len(recent) >= limit:
+                # Blocked until enough failures age out to get back under the limit.
+                retry_after = max(retry_after, recent[-limit] + self.window - now)
+
+        if retry_after:
+            self._count('blocked')
+            logger.warning(json.dumps({
+                'event': 'login_throttled',
+                'username': username,
+                'ip': ip,
+                'retry_after': round(retry_after, 1),
+                **self.stats(),
+            }))
+            return max(1, int(retry_after + 0.5))
+
+        self._count('allowed')
+        return 0
+
+    def record_failure(self, username, ip):
+        now = time()
+        for kind, key in self._keys(username, ip).items():
+            self.store.record(key, now, self.limits[kind])
+
+        self._count('failures')
+        self._prune(now)
+
+    def record_success(self, username, ip):
+        self.store.clear(self._keys(username, ip)['user'])
+        self._count('successes')
+
+    def _prune(self, now):
+        with self._lock:
+            if now - self._pruned_at < PRUNE_INTERVAL:
+                return
+            self._pruned_at = now
+
+        self.store.expire(now - self.window)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.metrics)
+
+
+login_throttle = LoginThrottle()
@@ -0,0 +1,380 @@
+"""Home timelines for Warbler.
+
+Timelines are hybrid. Most authors are fanned out on write: every message
+they post is copied into the ``timelines`` table for the author and each
+follower, so a home page is a single range read of that table.
+
+Authors with at least TIMELINE_CELEBRITY_THRESHOLD followers are not
+fanned out, since one post would mean tens of thousands of writes.
+Instead each of them keeps a bounded in-process ring buffer of their
+newest message ids, and ``home_timeline()`` k-way merges the buffers of
+the celebrities a user follows into the precomputed part at read time.
+Buffers are reloaded after AUTHOR_BUFFER_MAX_AGE seconds so posts made
+through other processes show up.
+
+When a follow takes an author up to the threshold, their messages are
+purged from their followers' timelines; when an unfollow takes them back
+below it, every remaining follower is backfilled. Authors sitting right
+at the threshold pay for that on every crossing; ``rebuild_timelines()``
+repairs anything the events missed.
+
+The writes hang off mapper events on ``Message`` and ``Follows`` so they
+run in the same transaction as the change that caused them. Bulk
+``Query.delete()`` calls skip those events; the ``ondelete='cascade'``
+foreign keys on ``timelines`` clean up after them instead.
+"""
+
+import heapq
+from collections import deque
+from itertools import islice
+from threading import Lock
+from time import monotonic
+
+from flask import current_app
+from sqlalchemy import event, exists, func, insert, literal, select, true, union_all
+
+from models import db, Follows, Message, TimelineEntry, User
+from pagination import before_cursor
+
+# How many of a user's most recent messages get copied onto a new
+# follower's timeline (and onto every timeline during a rebuild).
+BACKFILL_LIMIT = 100
+
+# Default for the TIMELINE_CELEBRITY_THRESHOLD config key.
+CELEBRITY_THRESHOLD = 10000
+
+# How many message ids each celebrity's ring buffer holds.
+AUTHOR_BUFFER_SIZE = 200
+
+# Seconds before a ring buffer is reloaded from the database.
+AUTHOR_BUFFER_MAX_AGE = 10
+
+TIMELINE_COLUMNS = ['user_id', 'message_id', 'author_id', 'timestamp']
+
+
+def celebrity_threshold():
+    """Follower count at which an author stops being fanned out on write."""
+
+    return current_app.config.get('TIMELINE_CELEBRITY_THRESHOLD', CELEBRITY_THRESHOLD)
+
+
+def followers_count(connection, user_id):
+    """`user_id`'s followers_count as of this transaction."""
+
+    return connection.execute(select(User.followers_count).where(User.id == user_id)).scalar() or 0
+
+
+def is_celebrity(connection, user_id):
+    """Is `user_id` followed by enough users to be merged on read?"""
+
+    return followers_count(connection, user_id) >= celebrity_threshold()
+
+
+class RecentMessages:
+    """Bounded ring buffers of each celebrity author's newest messages.
+
+    Entries are ``(timestamp, message_id)`` pairs. A buffer is loaded from
+    the database the first time its author is read, then kept current by
+    the message listeners below until it is `max_age` seconds old, when
+    it is reloaded; that picks up posts from other processes and drops
+    pushes whose transaction rolled back. Only the newest `size`
+    messages are kept in memory.
+    """
+
+    def __init__(self, size=AUTHOR_BUFFER_SIZE, max_age=AUTHOR_BUFFER_MAX_AGE):
+        self.size = size
+        self.max_age = max_age
+        self._buffers = {}
+        self._lock = Lock()
+
+    def push(self, author_id, timestamp, message_id):
+        """Record a new message, if `author_id` has a buffer loaded."""
+
+        with self._lock:
+            loaded = self._buffers.get(author_id)
+            if loaded is not None:
+                loaded[0].appendleft((timestamp, message_id))
+
+    def discard(self, author_id, message_id):
+        """Drop a deleted message from its author's buffer."""
+
+        with self._lock:
+            loaded = self._buffers.get(author_id)
+            if loaded is not None:
+                buffer, loaded_at = loaded
+                self._buffers[author_id] = (deque(
+                    (entry for entry in buffer if entry[1] != message_id), maxlen=self.size), loaded_at)
+
+    def forget(self, author_id):
+        """Drop an author's buffer (they're no longer a celebrity)."""
+
+        with self._lock:
+            self._buffers.pop(author_id, None)
+
+    def entries(self, author_id, limit, before=None):
+        """Return up to `limit` of the author's messages older than `before`,
+        newest first.
+
+        Pages that reach past the end of a full buffer are read from the
+        database instead, since older messages have fallen off it.
+        """
+
+        with self._lock:
+            loaded = self._buffers.get(author_id)
+
+        if loaded is None or monotonic() - loaded[1] > self.max_age:
+            buffer = deque(self._load(author_id, self.size), maxlen=self.size)
+            with self._lock:
+                self._buffers[author_id] = (buffer, monotonic())
+        else:
+            buffer = loaded[0]
+
+        entries = sorted(buffer, reverse=True)
+        if before is not None:
+            entries = [entry for entry in entries if entry < before]
+
+        if len(entries) < limit and len(buffer) == self.size:
+            return self._load(author_id, limit, before)
+
+        return entries[:limit]
+
+    def _load(self, author_id, limit, before=None):
+        rows = (db.session.query(Message.timestamp, Message.id)
+                .filter(Message.user_id == author_id)
+                .filter(before_cursor(Message.timestamp, Message.id, before))
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(limit)
+                .all())
+        return [tuple(row) for row in rows]
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+
+
+recent_messages = RecentMessages()
+
+
+@event.listens_for(Message, 'after_insert')
+def fan_out_message(mapper, connection, message):
+    """Copy a new message onto its author's and followers' timelines.
+
+    Celebrity authors only get the author's own row; their followers see
+    the message through the ring buffer instead.
+    """
+
+    author_row = select(
+        literal(message.user_id),
+        literal(message.id),
+        literal(message.user_id),
+        literal(message.timestamp, db.DateTime),
+    )
+
+    if is_celebrity(connection, message.user_id):
+        connection.execute(insert(TimelineEntry).from_select(TIMELINE_COLUMNS, author_row))
+        recent_messages.push(message.user_id, message.timestamp, message.id)
+        return
+
+    follower_rows = (select(
+                        Follows.user_following_id,
+                        literal(message.id),
+                        literal(message.user_id),
+                        literal(message.timestamp, db.DateTime))
+                     .where(Follows.user_being_followed_id == message.user_id)
+                     .where(Follows.user_following_id != message.user_id))
+
+    connection.execute(insert(TimelineEntry).from_select(
+        TIMELINE_COLUMNS, union_all(author_row, follower_rows)))
+
+
+@event.listens_for(Message, 'before_delete')
+def remove_message(mapper, connection, message):
+    """Take a message off every timeline it was copied to."""
+
+    connection.execute(TimelineEntry.__table__.delete().where(
+        TimelineEntry.message_id == message.id))
+    recent_messages.discard(message.user_id, message.id)
+
+
+def backfill(connection, author_id, follower_ids):
+    """Copy the author's newest BACKFILL_LIMIT messages onto the timeline of
+    each user selected by `follower_ids` (a one-column select), skipping
+    any already there."""
+
+    followers = follower_ids.subquery()
+    follower_id = list(followers.c)[0]
+
+    recent = (select(Message.id, Message.user_id, Message.timestamp)
+              .where(Message.user_id == author_id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(BACKFILL_LIMIT)
+              .subquery())
+
+    rows = (select(follower_id, recent.c.id, recent.c.user_id, recent.c.timestamp)
+            .select_from(followers)
+            .join(recent, true())
+            .where(~exists().where((TimelineEntry.user_id == follower_id)
+                                   & (TimelineEntry.message_id == recent.c.id))))
+
+    connection.execute(insert(TimelineEntry).from_select(TIMELINE_COLUMNS, rows))
+
+
+@event.listens_for(Follows, 'after_insert')
+def backfill_follow(mapper, connection, follow):
+    """Copy the followed user's recent messages onto the follower's timeline.
+
+    The counter listener in models.py has already counted this follow, so
+    a count of exactly the threshold means it made the author a
+    celebrity: their messages come off every follower's timeline and are
+    merged on read from now on.
+    """
+
+    author_id = follow.user_being_followed_id
+
+    # A user's own messages are already on their timeline.
+    if follow.user_following_id == author_id:
+        return
+
+    followers = followers_count(connection, author_id)
+    threshold = celebrity_threshold()
+
+    if followers == threshold:
+        connection.execute(TimelineEntry.__table__.delete().where(
+            (TimelineEntry.author_id == author_id) & (TimelineEntry.user_id != author_id)))
+
+    if followers >= threshold:
+        return
+
+    backfill(connection, author_id, select(literal(follow.user_following_id)))
+
+
+@event.listens_for(Follows, 'after_delete')
+def remove_follow(mapper, connection, follow):
+    """Take the unfollowed user's messages off the follower's timeline.
+
+    If this unfollow took the author back below the threshold, their
+    remaining followers are backfilled, since nothing was fanned out to
+    them while the author was a celebrity.
+    """
+
+    author_id = follow.user_being_followed_id
+
+    if follow.user_following_id == author_id:
+        return
+
+    connection.execute(TimelineEntry.__table__.delete().where(
+        (TimelineEntry.user_id == follow.user_following_id)
+        & (TimelineEntry.author_id == author_id)))
+
+    if followers_count(connection, author_id) == celebrity_threshold() - 1:
+        backfill(connection, author_id, (
+            select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == author_id)
+            .where(Follows.user_following_id != author_id)))
+        recent_messages.forget(author_id)
+
+
+def followed_celebrities(user_id):
+    """Ids of the celebrity authors `user_id` follows."""
+
+    return [followed_id for (followed_id,) in (
+        db.session.query(Follows.user_being_followed_id)
+        .join(User, User.id == Follows.user_being_followed_id)
+        .filter(Follows.user_following_id == user_id)
+        .filter(Follows.user_being_followed_id != user_id)
+        .filter(User.followers_count >= celebrity_threshold())
+        .all())]
+
+
+def home_timeline(user_id, limit=100, before=None):
+    """Return the newest `limit` messages on a user's home timeline.
+
+    `before` is an optional `(timestamp, id)` cursor; only messages older
+    than it are returned. The precomputed rows and each followed
+    celebrity's ring buffer are already sorted newest first, so
+    heapq.merge walks them lazily and stops as soon as `limit` distinct
+    messages have been seen.
+    """
+
+    precomputed = (db.session.query(TimelineEntry.timestamp, TimelineEntry.message_id)
+                   .filter(TimelineEntry.user_id == user_id)
+                   .filter(before_cursor(TimelineEntry.timestamp, TimelineEntry.message_id, before))
+                   .order_by(TimelineEntry.timestamp.desc(), TimelineEntry.message_id.desc())
+                   .limit(limit)
+                   .all())
+
+    sources = [[tuple(row) for row in precomputed]]
+    sources.extend(recent_messages.entries(author_id, limit, before)
+                   for author_id in followed_celebrities(user_id))
+
+    # A message can sit in both the table and a buffer when its author
+    # crossed the threshold after it was fanned out.
+    seen = set()
+    merged = (message_id for _, message_id in heapq.merge(*sources, reverse=True)
+              if not (message_id in seen or seen.add(message_id)))
+    message_ids = list(islice(merged, limit))
+
+    if not message_ids:
+        return []
+
+    messages = {message.id: message
+                for message in Message.with_authors().filter(Message.id.in_(message_ids)).all()}
+
+    # Buffers can briefly hold ids from rolled-back transactions.
+    return [messages[message_id] for message_id in message_ids if message_id in messages]
+
+
+def newest_on_timeline(user_id):
+    """Id of the newest message on a user's home timeline, or None.
+
+    One indexed row plus the followed celebrities' buffers, for
+    validating a cached timeline without reading a page of it.
+    """
+
+    newest = (db.session.query(TimelineEntry.timestamp, TimelineEntry.message_id)
+              .filter(TimelineEntry.user_id == user_id)
+              .order_by(TimelineEntry.timestamp.desc(), TimelineEntry.message_id.desc())
+              .first())
+
+    heads = [tuple(newest)] if newest else []
+    for author_id in followed_celebrities(user_id):
+        heads.extend(recent_messages.entries(author_id, 1))
+
+    return max(heads)[1] if heads else None
+
+
+def rebuild_timelines():
+    """Recompute every timeline from the messages and follows tables.
+
+    Used after bulk loads (which skip the mapper events above) and to
+    repair drift; run User.reconcile_counts() first so the celebrity
+    cut-off sees real follower counts. Each user gets their own messages
+    plus the newest BACKFILL_LIMIT messages of every non-celebrity they
+    follow.
+    """
+
+    own = select(Message.user_id, Message.id, Message.user_id, Message.timestamp)
+
+    ranked = (select(
+                Follows.user_following_id.label('user_id'),
+                Message.id.label('message_id'),
+                Message.user_id.label('author_id'),
+                Message.timestamp.label('timestamp'),
+                func.row_number().over(
+                    partition_by=(Follows.user_following_id, Message.user_id),
+                    order_by=(Message.timestamp.desc(), Message.id.desc()),
+                ).label('rank'))
+              .join(Message, Message.user_id == Follows.user_being_followed_id)
+              .join(User, User.id == Follows.user_being_followed_id)
+              .where(Follows.user_following_id != Follows.user_being_followed_id)
+              .where(User.followers_count < celebrity_threshold())
+              .subquery())
+
+    followed = (select(ranked.c.user_id, ranked.c.message_id, ranked.c.author_id, ranked.c.timestamp)
+                .where(ranked.c.rank <= BACKFILL_LIMIT))
+
+    db.session.execute(TimelineEntry.__table__.delete())
+    db.session.execute(insert(TimelineEntry).from_select(
+        TIMELINE_COLUMNS, union_all(own, followed)))
+    db.session.commit()
+    recent_messages.clear()
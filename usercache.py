@@ -0,0 +1,224 @@
+"""Per-process cache of the logged-in user.
+
+``add_user_to_g()`` runs before every request, including redirects, so
+loading the user from the database each time adds a query to every hit.
+Instead it reads a lightweight, read-only ``UserSnapshot`` from this
+cache: a TTL'd LRU keyed by user id.
+
+Entries are invalidated by bumping the user's version number. A load
+records the version it started from and is only stored if nothing
+bumped it in the meantime, so a request that raced an update can't put
+stale data back. The listeners below note which users a flush touched
+(User updates and deletes, and new or deleted messages and follows,
+since the snapshot carries the counters) and bump their versions once
+the transaction commits; bumping any earlier would let a concurrent
+load store the old committed row under the new version. Writes made by
+other processes aren't seen until the TTL runs out.
+"""
+from collections import OrderedDict
+from itertools import count
+from threading import Lock
+from time import monotonic
+
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from models import db, Follows, Message, User
+
+# Defaults for the USER_CACHE_TTL and USER_CACHE_SIZE config keys.
+DEFAULT_TTL = 30
+DEFAULT_SIZE = 10000
+
+# Columns copied onto a snapshot. The password hash stays in the database.
+SNAPSHOT_FIELDS = ('id', 'username', 'email', 'image_url', 'header_image_url', 'bio', 'location',
+                   'messages_count', 'following_count', 'followers_count')
+
+
+class UserSnapshot:
+    """Read-only copy of a User row, safe to share between requests."""
+
+    __slots__ = SNAPSHOT_FIELDS
+
+    def __init__(self, user):
+        for field in SNAPSHOT_FIELDS:
+            setattr(self, field, getattr(user, field))
+
+    def __repr__(self):
+        return f"<UserSnapshot #{self.id}: {self.username}>"
+
+    def _follow_answers(self):
+        """This request's known answers to "does this user follow X?",
+        by X's id."""
+
+        memo = g.get('followed_ids')
+        if memo is None or memo[0] != self.id:
+            memo = g.followed_ids = (self.id, {})
+        return memo[1]
+
+    def follows_among(self, users):
+        """Return the ids of the `users` this user follows, in one query.
+
+        User lists call this before rendering, so the is_following() call
+        on each card is answered from memory.
+        """
+
+        answers = self._follow_answers()
+        unknown = [user.id for user in users if user.id not in answers]
+        if unknown:
+            followed = Follows.followed_among(self.id, unknown)
+            answers.update((user_id, user_id in followed) for user_id in unknown)
+
+        return {user.id for user in users if answers[user.id]}
+
+    def is_following(self, other_user):
+        """Is this user following `other_user`? (one EXISTS probe, once per request)"""
+
+        answers = self._follow_answers()
+        if other_user.id not in answers:
+            answers[other_user.id] = Follows.exists_between(self.id, other_user.id)
+        return answers[other_user.id]
+
+    def is_followed_by(self, other_user):
+        """Is this user followed by `other_user`?"""
+
+        return Follows.exists_between(other_user.id, self.id)
+
+
+class UserCache:
+    """TTL'd LRU of UserSnapshots with version-based invalidation.
+
+    Versions come from one counter shared by every user. Only users with a
+    cached entry keep an explicit version once the table is pruned; the
+    rest fall back to `_floor`, the counter value at the last prune, which
+    is never older than any version that was dropped.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, size=DEFAULT_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._clock = count(1)
+        self._floor = 0
+        self._lock = Lock()
+
+    def configure(self, ttl, size):
+        with self._lock:
+            self.ttl = ttl
+            self.size = size
+            self._entries.clear()
+
+    def get(self, user_id):
+        """Return a snapshot of user `user_id`, or None if there's no such
+        user or the account is deactivated."""
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            version = self._versions.get(user_id, self._floor)
+
+            if entry is not None:
+                snapshot, entry_version, loaded_at = entry
+                if entry_version == version and monotonic() - loaded_at < self.ttl:
+                    self._entries.move_to_end(user_id)
+                    self.hits += 1
+                    return snapshot
+                del self._entries[user_id]
+
+            self.misses += 1
+
+        user = db.session.get(User, user_id)
+        if user is None or user.deactivated_at is not None:
+            return None
+
+        snapshot = UserSnapshot(user)
+
+        with self._lock:
+            if self._versions.get(user_id, self._floor) == version:
+                self._versions[user_id] = version
+                self._entries[user_id] = (snapshot, version, monotonic())
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+
+        return snapshot
+
+    def version(self, user_id):
+        """User `user_id`'s current version; it changes whenever they do."""
+
+        with self._lock:
+            return self._versions.get(user_id, self._floor)
+
+    def versions(self, user_ids):
+        """The current versions of `user_ids`, in order."""
+
+        with self._lock:
+            return tuple(self._versions.get(user_id, self._floor) for user_id in user_ids)
+
+    def invalidate(self, *user_ids):
+        """Bump the version of each user so cached snapshots are reloaded."""
+
+        with self._lock:
+            for user_id in user_ids:
+                self._versions[user_id] = next(self._clock)
+                self._entries.pop(user_id, None)
+
+            if len(self._versions) > 2 * self.size:
+                self._prune()
+
+    def _prune(self):
+        """Drop the versions of users with no cached entry."""
+
+        self._floor = next(self._clock)
+        self._versions = {user_id: self._versions[user_id] for user_id in self._entries}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = UserCache()
+
+
+def invalidate_on_commit(target, *user_ids):
+    """Queue `user_ids` to be invalidated when `target`'s session commits."""
+
+    session = object_session(target)
+    if session is None:
+        user_cache.invalidate(*user_ids)
+    else:
+        session.info.setdefault('user_cache_pending', set()).update(user_ids)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_user(mapper, connection, user):
+    invalidate_on_commit(user, user.id)
+
+
+@event.listens_for(Message, 'after_insert')
+@event.listens_for(Message, 'after_delete')
+def invalidate_author(mapper, connection, message):
+    invalidate_on_commit(message, message.user_id)
+
+
+@event.listens_for(Follows, 'after_insert')
+@event.listens_for(Follows, 'after_delete')
+def invalidate_follow(mapper, connection, follow):
+    invalidate_on_commit(follow, follow.user_following_id, follow.user_being_followed_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed(session):
+    pending = session.info.pop('user_cache_pending', None)
+    if pending:
+        user_cache.invalidate(*pending)
+        if has_app_context():
+            g.pop('followed_ids', None)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_rolled_back(session):
+    session.info.pop('user_cache_pending', None)